@@ -1,8 +1,21 @@
 from flask import Flask, render_template, request, redirect, url_for, session, send_file, jsonify, send_from_directory, make_response, Response
 from functools import wraps
-import io
+from itertools import islice
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import atexit
+import asyncio
+import base64
+import binascii
+import bisect
+import click
+import codecs
+import gzip
 import json
+import mimetypes
 import os
+import queue
 from datetime import datetime, timedelta
 import pytz
 import random
@@ -10,7 +23,19 @@ import time
 import threading
 import requests
 import re
+import shutil
+import sqlite3
+import hashlib
+import heapq
 from flask import g
+try:
+    import fcntl
+except ImportError:  # Windows dev boxes; shared mode needs it
+    fcntl = None
+try:
+    import brotli
+except ImportError:  # optional, game pages are then served gzip only
+    brotli = None
 import instaloader
 
 # ===============================================================
@@ -150,6 +175,8 @@ def format_time_filter(timestamp):
 DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
 
 USERS_FILE = os.path.join(DATA_DIR, 'users.json')
+# Names of the one-time data migrations that have run -> when
+MIGRATIONS_FILE = os.path.join(DATA_DIR, 'migrations.json')
 GAMES_FILE = os.path.join(DATA_DIR, 'games.json')
 ANNOUNCEMENTS_FILE = os.path.join(DATA_DIR, 'announcements.json')
 FEEDBACK_FILE = os.path.join(DATA_DIR, 'feedback.json')
@@ -164,7 +191,8 @@ CODES_FILE = os.path.join(DATA_DIR, 'codes.json')
 REDEEMED_CODES_FILE = os.path.join(DATA_DIR, 'redeemed_codes.json')
 RANK_PASS_FILE = os.path.join(DATA_DIR, 'rank_pass.json')
 PLAYS_FILE = os.path.join(DATA_DIR, 'game_plays.json')
-LOUNGE_REACTIONS_FILE = os.path.join(DATA_DIR, 'lounge_reactions.json')
+PLAY_BUCKETS_FILE = os.path.join(DATA_DIR, 'game_play_buckets.json')
+LOUNGE_REACTIONS_FILE = os.path.join(DATA_DIR, 'lounge_reactions2.json')
 LOUNGE_READ_RECEIPTS_FILE = os.path.join(DATA_DIR, 'lounge_read_receipts1.json')
 MAINTENANCE_FILE = os.path.join(DATA_DIR, 'maintenance.json')
 TOWER_WINS_FILE = os.path.join(DATA_DIR, 'tower_wins.json')
@@ -179,37 +207,1413 @@ SITE_ACCESS_FILE = os.path.join(DATA_DIR, 'site_access.json')
 ADVENT_CALENDAR_FILE = os.path.join(DATA_DIR, 'advent_calendar.json')
 GROUPS_FILE = os.path.join(DATA_DIR, 'groups.json')
 GROUP_MESSAGES_FILE = os.path.join(DATA_DIR, 'group_messages.json')
-GROUP_REACTIONS_FILE = os.path.join(DATA_DIR, 'group_reactions.json')
+GROUP_REACTIONS_FILE = os.path.join(DATA_DIR, 'group_reactions2.json')
 GROUP_READ_RECEIPTS_FILE = os.path.join(DATA_DIR, 'group_read_receipts.json')
-ACTION_LOGS_FILE = os.path.join(DATA_DIR, 'action_logs.json')
-TOKEN_TRANSACTIONS_FILE = os.path.join(DATA_DIR, 'token_transactions.json')
+ACTION_LOGS_FILE = os.path.join(DATA_DIR, 'action_logs2.json')
+# Reactions keyed by list index, from before messages had IDs (read once to migrate)
+LEGACY_LOUNGE_REACTIONS = os.path.join(DATA_DIR, 'lounge_reactions.json')
+LEGACY_GROUP_REACTIONS = os.path.join(DATA_DIR, 'group_reactions.json')
+TOKEN_TRANSACTIONS_FILE = os.path.join(DATA_DIR, 'token_transactions2.json')
 REPORTED_MESSAGES_FILE = os.path.join(DATA_DIR, 'reported_messages.json')
 PAYCHECKS_FILE = os.path.join(DATA_DIR, 'paychecks.json')
-CASINO_STATS_FILE = os.path.join(DATA_DIR, 'casino_stats.json')
+CASINO_STATS_FILE = os.path.join(DATA_DIR, 'casino_stats2.json')
+# Newest-first lists from before the logs were LogStores (read once to migrate)
+LEGACY_ACTION_LOGS = os.path.join(DATA_DIR, 'action_logs.json')
+LEGACY_TOKEN_TRANSACTIONS = os.path.join(DATA_DIR, 'token_transactions.json')
+LEGACY_CASINO_STATS = os.path.join(DATA_DIR, 'casino_stats.json')
 LOTTERY_HISTORY_FILE = os.path.join(DATA_DIR, 'lottery_history.json')
-
-tower_games = {}
-
+TOWER_GAMES_FILE = os.path.join(DATA_DIR, 'tower_games.json')
+TYPING_STATUS_FILE = os.path.join(DATA_DIR, 'typing_status.json')
 
 # Create data directory if it doesn't exist
 if not os.path.exists(DATA_DIR):
     os.makedirs(DATA_DIR)
 
+# ===============================================================
+# Locking
+# ===============================================================
+# Multi-worker mode (e.g. gunicorn -w 4, without --preload): every store
+# lives in SQLite, each worker keeps a cached copy and pulls the rows other
+# workers changed at the start of each request, and store/balance locks also
+# exclude the other workers.
+SHARED_STATE = os.environ.get('STUDYHALL_SHARED_STATE', '0') == '1'
+LOCK_DIR = os.path.join(DATA_DIR, 'locks')
+
+if SHARED_STATE:
+    if fcntl is None:
+        raise RuntimeError('STUDYHALL_SHARED_STATE needs fcntl (Linux/macOS)')
+    os.makedirs(LOCK_DIR, exist_ok=True)
+
+class WorkerLock:
+    """Re-entrant lock that also excludes other worker processes.
+
+    The outermost acquire takes a flock on a lock file and then runs
+    on_acquire, which pulls the other workers' latest writes so the holder
+    never decides on stale data.
+    """
+
+    def __init__(self, path, on_acquire):
+        self.local = threading.RLock()
+        self.path = path
+        self.on_acquire = on_acquire
+        self.depth = 0
+        self.fd = None
+
+    def acquire(self):
+        self.local.acquire()
+        self.depth += 1
+        if self.depth > 1:
+            return
+        try:
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        except BaseException:
+            self.depth -= 1
+            self.local.release()
+            raise
+        try:
+            self.on_acquire()
+        except BaseException:
+            self.release()
+            raise
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.local.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class LockManager:
+    """One re-entrant lock per store (keyed by its *_FILE path) and per user balance.
+
+    Multi-lock helpers always acquire in sorted order so two requests taking
+    the same pair of locks can't deadlock. In shared mode the locks are
+    WorkerLocks; local() is the thread-only half, for code that just needs a
+    consistent in-memory view (serializing, applying a sync).
+    """
+
+    def __init__(self):
+        self.guard = threading.Lock()
+        self.store_locks = {}
+        self.balance_locks = {}
+
+    def _get(self, table, key, lock_name, sync_filepath):
+        with self.guard:
+            if key not in table:
+                if SHARED_STATE:
+                    table[key] = WorkerLock(os.path.join(LOCK_DIR, lock_name + '.lock'),
+                                            lambda: sync_store(sync_filepath))
+                else:
+                    table[key] = threading.RLock()
+            return table[key]
+
+    def store(self, filepath):
+        return self._get(self.store_locks, filepath, store_name(filepath), filepath)
+
+    def balance(self, username):
+        lock_name = 'balance-' + hashlib.sha1(username.encode('utf-8')).hexdigest()[:16]
+        return self._get(self.balance_locks, username, lock_name, USERS_FILE)
+
+    def local(self, filepath):
+        lock = self.store(filepath)
+        return lock.local if SHARED_STATE else lock
+
+    @contextmanager
+    def _hold(self, held):
+        for lock in held:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(held):
+                lock.release()
+
+    def stores(self, *filepaths):
+        return self._hold([self.store(f) for f in sorted(set(filepaths))])
+
+    def balances(self, *usernames):
+        return self._hold([self.balance(u) for u in sorted(set(usernames))])
+
+locks = LockManager()
+
+def store_locked(*filepaths):
+    """Run the whole view while holding the given store locks"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            with locks.stores(*filepaths):
+                return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+# ===============================================================
+# Storage engines
+# ===============================================================
+# 'json' keeps one file per store, 'sqlite' keeps one table per store
+STORAGE_ENGINE = 'sqlite' if SHARED_STATE else os.environ.get('STUDYHALL_STORAGE', 'json')
+SQLITE_FILE = os.path.join(DATA_DIR, 'studyhall.db')
+
+def store_name(filepath):
+    """Table name for a *_FILE path (e.g. read_receipts1.json -> read_receipts1)"""
+    name = os.path.splitext(os.path.basename(filepath))[0]
+    return re.sub(r'[^0-9A-Za-z_]', '_', name)
+
+# Older snapshots kept next to each JSON store as <file>.1 ... <file>.N, at
+# most one new generation per SNAPSHOT_ROTATE_SECONDS (and on the first save
+# after a start) so they reach back further than a few write-behind flushes
+SNAPSHOT_GENERATIONS = int(os.environ.get('STUDYHALL_SNAPSHOT_GENERATIONS', 3))
+SNAPSHOT_ROTATE_SECONDS = int(os.environ.get('STUDYHALL_SNAPSHOT_ROTATE_SECONDS', 600))
+
+# Stores bigger than this are parsed one top-level element at a time, so the
+# raw text and the parsed object are never both fully in memory
+STREAM_LOAD_BYTES = int(os.environ.get('STUDYHALL_STREAM_LOAD_BYTES', 8 * 1024 * 1024))
+
+def stream_json(f, hasher, chunk_size=1024 * 1024):
+    """Parse the JSON document in binary file f incrementally, feeding every byte to hasher"""
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    eof = False
+
+    def fill(size):
+        nonlocal buf, pos, eof
+        raw = f.read(size)
+        if raw:
+            hasher.update(raw)
+        else:
+            eof = True
+        buf = buf[pos:] + utf8.decode(raw, final=eof)
+        pos = 0
+
+    def skip_ws():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buf) or eof:
+                return
+            fill(chunk_size)
+
+    def expect(chars):
+        nonlocal pos
+        skip_ws()
+        if pos >= len(buf) or buf[pos] not in chars:
+            raise ValueError(f'Expected one of {chars!r} at offset {pos}')
+        pos += 1
+        return buf[pos - 1]
+
+    def next_value():
+        nonlocal pos
+        skip_ws()
+        size = chunk_size
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+                # Only trust a value followed by a delimiter - a number cut
+                # at the buffer edge ('-25' of '-25.0') also decodes
+                if eof or (end < len(buf) and buf[end] in ' \t\r\n,:]}'):
+                    pos = end
+                    return value
+            except ValueError:
+                if eof:
+                    raise
+            fill(size)
+            size *= 2
+
+    skip_ws()
+    if pos < len(buf) and buf[pos] in '[{':
+        close = ']' if buf[pos] == '[' else '}'
+        result = [] if close == ']' else {}
+        pos += 1
+        skip_ws()
+        if pos < len(buf) and buf[pos] == close:
+            pos += 1
+        else:
+            while True:
+                if close == '}':
+                    key = next_value()
+                    expect(':')
+                    result[key] = next_value()
+                else:
+                    result.append(next_value())
+                if expect(',' + close) == close:
+                    break
+    else:
+        result = next_value()
+
+    skip_ws()
+    if pos < len(buf):
+        raise ValueError(f'Extra data at offset {pos}')
+    return result
+
+def fsync_dir(path):
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class JsonFileEngine:
+    """Every store is a single JSON document on disk.
+
+    Snapshots are written to a temp file, fsynced and renamed over the old
+    one, so readers never see a half-written file. Each snapshot has a
+    <file>.sha256 checksum and the previous SNAPSHOT_GENERATIONS versions are
+    kept; load() returns the newest generation that verifies.
+
+    The checksum file is replaced first and lists the new digest followed by
+    the ones it replaces, so a crash before the data file's rename still
+    leaves a checksum that matches it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # filepath -> time.monotonic() of its last rotation
+        self.rotated = {}
+
+    def generations(self, filepath):
+        return [filepath] + [f'{filepath}.{i}' for i in range(1, SNAPSHOT_GENERATIONS + 1)]
+
+    def read_snapshot(self, path):
+        """Parsed contents of one generation, or None if missing/corrupt"""
+        if not os.path.exists(path):
+            return None
+        try:
+            expected = None
+            if os.path.exists(path + '.sha256'):
+                with open(path + '.sha256', 'r') as f:
+                    expected = f.read().split()
+            hasher = hashlib.sha256()
+            if os.path.getsize(path) > STREAM_LOAD_BYTES:
+                with open(path, 'rb') as f:
+                    data = stream_json(f, hasher)
+            else:
+                with open(path, 'rb') as f:
+                    payload = f.read()
+                hasher.update(payload)
+                data = None
+            if expected is not None and hasher.hexdigest() not in expected:
+                print(f"Checksum mismatch in {path}")
+                return None
+            return json.loads(payload.decode('utf-8')) if data is None else data
+        except Exception as e:
+            print(f"Could not read {path}: {e}")
+            return None
+
+    def load(self, filepath, default_data):
+        for path in self.generations(filepath):
+            data = self.read_snapshot(path)
+            if data is not None:
+                if path != filepath:
+                    print(f"Recovered {filepath} from {path}")
+                return data
+        return default_data
+
+    def rotate(self, filepath):
+        """Shift <file> -> <file>.1 -> ... keeping <file> itself in place"""
+        paths = self.generations(filepath)
+        for older, newer in reversed(list(zip(paths[1:], paths[2:]))):
+            for suffix in ('', '.sha256'):
+                if os.path.exists(older + suffix):
+                    os.replace(older + suffix, newer + suffix)
+        if SNAPSHOT_GENERATIONS < 1 or not os.path.exists(filepath):
+            return
+        for suffix in ('', '.sha256'):
+            if not os.path.exists(filepath + suffix):
+                continue
+            if os.path.exists(paths[1] + suffix):
+                os.remove(paths[1] + suffix)
+            try:
+                os.link(filepath + suffix, paths[1] + suffix)
+            except OSError:
+                shutil.copy2(filepath + suffix, paths[1] + suffix)
+
+    def save(self, filepath, data, keys=None):
+        payload = json.dumps(data, indent=2, ensure_ascii=False).encode('utf-8')
+        digest = hashlib.sha256(payload).hexdigest()
+        tmp = f'{filepath}.{threading.get_ident()}.tmp'
+        with self.lock:
+            with open(tmp, 'wb') as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            previous = []
+            if os.path.exists(filepath + '.sha256'):
+                with open(filepath + '.sha256', 'r') as f:
+                    previous = f.read().split()
+            with open(tmp + '.sha256', 'w') as f:
+                f.write('\n'.join([digest] + previous[:2]))
+                f.flush()
+                os.fsync(f.fileno())
+            now = time.monotonic()
+            if now - self.rotated.get(filepath, float('-inf')) >= SNAPSHOT_ROTATE_SECONDS:
+                self.rotate(filepath)
+                self.rotated[filepath] = now
+            os.replace(tmp + '.sha256', filepath + '.sha256')
+            os.replace(tmp, filepath)
+            fsync_dir(filepath)
+
+class SQLiteEngine:
+    """Embedded SQLite (WAL) backend with one table per store.
+
+    Dict stores keep one row per top-level key, list stores one row per
+    position. save() only upserts rows whose serialized value changed since
+    the last load/save, so a write costs O(changed rows) in I/O. Callers that
+    know what they touched can pass keys= to skip diffing the other rows
+    (top-level keys for dicts, indexes for lists).
+
+    Every save bumps the store's version and stamps the rows it wrote with
+    it, so refresh() can pull just the rows another process changed.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA busy_timeout=10000')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS _stores (name TEXT PRIMARY KEY, kind TEXT NOT NULL)')
+        self._add_column('_stores', 'version', 'INTEGER NOT NULL DEFAULT 0')
+        self._add_column('_stores', 'removed', 'INTEGER NOT NULL DEFAULT 0')
+        # table -> {row key: (pos, serialized value)} as last seen on disk
+        self.rows = {}
+        # table -> store version self.rows reflects
+        self.versions = {}
+        # table -> 'dict', 'list' or 'value' as recorded in _stores
+        self.kinds = {}
+        # table -> pos the next new key of a dict store gets
+        self.next_pos = {}
+
+    def _add_column(self, table, column, decl):
+        """Upgrade databases created before the column existed"""
+        columns = [row[1] for row in self.conn.execute(f'PRAGMA table_info("{table}")')]
+        if column not in columns:
+            self.conn.execute(f'ALTER TABLE "{table}" ADD COLUMN {column} {decl}')
+
+    def _create_table(self, table, kind):
+        self.conn.execute(f'CREATE TABLE IF NOT EXISTS "{table}" (k TEXT PRIMARY KEY, pos INTEGER NOT NULL, v TEXT NOT NULL, ver INTEGER NOT NULL DEFAULT 0)')
+        self._add_column(table, 'ver', 'INTEGER NOT NULL DEFAULT 0')
+        self.conn.execute('INSERT OR IGNORE INTO _stores (name, kind) VALUES (?, ?)', (table, kind))
+        self.conn.execute('UPDATE _stores SET kind = ? WHERE name = ?', (kind, table))
+        self.kinds[table] = kind
+
+    def load(self, filepath, default_data):
+        table = store_name(filepath)
+        with self.lock:
+            row = self.conn.execute('SELECT kind FROM _stores WHERE name = ?', (table,)).fetchone()
+            if row is None:
+                # First start on this engine - import the existing JSON file once
+                data = JsonFileEngine().load(filepath, default_data)
+                self.save(filepath, data)
+                return data
+
+            kind = row[0]
+            self.kinds[table] = kind
+            self._add_column(table, 'ver', 'INTEGER NOT NULL DEFAULT 0')
+            cached = {}
+            self.conn.execute('BEGIN')
+            try:
+                version = self.conn.execute('SELECT version FROM _stores WHERE name = ?', (table,)).fetchone()[0]
+                rows = self.conn.execute(f'SELECT k, pos, v FROM "{table}" ORDER BY pos').fetchall()
+            finally:
+                self.conn.execute('COMMIT')
+            for k, pos, v in rows:
+                cached[k] = (pos, v)
+            self.rows[table] = cached
+            self.versions[table] = version
+            self.next_pos.pop(table, None)
+
+        if kind == 'dict':
+            return {k: json.loads(v) for k, (pos, v) in cached.items()}
+        if kind == 'list':
+            return [json.loads(v) for k, (pos, v) in cached.items()]
+        if '' not in cached and cached:
+            # Keyed rows under a 'value' kind: a dict saved over a None
+            # default before save() recorded kind changes
+            return {k: json.loads(v) for k, (pos, v) in cached.items()}
+        return json.loads(cached[''][1]) if '' in cached else default_data
+
+    def save(self, filepath, data, keys=None):
+        table = store_name(filepath)
+        if isinstance(data, dict):
+            kind = 'dict'
+        elif isinstance(data, list):
+            kind = 'list'
+        else:
+            kind = 'value'
+
+        with self.lock:
+            if table not in self.rows:
+                self._create_table(table, kind)
+                self.rows[table] = {}
+                self.versions[table] = self.conn.execute(
+                    'SELECT version FROM _stores WHERE name = ?', (table,)).fetchone()[0]
+            cached = self.rows[table]
+            # A store saved as another type before (e.g. a None default that
+            # later became a dict): record the new kind and replace every row
+            retyped = self.kinds.get(table) != kind
+            if retyped:
+                keys = None
+
+            if kind == 'dict':
+                candidates = keys if keys is not None else list(data.keys())
+                if table not in self.next_pos:
+                    self.next_pos[table] = max((pos for pos, v in cached.values()), default=-1) + 1
+                current = {}
+                for key in candidates:
+                    if key not in data:
+                        continue
+                    text = json.dumps(data[key], ensure_ascii=False)
+                    if key in cached:
+                        current[key] = (cached[key][0], text)
+                    else:
+                        current[key] = (self.next_pos[table], text)
+                        self.next_pos[table] += 1
+                if keys is not None:
+                    removed = [k for k in keys if k not in data and k in cached]
+                else:
+                    removed = [k for k in cached if k not in data]
+            elif kind == 'list':
+                candidates = keys if keys is not None else range(len(data))
+                current = {str(i): (i, json.dumps(data[i], ensure_ascii=False)) for i in candidates if 0 <= i < len(data)}
+                removed = [] if retyped else [k for k in cached if int(k) >= len(data)]
+            else:
+                current = {'': (0, json.dumps(data, ensure_ascii=False))}
+                removed = []
+            if retyped:
+                removed = [k for k in cached if k not in current]
+
+            changed = [(k, pos, text) for k, (pos, text) in current.items() if cached.get(k) != (pos, text)]
+            if not changed and not removed and not retyped:
+                return
+
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                if retyped:
+                    self._create_table(table, kind)
+                self.conn.execute('UPDATE _stores SET version = version + 1 WHERE name = ?', (table,))
+                if removed:
+                    self.conn.execute('UPDATE _stores SET removed = version WHERE name = ?', (table,))
+                version = self.conn.execute('SELECT version FROM _stores WHERE name = ?', (table,)).fetchone()[0]
+                if changed:
+                    self.conn.executemany(
+                        f'INSERT INTO "{table}" (k, pos, v, ver) VALUES (?, ?, ?, ?) '
+                        'ON CONFLICT(k) DO UPDATE SET pos = excluded.pos, v = excluded.v, ver = excluded.ver',
+                        [(k, pos, text, version) for k, pos, text in changed]
+                    )
+                if removed:
+                    self.conn.executemany(f'DELETE FROM "{table}" WHERE k = ?', [(k,) for k in removed])
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+            for k, pos, text in changed:
+                cached[k] = (pos, text)
+            for k in removed:
+                del cached[k]
+            # If another process wrote in between, keep the old version so
+            # the next refresh() still picks its rows up
+            if self.versions.get(table, 0) == version - 1:
+                self.versions[table] = version
+
+    def stale_tables(self):
+        """Tables another process has written since we last loaded/refreshed them"""
+        with self.lock:
+            rows = self.conn.execute('SELECT name, version FROM _stores').fetchall()
+        return {name for name, version in rows
+                if name in self.versions and self.versions[name] != version}
+
+    def refresh(self, filepath, data):
+        """Apply rows other processes wrote since our last load/refresh to data in place.
+
+        Returns the keys (list indexes for list stores) that changed.
+        """
+        table = store_name(filepath)
+        with self.lock:
+            if table not in self.versions:
+                return []
+            known = self.versions[table]
+            self.conn.execute('BEGIN')
+            try:
+                version, removed_at = self.conn.execute(
+                    'SELECT version, removed FROM _stores WHERE name = ?', (table,)).fetchone()
+                if version == known:
+                    return []
+                changed = self.conn.execute(
+                    f'SELECT k, pos, v FROM "{table}" WHERE ver > ? ORDER BY pos', (known,)).fetchall()
+                present = None
+                if removed_at > known:
+                    present = {k for (k,) in self.conn.execute(f'SELECT k FROM "{table}"')}
+            finally:
+                self.conn.execute('COMMIT')
+
+            cached = self.rows[table]
+            for k, pos, v in changed:
+                cached[k] = (pos, v)
+                if table in self.next_pos:
+                    self.next_pos[table] = max(self.next_pos[table], pos + 1)
+            gone = [k for k in cached if k not in present] if present is not None else []
+            for k in gone:
+                del cached[k]
+            self.versions[table] = version
+
+        if isinstance(data, dict):
+            for k, pos, v in changed:
+                data[k] = json.loads(v)
+            for k in gone:
+                data.pop(k, None)
+        elif isinstance(data, list):
+            del data[len(cached):]
+            for k, pos, v in changed:
+                if pos < len(data):
+                    data[pos] = json.loads(v)
+                else:
+                    data.append(json.loads(v))
+        return [k for k, pos, v in changed] + gone
+
+def create_storage_engine(kind):
+    if kind == 'sqlite':
+        return SQLiteEngine(SQLITE_FILE)
+    return JsonFileEngine()
+
+storage = create_storage_engine(STORAGE_ENGINE)
+
 # ===============================================================
 # JSON persistence helpers
 # ===============================================================
+# filepath -> the object the module global for that store is bound to
+live_stores = {}
+
+# Startup reads the JSON stores on a thread pool (file I/O and checksumming
+# overlap); the module-level load_json calls then just pick the results up
+LOAD_WORKERS = int(os.environ.get('STUDYHALL_LOAD_WORKERS', 8))
+NOT_FOUND = object()
+preloaded = {}
+load_timings = {}  # filepath -> seconds spent in storage.load
+
+def timed_load(filepath, default_data):
+    started = time.perf_counter()
+    data = storage.load(filepath, default_data)
+    load_timings[filepath] = time.perf_counter() - started
+    return data
+
+def preload_stores(filepaths):
+    """Read stores concurrently ahead of their load_json calls"""
+    # SQLite loads share one connection, so only the JSON engine benefits
+    if not isinstance(storage, JsonFileEngine) or LOAD_WORKERS <= 1:
+        return
+    with ThreadPoolExecutor(max_workers=LOAD_WORKERS) as pool:
+        futures = {fp: pool.submit(timed_load, fp, NOT_FOUND) for fp in filepaths}
+    for filepath, future in futures.items():
+        try:
+            preloaded[filepath] = future.result()
+        except Exception as e:
+            print(f"Preloading {filepath} failed, loading it again: {e}")
+
+def report_load_timings(started):
+    """Print where startup time went, slowest stores first"""
+    print(f"Loaded {len(load_timings)} stores in {time.perf_counter() - started:.2f}s")
+    for filepath, seconds in sorted(load_timings.items(), key=lambda item: -item[1])[:10]:
+        size = os.path.getsize(filepath) if os.path.exists(filepath) else 0
+        print(f"  {os.path.basename(filepath):<28} {seconds * 1000:8.1f} ms {size / 1024:10.1f} KiB")
+
 def load_json(filepath, default_data):
-    if os.path.exists(filepath):
+    if filepath in preloaded:
+        data = preloaded.pop(filepath)
+        if data is NOT_FOUND:
+            data = default_data
+    else:
+        data = timed_load(filepath, default_data)
+    if filepath in journals:
+        data = journals[filepath].replay(data)
+    live_stores[filepath] = data
+    return data
+
+def sync_store(filepath):
+    """Pull rows other workers wrote to one store into our copy (shared mode)"""
+    if not SHARED_STATE or filepath not in live_stores:
+        return
+    with locks.local(filepath):
+        changed = storage.refresh(filepath, live_stores[filepath])
+        if filepath == MESSAGES_FILE:
+            for chat_key in changed:
+                if chat_key in chat_feeds and chat_key in messages:
+                    chat_feeds[chat_key].sync(messages[chat_key])
+        elif filepath == LOUNGE_FILE and changed:
+            lounge_changes.sync(lounge_messages)
+        elif filepath == GROUP_MESSAGES_FILE:
+            for group_id in changed:
+                if group_id not in group_messages:
+                    group_feeds.pop(group_id, None)
+                elif group_id in group_feeds:
+                    group_feeds[group_id].sync(group_messages[group_id])
+        elif filepath in log_stores and changed:
+            log_stores[filepath].rebuild()
+        elif filepath == USERS_FILE:
+            circulation.track(*changed)
+    if filepath == PLAYS_FILE:
+        for username in changed:
+            refresh_top_plays(username)
+    if changed and filepath in (LOUNGE_FILE, LOUNGE_REACTIONS_FILE):
+        publish_lounge_feed()
+    if changed and filepath == LOUNGE_FILE:
+        rebuild_lounge_counters()
+    # Inbox entries for chats or receipts another worker changed
+    if filepath == MESSAGES_FILE:
+        for chat_key in changed:
+            for username in chat_participants(chat_key):
+                refresh_inbox(username, chat_key)
+    elif filepath == READ_RECEIPTS_FILE:
+        for username in changed:
+            chat_keys = {entry['chat_key'] for entry in inbox(username).values()}
+            for chat_key in chat_keys | set(read_receipts.get(username, {})):
+                refresh_inbox(username, chat_key)
+    # Group unread counts for groups, messages or receipts another worker changed
+    elif filepath == GROUPS_FILE and changed:
+        rebuild_group_index()
+    elif filepath == GROUP_MESSAGES_FILE:
+        for group_id in changed:
+            reindex_group(group_id)
+    elif filepath == GROUP_READ_RECEIPTS_FILE:
+        for username in changed:
+            for group_id in group_index.groups_of(username):
+                refresh_group_unread(username, group_id)
+
+def sync_stores():
+    """Pull every store another worker has written since we last looked"""
+    stale = storage.stale_tables()
+    for filepath in list(live_stores):
+        if store_name(filepath) in stale:
+            sync_store(filepath)
+
+# save_json only marks a store dirty; persist_thread writes each dirty store at
+# most once per STUDYHALL_FLUSH_INTERVAL_MS. That interval is the durability
+# bound: the longest an acknowledged change lives only in memory. 0 writes
+# through synchronously like before.
+# Shared mode always writes through so other workers see changes immediately.
+FLUSH_INTERVAL_MS = 0 if SHARED_STATE else int(os.environ.get('STUDYHALL_FLUSH_INTERVAL_MS', 500))
+
+dirty_stores = {}  # filepath -> (data, set of changed keys or None for all)
+dirty_lock = threading.Lock()
+
+def write_store(filepath, data, keys=None):
+    """Write a store to the storage engine right now"""
+    if filepath in journals:
+        if keys is None:
+            # A full snapshot already contains every journaled message
+            journals[filepath].compact(data)
+        else:
+            journals[filepath].record(data, keys)
+        return
+    # Mutators of the same store hold this lock, so the dict can't change
+    # size while it is being serialized
+    with locks.local(filepath):
+        storage.save(filepath, data, keys)
+
+def save_json(filepath, data, keys=None):
+    """Persist a store. keys= lists the top-level keys that changed (optional)"""
+    live_stores[filepath] = data
+    if FLUSH_INTERVAL_MS <= 0:
+        write_store(filepath, data, keys)
+        return
+    with dirty_lock:
+        if filepath in dirty_stores:
+            pending_data, pending_keys = dirty_stores[filepath]
+            if keys is None or pending_keys is None or pending_data is not data:
+                keys = None
+            else:
+                keys = pending_keys | set(keys)
+        elif keys is not None:
+            keys = set(keys)
+        dirty_stores[filepath] = (data, keys)
+
+def flush_stores():
+    """Write every dirty store. Called by persist_thread and at shutdown"""
+    with dirty_lock:
+        pending = dict(dirty_stores)
+        dirty_stores.clear()
+    for filepath, (data, keys) in pending.items():
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return default_data
-    return default_data
+            write_store(filepath, data, list(keys) if keys is not None else None)
+        except Exception as e:
+            print(f"Error flushing {filepath}: {e}")
+            with dirty_lock:
+                # Retry on the next tick unless a newer save already queued it
+                dirty_stores.setdefault(filepath, (data, None))
+
+# ===============================================================
+# Message journals
+# ===============================================================
+# Chat, lounge and group messages are appended to a JSONL journal instead of
+# rewriting the whole store, and keyed saves journal the changed keys. The
+# journal is folded into the snapshot by periodic_compact_journals (sooner once
+# it passes JOURNAL_COMPACT_BYTES), or by any full save_json of the store.
+JOURNAL_COMPACT_SECONDS = int(os.environ.get('STUDYHALL_JOURNAL_COMPACT_SECONDS', 300))
+JOURNAL_COMPACT_BYTES = int(os.environ.get('STUDYHALL_JOURNAL_COMPACT_BYTES', 16 * 1024 * 1024))
+journal_full = threading.Event()
+
+class MessageJournal:
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.path = os.path.splitext(filepath)[0] + '.journal.jsonl'
+        self.lock = locks.local(filepath)
+        self.pending = 0
+        self.size = 0
+        self.handle = None
+        # The live store this journal belongs to, used by the compaction thread
+        self.data = None
+
+    def replay(self, data):
+        """Apply journal entries written after the last snapshot to data"""
+        self.data = data
+        if not os.path.exists(self.path):
+            return data
+        with self.lock:
+            with open(self.path, 'rb') as f:
+                raw = f.read()
+            # Drop a torn final line left by a crash mid-append
+            end = raw.rfind(b'\n') + 1
+            if end != len(raw):
+                with open(self.path, 'r+b') as f:
+                    f.truncate(end)
+            self.size = end
+            for line in raw[:end].splitlines():
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self.replay_entry(data, entry)
+                self.pending += 1
+        return data
+
+    def replay_entry(self, data, entry):
+        if 'message' in entry:
+            self.apply(data, entry['message'], entry.get('key'))
+        elif 'seq' in entry:
+            # An edited message of a list store, found by ID since tombstone
+            # drops shift positions
+            position = message_position(data, entry['seq'])
+            if position is not None:
+                data[position] = entry['set']
+        elif 'set' in entry:
+            data[entry['key']] = entry['set']
+        else:
+            data.pop(entry['key'], None)
+
+    def apply(self, data, message, key):
+        msgs = data if key is None else data.setdefault(key, [])
+        # A crash between compact()'s snapshot and its truncate leaves entries
+        # the snapshot already holds; IDs only grow, so skip those
+        if 'seq' in message and msgs and msgs[-1].get('seq', 0) >= message['seq']:
+            return
+        msgs.append(message)
+
+    def write(self, lines):
+        """Append journal lines with one fsync'd write. Caller holds self.lock"""
+        if self.handle is None:
+            self.handle = open(self.path, 'a', encoding='utf-8')
+        text = ''.join(lines)
+        self.handle.write(text)
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+        self.pending += len(lines)
+        self.size += len(text.encode('utf-8'))
+        if self.size >= JOURNAL_COMPACT_BYTES:
+            journal_full.set()
+
+    def append(self, data, message, key=None):
+        """Add message to the in-memory store and journal it with one fsync'd write"""
+        line = json.dumps({'key': key, 'message': message}, ensure_ascii=False) + '\n'
+        with self.lock:
+            self.data = data
+            self.apply(data, message, key)
+            self.write([line])
+
+    def record(self, data, keys):
+        """Journal the current value of each changed key, or its removal"""
+        if isinstance(data, list) and any(key >= len(data) for key in keys):
+            # Positions from before the list shrank; only a snapshot is safe
+            self.compact(data)
+            return
+        lines = []
+        with self.lock:
+            self.data = data
+            for key in keys:
+                if isinstance(data, list):
+                    entry = {'seq': data[key]['seq'], 'set': data[key]}
+                elif key in data:
+                    entry = {'key': key, 'set': data[key]}
+                else:
+                    entry = {'key': key, 'drop': True}
+                lines.append(json.dumps(entry, ensure_ascii=False) + '\n')
+            self.write(lines)
+
+    def compact(self, data):
+        """Write a full snapshot and start an empty journal"""
+        with self.lock:
+            storage.save(self.filepath, data)
+            if self.handle is not None:
+                self.handle.close()
+                self.handle = None
+            if os.path.exists(self.path):
+                with open(self.path, 'w') as f:
+                    os.fsync(f.fileno())
+            self.pending = 0
+            self.size = 0
+
+class LogJournal(MessageJournal):
+    """Journal for a LogStore: every line sets one key of the store's dict"""
+
+    def apply(self, data, message, key):
+        data[key] = message
+
+# Journals are per-process files, so shared mode appends rows in SQLite instead
+journals = {} if SHARED_STATE else {
+    MESSAGES_FILE: MessageJournal(MESSAGES_FILE),
+    LOUNGE_FILE: MessageJournal(LOUNGE_FILE),
+    GROUP_MESSAGES_FILE: MessageJournal(GROUP_MESSAGES_FILE),
+    ACTION_LOGS_FILE: LogJournal(ACTION_LOGS_FILE),
+    TOKEN_TRANSACTIONS_FILE: LogJournal(TOKEN_TRANSACTIONS_FILE),
+    CASINO_STATS_FILE: LogJournal(CASINO_STATS_FILE),
+}
 
-def save_json(filepath, data):
-    with open(filepath, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+def append_message(filepath, store, message, key=None):
+    """Append one message to a journaled store (key is the chat/group id for dict stores)"""
+    if filepath in journals:
+        with journals[filepath].lock:
+            stamp_message(filepath, message, key)
+            journals[filepath].append(store, message, key)
+    else:
+        with locks.stores(filepath):
+            stamp_message(filepath, message, key)
+            if key is None:
+                store.append(message)
+            else:
+                store.setdefault(key, []).append(message)
+            save_json(filepath, store, keys=[key if key is not None else len(store) - 1])
+    if filepath == LOUNGE_FILE:
+        publish_lounge_feed()
+    else:
+        notify_message(filepath, key)
+
+# ===============================================================
+# Message cursors
+# ===============================================================
+# Private chat and lounge messages carry 'seq' (send order, never reused) and
+# 'rev' (taken from the list's revision counter whenever the message is added
+# or edited). Pollers send the last revision they saw and get back only the
+# messages added or edited since, instead of the whole conversation.
+FEED_EDIT_LOG = 500
+
+class MessageFeed:
+    """Revision counter and recent-edit log for one message list"""
+
+    def __init__(self, msgs):
+        self.rev = max((max(msg.get('seq', 0), msg.get('rev', 0)) for msg in msgs), default=0)
+        if any('seq' not in msg or 'rev' not in msg for msg in msgs):
+            # Messages from before cursors existed (or added to the store by
+            # hand) are numbered after the highest ID in list order. Existing
+            # IDs stay put: reactions, reports and receipts are keyed by them
+            for msg in msgs:
+                if 'seq' not in msg:
+                    self.rev += 1
+                    msg['seq'] = self.rev
+                msg.setdefault('rev', msg['seq'])
+            # Unnumbered messages between numbered ones now sort last
+            msgs.sort(key=lambda msg: msg['seq'])
+        self.edits = []  # (rev, seq) of edits to earlier messages, oldest first
+        # Edits at or before this revision are no longer in the log, so older
+        # cursors (including any from before a restart) have to start over
+        self.horizon = self.rev
+
+    def added(self, msg):
+        self.rev += 1
+        msg['seq'] = msg['rev'] = self.rev
+
+    def edited(self, msg):
+        self.rev += 1
+        msg['rev'] = self.rev
+        self.log_edit(self.rev, msg['seq'])
+
+    def log_edit(self, rev, seq):
+        self.edits.append((rev, seq))
+        if len(self.edits) > FEED_EDIT_LOG:
+            self.horizon = self.edits.pop(0)[0]
+
+    def sync(self, msgs):
+        """Pick up messages another worker added or edited (shared mode)"""
+        known = self.rev
+        for rev, seq in sorted((msg['rev'], msg['seq']) for msg in msgs if msg.get('rev', 0) > known):
+            if seq <= known:
+                self.log_edit(rev, seq)
+            self.rev = max(self.rev, rev)
+
+    def changes(self, msgs, since):
+        """[(index, message)] added or edited after revision since, or None if the client must reload"""
+        if since < self.horizon or since > self.rev:
+            return None
+        start = len(msgs)
+        while start > 0 and msgs[start - 1]['seq'] > since:
+            start -= 1
+        changed = {i: msgs[i] for i in range(start, len(msgs))}
+        for rev, seq in reversed(self.edits):
+            if rev <= since:
+                break
+            i = message_position(msgs, seq)
+            if i is not None:
+                changed[i] = msgs[i]
+        return sorted(changed.items())
+
+# A message's seq doubles as its ID: routes that react to, open, report or
+# delete a message take the seq, so deletes never renumber anything. Lists
+# stay in seq order and a bisect finds the message. A delete leaves a
+# tombstone in place (pollers see it as one edit) and
+# periodic_drop_tombstones removes them from the lists later.
+TOMBSTONE_DROP_SECONDS = int(os.environ.get('STUDYHALL_TOMBSTONE_DROP_SECONDS', 600))
+
+def message_position(msgs, message_id):
+    """Index of the message with seq message_id in a seq-ordered list, or None"""
+    i = bisect.bisect_left(msgs, message_id, key=lambda msg: msg['seq'])
+    if i < len(msgs) and msgs[i]['seq'] == message_id:
+        return i
+    return None
+
+def live_position(msgs, message_id):
+    """Like message_position, but None for a deleted message too"""
+    i = message_position(msgs, message_id)
+    return None if i is None or msgs[i].get('deleted') else i
+
+def tombstone(msg):
+    """What's left of a deleted message until its tombstone is dropped"""
+    return {'seq': msg['seq'], 'rev': msg.get('rev'), 'from': msg.get('from'),
+            'timestamp': msg['timestamp'], 'deleted': True}
+
+def live_messages(msgs):
+    return [msg for msg in msgs if not msg.get('deleted')]
+
+def last_live_message(msgs):
+    for msg in reversed(msgs):
+        if not msg.get('deleted'):
+            return msg
+    return None
+
+def reactions_by_id(msgs, by_index):
+    """Re-key reactions saved by list index to message IDs"""
+    return {str(msgs[int(key)]['seq']): reactions for key, reactions in by_index.items()
+            if key.isdigit() and int(key) < len(msgs)}
+
+chat_feeds = {}
+
+def chat_feed(chat_key):
+    """MessageFeed for a private chat, created on first use"""
+    with locks.local(MESSAGES_FILE):
+        feed = chat_feeds.get(chat_key)
+        if feed is None:
+            chat = messages.setdefault(chat_key, [])
+            numbered = any('seq' not in msg for msg in chat)
+            feed = chat_feeds[chat_key] = MessageFeed(chat)
+            if numbered:
+                save_json(MESSAGES_FILE, messages, keys=[chat_key])
+        return feed
+
+group_feeds = {}
+
+def group_feed(group_id):
+    """MessageFeed for a group chat, created on first use"""
+    with locks.local(GROUP_MESSAGES_FILE):
+        feed = group_feeds.get(group_id)
+        if feed is None:
+            chat = group_messages.setdefault(group_id, [])
+            numbered = any('seq' not in msg for msg in chat)
+            feed = group_feeds[group_id] = MessageFeed(chat)
+            if numbered:
+                save_json(GROUP_MESSAGES_FILE, group_messages, keys=[group_id])
+        return feed
+
+def stamp_message(filepath, message, key):
+    """Bookkeeping done under the store lock as a message is appended (seq/rev, unread counts)"""
+    if filepath == MESSAGES_FILE:
+        chat_feed(key).added(message)
+        inbox_added(key, message)
+    elif filepath == LOUNGE_FILE:
+        lounge_changes.added(message)
+        lounge_own_added(message)
+    elif filepath == GROUP_MESSAGES_FILE:
+        group_feed(key).added(message)
+        group_index_added(key, message)
+
+# Read-only snapshot of the lounge for the poll endpoint. Writers rebuild it
+# under the lounge locks and swap the reference; readers never take a lock.
+# Message dicts are shared with the live list, so mutators replace a message
+# instead of editing it in place.
+lounge_feed = {'messages': [], 'reactions': {}}
+
+def publish_lounge_feed():
+    global lounge_feed
+    with locks.local(LOUNGE_FILE), locks.local(LOUNGE_REACTIONS_FILE):
+        lounge_feed = {
+            'messages': live_messages(lounge_messages),
+            'reactions': {key: {emoji: list(names) for emoji, names in reactions.items()}
+                          for key, reactions in lounge_reactions.items()}
+        }
+    event_bus.publish('lounge', {'cursor': lounge_changes.rev})
+
+# ===============================================================
+# Live events
+# ===============================================================
+# /api/events keeps one Server-Sent Events stream open per tab. Routes publish
+# small "something changed" events to the users concerned and the page then
+# fetches the delta it needs, so an idle tab is one quiet connection instead
+# of several polls a second. The bus is in-process: in shared mode other
+# workers' writes never reach it, so the stream is refused and pages keep
+# polling.
+EVENT_HEARTBEAT_SECONDS = 15
+EVENT_QUEUE_SIZE = 256
+
+class EventBus:
+    """Fan-out of events to the open streams of each user"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.streams = {}  # username -> set of Queues, one per open stream
+        self.sinks = []  # callables(frame, to) that fan out elsewhere (the gateway)
+
+    def subscribe(self, username):
+        stream = queue.Queue(EVENT_QUEUE_SIZE)
+        with self.lock:
+            self.streams.setdefault(username, set()).add(stream)
+        return stream
+
+    def unsubscribe(self, username, stream):
+        with self.lock:
+            streams = self.streams.get(username)
+            if streams:
+                streams.discard(stream)
+                if not streams:
+                    del self.streams[username]
+
+    def publish(self, event, data, to=None):
+        """Send to the given usernames, or to everyone connected if to is None"""
+        with self.lock:
+            if to is None:
+                targets = [s for streams in self.streams.values() for s in streams]
+            else:
+                targets = [s for username in set(to) for s in self.streams.get(username, ())]
+        if not targets and not self.sinks:
+            return
+        frame = f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        for sink in self.sinks:
+            sink(frame, to)
+        for stream in targets:
+            try:
+                stream.put_nowait(frame)
+            except queue.Full:
+                pass  # Reader has stopped draining; the heartbeat will notice it is gone
+
+event_bus = EventBus()
+
+def notify_message(filepath, key):
+    """Tell the people who can see a message list that it changed"""
+    if filepath == MESSAGES_FILE:
+        notify_chat(key)
+    elif filepath == GROUP_MESSAGES_FILE:
+        notify_group(key)
+
+def chat_participants(chat_key):
+    """The two usernames behind a get_chat_key() key (usernames may contain '-')"""
+    for i, ch in enumerate(chat_key):
+        if ch == '-' and chat_key[:i] in users and chat_key[i + 1:] in users:
+            return [chat_key[:i], chat_key[i + 1:]]
+    parts = chat_key.split('-')  # A deleted account's chats
+    return parts if len(parts) == 2 else []
+
+def notify_chat(chat_key):
+    participants = chat_participants(chat_key)
+    if participants:
+        event_bus.publish('chat', {'users': participants}, to=participants)
+
+def notify_rps(*players):
+    event_bus.publish('rps', {'users': list(players)}, to=players)
+
+def notify_group(group_id):
+    group_data = groups.get(group_id)
+    if group_data:
+        event_bus.publish('group', {'group_id': group_id},
+                          to=[group_data['leader']] + group_data.get('members', []))
+
+# ===============================================================
+# Event gateway
+# ===============================================================
+# Flask holds a thread for every open /api/events stream, which runs out long
+# before the number of open tabs does. With STUDYHALL_GATEWAY_PORT set, an
+# asyncio server on its own thread serves the same stream (proxy /api/events
+# to it, or point STUDYHALL_EVENTS_URL at it) and an idle tab costs one socket
+# and one small queue. Flask routes stay synchronous and publish to event_bus
+# as before; the bus hands each frame to the gateway loop with
+# call_soon_threadsafe, which is the queue between the two sides.
+GATEWAY_HOST = os.environ.get('STUDYHALL_GATEWAY_HOST', '127.0.0.1')
+GATEWAY_PORT = int(os.environ.get('STUDYHALL_GATEWAY_PORT', '0'))
+EVENTS_URL = os.environ.get('STUDYHALL_EVENTS_URL', '/api/events')
+# Page origins allowed to open the stream cross-origin (when EVENTS_URL is on
+# another port or host), comma-separated
+GATEWAY_ORIGINS = {o.strip() for o in os.environ.get('STUDYHALL_GATEWAY_ORIGINS', '').split(',') if o.strip()}
+GATEWAY_REQUEST_TIMEOUT = 10  # seconds to send the request head
+GATEWAY_READ_LIMIT = 16 * 1024  # request head cap; streams never read more
+
+class EventGateway:
+    """asyncio HTTP server for GET /api/events, fed from event_bus"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self.streams = {}  # username -> set of asyncio.Queues
+        self.ready = threading.Event()
+        self.serializer = app.session_interface.get_signing_serializer(app)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True, name='event-gateway').start()
+        self.ready.wait()
+        event_bus.sinks.append(self.deliver)
+        return self
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.serve())
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle, self.host, self.port,
+                                            limit=GATEWAY_READ_LIMIT, backlog=1024)
+        self.port = server.sockets[0].getsockname()[1]
+        self.ready.set()
+        async with server:
+            await server.serve_forever()
+
+    def deliver(self, frame, to):
+        """EventBus sink - called from Flask threads"""
+        self.loop.call_soon_threadsafe(self.fan_out, frame.encode('utf-8'), to)
+
+    def fan_out(self, frame, to):
+        if to is None:
+            targets = [q for queues in self.streams.values() for q in queues]
+        else:
+            targets = [q for username in set(to) for q in self.streams.get(username, ())]
+        for q in targets:
+            try:
+                q.put_nowait(frame)
+            except asyncio.QueueFull:
+                pass  # Stalled reader; the heartbeat write will drop it
+
+    def session_user(self, headers):
+        """Username from the Flask session cookie, or None"""
+        cookie_name = app.config.get('SESSION_COOKIE_NAME', 'session')
+        for part in headers.get('cookie', '').split(';'):
+            name, _, value = part.strip().partition('=')
+            if name == cookie_name:
+                try:
+                    # Expire cookies like Flask's own session interface does
+                    max_age = int(app.permanent_session_lifetime.total_seconds())
+                    username = self.serializer.loads(value, max_age=max_age).get('username')
+                except Exception:
+                    return None
+                user = users.get(username)
+                return username if user and not user.get('banned') else None
+        return None
+
+    async def handle(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), GATEWAY_REQUEST_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ConnectionError):
+            writer.close()
+            return
+        lines = head.decode('latin-1').split('\r\n')
+        method, path = (lines[0].split(' ') + ['', ''])[:2]
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        cors = ''
+        if headers.get('origin') in GATEWAY_ORIGINS:
+            cors = (f"Access-Control-Allow-Origin: {headers['origin']}\r\n"
+                    "Access-Control-Allow-Credentials: true\r\n")
+        if method != 'GET' or path.split('?')[0] != '/api/events':
+            writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+        else:
+            username = self.session_user(headers)
+            if username is None:
+                writer.write(('HTTP/1.1 401 Unauthorized\r\nContent-Length: 0\r\n'
+                              f'{cors}Connection: close\r\n\r\n').encode('latin-1'))
+            else:
+                writer.write(('HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n'
+                              f'Cache-Control: no-cache\r\n{cors}Connection: keep-alive\r\n\r\n'
+                              'retry: 3000\n\n').encode('latin-1'))
+                await self.stream(username, writer)
+        writer.close()
+
+    async def stream(self, username, writer):
+        q = asyncio.Queue(EVENT_QUEUE_SIZE)
+        self.streams.setdefault(username, set()).add(q)
+        try:
+            while True:
+                await writer.drain()
+                try:
+                    frame = await asyncio.wait_for(q.get(), EVENT_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    frame = b': ping\n\n'
+                writer.write(frame)
+        except ConnectionError:
+            pass
+        finally:
+            queues = self.streams.get(username)
+            if queues:
+                queues.discard(q)
+                if not queues:
+                    del self.streams[username]
+
+    def subscriber_count(self):
+        return sum(len(queues) for queues in self.streams.values())
+
+event_gateway = None
+app.jinja_env.globals['EVENTS_URL'] = EVENTS_URL
+
+# ===============================================================
+# Media blob store
+# ===============================================================
+# Snaps, voice notes, group images and profile pictures are stored once on
+# disk under their SHA-256 and the stores only keep a /media/<hash><ext> URL,
+# which works anywhere the old data: URI did (img src, new Audio(...)).
+BLOB_DIR = os.path.join(DATA_DIR, 'blobs')
+MEDIA_URL_PREFIX = '/media/'
+DATA_URI_RE = re.compile(r'data:([\w.+-]+/[\w.+-]+)(?:;[^,]*?)?;base64,(.*)', re.S)
+MEDIA_NAME_RE = re.compile(r'([0-9a-f]{64})(\.[0-9a-z]{1,8})?')
+MEDIA_EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/gif': '.gif',
+    'image/webp': '.webp',
+    'audio/webm': '.webm',
+    'audio/ogg': '.ogg',
+    'audio/mpeg': '.mp3',
+    'audio/mp4': '.m4a',
+    'audio/wav': '.wav',
+}
+# Served back with the type they were uploaded as (.webm here is always audio)
+MEDIA_MIMETYPES = {ext: mime for mime, ext in MEDIA_EXTENSIONS.items()}
+
+def blob_path(digest, ext=''):
+    return os.path.join(BLOB_DIR, digest[:2], digest + ext)
+
+def store_blob(payload, ext=''):
+    """Write payload once (deduplicated by content) and return its /media/ URL"""
+    digest = hashlib.sha256(payload).hexdigest()
+    path = blob_path(digest, ext)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    return MEDIA_URL_PREFIX + digest + ext
+
+def media_ref(value):
+    """Move a base64 data: URI into the blob store; other values pass through"""
+    if not isinstance(value, str) or not value.startswith('data:'):
+        return value
+    match = DATA_URI_RE.fullmatch(value)
+    if not match:
+        return value
+    mime = match.group(1).lower()
+    try:
+        payload = base64.b64decode(match.group(2))
+    except (binascii.Error, ValueError):
+        return value
+    ext = MEDIA_EXTENSIONS.get(mime) or mimetypes.guess_extension(mime) or ''
+    return store_blob(payload, ext)
+
+# ===============================================================
+# Game content store
+# ===============================================================
+# games.json only holds game metadata. Each game's HTML is a file under
+# GAME_CONTENT_DIR named by its SHA-256 ('html_file'), read when a page is
+# built, edited or downloaded, so listing or saving the catalog never touches
+# multi-MB game bodies.
+# Replaced or deleted games leave their file behind: games.json reaches disk
+# later (write-behind) and older snapshot generations may still name it.
+# collect_game_content removes files nothing references at startup.
+GAME_CONTENT_DIR = os.path.join(DATA_DIR, 'game_content')
+# Files younger than this are kept even when unreferenced - another worker may
+# have just written one and not saved games.json yet
+GAME_CONTENT_GRACE_SECONDS = int(os.environ.get('STUDYHALL_GAME_CONTENT_GRACE_SECONDS', 3600))
+
+def game_content_path(game):
+    return os.path.join(GAME_CONTENT_DIR, game['html_file'] + '.html')
+
+def store_game_html(game, html_content):
+    """Write html_content to the content store and point game's metadata at it"""
+    payload = html_content.encode('utf-8')
+    digest = hashlib.sha256(payload).hexdigest()
+    path = os.path.join(GAME_CONTENT_DIR, digest + '.html')
+    if os.path.exists(path):
+        # Reused content - restart its grace period so a collection can't race us
+        os.utime(path)
+    else:
+        os.makedirs(GAME_CONTENT_DIR, exist_ok=True)
+        tmp = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    game.pop('html_content', None)
+    game['html_file'] = digest
+    # Part of the game page cache key
+    game['html_version'] = digest[:16]
+    game['html_size'] = len(payload)
+    game['html_updated'] = time.time()
+
+def read_game_html(game):
+    with open(game_content_path(game), 'r', encoding='utf-8') as f:
+        return f.read()
+
+def collect_game_content():
+    """Delete content files no game references, in games.json or any older generation"""
+    if not os.path.isdir(GAME_CONTENT_DIR):
+        return
+    referenced = {game.get('html_file') for game in games.values()}
+    if isinstance(storage, JsonFileEngine):
+        for path in storage.generations(GAMES_FILE)[1:]:
+            for game in (storage.read_snapshot(path) or {}).values():
+                referenced.add(game.get('html_file'))
+    cutoff = time.time() - GAME_CONTENT_GRACE_SECONDS
+    for name in os.listdir(GAME_CONTENT_DIR):
+        path = os.path.join(GAME_CONTENT_DIR, name)
+        if not name.endswith('.html') or name[:-len('.html')] in referenced:
+            continue
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
 
 # ===============================================================
 # Core helpers and time utilities
@@ -223,14 +1627,10 @@ def get_chat_key(user1, user2):
     return '-'.join(sorted([user1, user2]))
 
 def load_coinflip_wins():
-    if os.path.exists(COINFLIP_WINS_FILE):
-        with open(COINFLIP_WINS_FILE, 'r') as f:
-            return json.load(f)
-    return []
+    return load_json(COINFLIP_WINS_FILE, [])
 
 def save_coinflip_wins(wins):
-    with open(COINFLIP_WINS_FILE, 'w') as f:
-        json.dump(wins, f, indent=4)
+    save_json(COINFLIP_WINS_FILE, wins)
 
 def has_permission(username, permission):
     """Check if user has a specific permission"""
@@ -246,10 +1646,214 @@ def get_user_role_info(username):
     user_role = users[username].get('role', 'user')
     return STAFF_ROLES.get(user_role, STAFF_ROLES['user'])
 
+# Total tokens in circulation, kept current by the balance helpers below
+# instead of summing every user per transaction. periodic_reconcile_circulation
+# checks it against a full sum and records any drift it had to correct.
+CIRCULATION_RECONCILE_SECONDS = int(os.environ.get('STUDYHALL_CIRCULATION_RECONCILE_SECONDS', 300))
+
+class CirculationCounter:
+    """Sum of users[...]['tokens'], updated per balance change"""
+
+    def __init__(self):
+        # Balance changes hold this while they write, so a reconcile sees
+        # every balance and its counted value agree
+        self.lock = threading.RLock()
+        self.total = 0
+        self.counted = {}  # username -> balance included in total
+        self.reconciliations = 0
+        self.last_drift = 0
+        self.total_drift = 0
+        self.reconciled_at = None
+
+    def track(self, *usernames):
+        """Fold the current balances of usernames (gone users count 0) into total"""
+        with self.lock:
+            for username in usernames:
+                balance = users[username].get('tokens', 0) if username in users else 0
+                self.total += balance - self.counted.pop(username, 0)
+                if username in users:
+                    self.counted[username] = balance
+
+    def reconcile(self):
+        """Recount from scratch. Returns the drift (full sum - running total)"""
+        with locks.local(USERS_FILE), self.lock:
+            counted = {username: user.get('tokens', 0) for username, user in users.items()}
+            drift = sum(counted.values()) - self.total
+            self.counted = counted
+            self.total += drift
+            if self.reconciled_at is not None:
+                self.reconciliations += 1
+                self.last_drift = drift
+                self.total_drift += abs(drift)
+                if drift:
+                    print(f"Token circulation drifted by {drift}, corrected to {self.total}")
+            self.reconciled_at = get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
+        return drift
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'total': self.total,
+                'reconciliations': self.reconciliations,
+                'last_drift': self.last_drift,
+                'total_drift': self.total_drift,
+                'reconciled_at': self.reconciled_at,
+            }
+
+circulation = CirculationCounter()
+
+# Token balances - every read-check-modify of users[...]['tokens'] goes through
+# these so concurrent requests for the same user can't lose updates
+def debit_tokens(username, amount):
+    """Take amount tokens from username. Returns False if the balance is too low"""
+    with locks.balances(username), circulation.lock:
+        balance = users[username].get('tokens', 0)
+        if balance < amount:
+            return False
+        users[username]['tokens'] = balance - amount
+        circulation.track(username)
+    save_json(USERS_FILE, users, keys=[username])
+    return True
+
+def credit_tokens(username, amount):
+    """Give amount tokens to username and return the new balance"""
+    with locks.balances(username), circulation.lock:
+        users[username]['tokens'] = users[username].get('tokens', 0) + amount
+        balance = users[username]['tokens']
+        circulation.track(username)
+    save_json(USERS_FILE, users, keys=[username])
+    return balance
+
+def transfer_tokens(sender, recipient, amount):
+    """Move amount tokens between users. Returns False if sender can't afford it"""
+    with locks.balances(sender, recipient), circulation.lock:
+        if users[sender].get('tokens', 0) < amount:
+            return False
+        users[sender]['tokens'] -= amount
+        users[recipient]['tokens'] = users[recipient].get('tokens', 0) + amount
+        circulation.track(sender, recipient)
+    save_json(USERS_FILE, users, keys=[sender, recipient])
+    return True
+
+def set_tokens(username, amount):
+    """Overwrite a balance (admin edit)"""
+    with locks.balances(username), circulation.lock:
+        users[username]['tokens'] = amount
+        circulation.track(username)
+    save_json(USERS_FILE, users, keys=[username])
+
+# ===============================================================
+# Bounded logs
+# ===============================================================
+# Action logs, token transactions and casino results only ever grow at the
+# new end and are capped. On disk each store is a dict of '<log>:<seq>' ->
+# entry; in memory every log is a deque, so recording an entry (and evicting
+# the oldest) is O(1) and writes one journal line, or two SQLite rows in
+# shared mode, instead of the whole list.
+ACTION_LOG_RETENTION = int(os.environ.get('STUDYHALL_ACTION_LOG_RETENTION', 1000))
+TRANSACTION_LOG_RETENTION = int(os.environ.get('STUDYHALL_TRANSACTION_LOG_RETENTION', 5000))
+CASINO_LOG_RETENTION = int(os.environ.get('STUDYHALL_CASINO_LOG_RETENTION', 1000))
+
+log_stores = {}  # filepath -> LogStore
+
+class RingLog:
+    """A capped log that iterates and indexes newest first, like the old lists"""
+
+    def __init__(self, filepath, retention):
+        # LogStore.add appends under this store's lock; readers copy under it
+        self.filepath = filepath
+        self.entries = deque(maxlen=retention)  # (store key, entry), oldest first
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        with locks.local(self.filepath):
+            entries = list(self.entries)
+        return (entry for key, entry in reversed(entries))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.start is None and index.step is None and index.stop is not None and index.stop >= 0:
+                with locks.local(self.filepath):
+                    return [entry for key, entry in islice(reversed(self.entries), index.stop)]
+            return list(self)[index]
+        with locks.local(self.filepath):
+            return self.entries[-1 - index][1]
+
+class LogStore:
+    """The RingLogs kept in one store, by name (e.g. one per casino game)"""
+
+    def __init__(self, filepath, retention, legacy_path, legacy_logs, ids=False):
+        self.filepath = filepath
+        self.retention = retention
+        # Number entries with their seq as 'id'
+        self.ids = ids
+        self.logs = {}
+        self.seq = 0
+        self.data = load_json(filepath, {})
+        log_stores[filepath] = self
+        if not self.data:
+            legacy = storage.load(legacy_path, None)
+            if legacy:
+                self.migrate(legacy_logs(legacy))
+        self.rebuild()
+
+    def migrate(self, legacy):
+        """Import {log name: newest-first list} from the old format"""
+        for name, entries in legacy.items():
+            for entry in reversed(entries):
+                self.seq += 1
+                self.data[self.key(name, self.seq)] = entry
+        save_json(self.filepath, self.data)
+
+    def key(self, name, seq):
+        return f'{name}:{seq:010d}'
+
+    def rebuild(self):
+        """Rebuild the deques from the store dict (load, or another worker wrote)"""
+        rows = sorted((int(key.rsplit(':', 1)[1]), key) for key in self.data)
+        # Clear rather than replace, module globals hold on to the RingLogs
+        for ring in self.logs.values():
+            ring.entries.clear()
+        for seq, key in rows:
+            ring = self.log(key.rsplit(':', 1)[0])
+            if len(ring) == ring.entries.maxlen:
+                self.data.pop(ring.entries[0][0], None)
+            ring.entries.append((key, self.data[key]))
+        self.seq = rows[-1][0] if rows else 0
+
+    def log(self, name):
+        if name not in self.logs:
+            self.logs[name] = RingLog(self.filepath, self.retention)
+        return self.logs[name]
+
+    def get(self, name, default=None):
+        return self.logs.get(name, default)
+
+    def add(self, name, entry):
+        """Append entry to the named log, evicting its oldest entry when full"""
+        with locks.stores(self.filepath):
+            self.seq += 1
+            key = self.key(name, self.seq)
+            if self.ids:
+                entry = {'id': self.seq, **entry}
+            ring = self.log(name)
+            evicted = ring.entries[0][0] if len(ring) == ring.entries.maxlen else None
+            if evicted is not None:
+                del self.data[evicted]
+            ring.entries.append((key, entry))
+            if self.filepath in journals:
+                # Evicted keys are dropped again when the journal is replayed
+                journals[self.filepath].append(self.data, entry, key)
+            else:
+                self.data[key] = entry
+                save_json(self.filepath, self.data, keys=[key] + ([evicted] if evicted else []))
+            return entry
+
 def log_action(actor, action_type, target=None, details=None, reason=None):
     """Log an action performed by staff"""
     log_entry = {
-        'id': len(action_logs) + 1,
         'actor': actor,
         'actor_role': users.get(actor, {}).get('role', 'unknown'),
         'action_type': action_type,
@@ -258,34 +1862,20 @@ def log_action(actor, action_type, target=None, details=None, reason=None):
         'reason': reason,
         'timestamp': get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
     }
-    action_logs.insert(0, log_entry)
-    # Keep only last 1000 logs
-    if len(action_logs) > 1000:
-        action_logs.pop()
-    save_json(ACTION_LOGS_FILE, action_logs)
-    return log_entry
+    return action_log_store.add('action', log_entry)
 
 def log_transaction(transaction_type, amount, user, source, details=None):
     """Log a token transaction"""
-    # Calculate new total tokens in circulation
-    total_tokens = sum(u.get('tokens', 0) for u in users.values())
-
     transaction = {
-        'id': len(token_transactions) + 1,
         'type': transaction_type,  # 'creation', 'destruction', 'transfer'
         'amount': amount,
         'user': user,
         'source': source,  # e.g., 'daily_reward', 'lottery_win', 'game_purchase', 'gift', 'code_redeem'
         'details': details,
-        'total_circulation': total_tokens,
+        'total_circulation': circulation.total,
         'timestamp': get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
     }
-    token_transactions.insert(0, transaction)
-    # Keep only last 5000 transactions
-    if len(token_transactions) > 5000:
-        token_transactions.pop()
-    save_json(TOKEN_TRANSACTIONS_FILE, token_transactions)
-    return transaction
+    return token_transaction_store.add('transaction', transaction)
 
 def log_casino_game(game_type, username, bet_amount, won, profit_loss, details=None):
     """Log a casino game result"""
@@ -297,21 +1887,11 @@ def log_casino_game(game_type, username, bet_amount, won, profit_loss, details=N
         'details': details,
         'timestamp': get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
     }
-
-    if game_type not in casino_stats:
-        casino_stats[game_type] = []
-
-    casino_stats[game_type].insert(0, entry)
-    # Keep only last 1000 per game type
-    if len(casino_stats[game_type]) > 1000:
-        casino_stats[game_type].pop()
-
-    save_json(CASINO_STATS_FILE, casino_stats)
-    return entry
+    return casino_stats.add(game_type, entry)
 
 def get_token_statistics():
     """Calculate comprehensive token statistics"""
-    total_tokens = sum(u.get('tokens', 0) for u in users.values())
+    total_tokens = circulation.total
 
     # Calculate tokens by source (last 30 days)
     thirty_days_ago = (get_ny_time() - timedelta(days=30)).strftime('%Y-%m-%d')
@@ -342,7 +1922,8 @@ def get_token_statistics():
         'created_by_source': created_by_source,
         'destroyed_by_source': destroyed_by_source,
         'daily_totals': daily_totals,
-        'total_transactions': len(token_transactions)
+        'total_transactions': len(token_transactions),
+        'circulation': circulation.metrics()
     }
 
 def get_casino_statistics():
@@ -395,6 +1976,18 @@ default_users = {
 default_games = {}
 
 # Load data from JSON files
+# Every *_FILE store defined so far (COINFLIP_WINS_FILE is read per request)
+load_started = time.perf_counter()
+preload_stores([path for name, path in list(globals().items())
+                if name.endswith('_FILE') and name != 'COINFLIP_WINS_FILE'
+                and isinstance(path, str) and path.endswith('.json')])
+
+migrations = load_json(MIGRATIONS_FILE, {})
+
+def mark_migrated(name):
+    migrations[name] = get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
+    save_json(MIGRATIONS_FILE, migrations, keys=[name])
+
 users = load_json(USERS_FILE, default_users)
 games = load_json(GAMES_FILE, default_games)
 announcements = load_json(ANNOUNCEMENTS_FILE, [])
@@ -403,8 +1996,19 @@ messages = load_json(MESSAGES_FILE, {})
 read_receipts = load_json(READ_RECEIPTS_FILE, {})
 user_activity = load_json(USER_ACTIVITY_FILE, {})
 lounge_messages = load_json(LOUNGE_FILE, [])
+lounge_numbered = any('seq' not in msg for msg in lounge_messages)
+lounge_changes = MessageFeed(lounge_messages)
+if lounge_numbered:
+    save_json(LOUNGE_FILE, lounge_messages)
 lounge_reactions = load_json(LOUNGE_REACTIONS_FILE, {})
+if 'lounge_reactions_by_id' not in migrations:
+    # Stores migrated before the marker existed are already keyed by id
+    if not lounge_reactions:
+        lounge_reactions = reactions_by_id(lounge_messages, storage.load(LEGACY_LOUNGE_REACTIONS, {}))
+        save_json(LOUNGE_REACTIONS_FILE, lounge_reactions)
+    mark_migrated('lounge_reactions_by_id')
 lounge_read_receipts = load_json(LOUNGE_READ_RECEIPTS_FILE, {})
+publish_lounge_feed()
 login_notifications = load_json(LOGIN_NOTIFICATIONS_FILE, {})
 maintenance_mode = load_json(MAINTENANCE_FILE, {
     'enabled': False,
@@ -423,6 +2027,7 @@ cookie_state = load_json(COOKIE_FILE, {
 profiles = load_json(PROFILES_FILE, {})
 
 rps_games = load_json(RPS_GAMES_FILE, {})
+tower_games = load_json(TOWER_GAMES_FILE, {})
 rps_history = load_json(RPS_HISTORY_FILE, [])
 
 user_ranks = load_json(RANKS_FILE, {})
@@ -431,6 +2036,7 @@ codes = load_json(CODES_FILE, {})
 redeemed_codes = load_json(REDEEMED_CODES_FILE, {})
 rank_pass_state = load_json(RANK_PASS_FILE, {})
 plays = load_json(PLAYS_FILE, {})
+play_buckets = load_json(PLAY_BUCKETS_FILE, {})
 
 lottery_state = load_json(LOTTERY_FILE, {
     'active': False,
@@ -452,44 +2058,75 @@ advent_calendar = load_json(ADVENT_CALENDAR_FILE, {})
 # Groups data
 groups = load_json(GROUPS_FILE, {})
 group_messages = load_json(GROUP_MESSAGES_FILE, {})
+for gid in list(group_messages):
+    group_feed(gid)
 group_reactions = load_json(GROUP_REACTIONS_FILE, {})
+if 'group_reactions_by_id' not in migrations:
+    if not group_reactions:
+        group_reactions = {group_id: reactions_by_id(group_messages.get(group_id, []), reactions)
+                           for group_id, reactions in storage.load(LEGACY_GROUP_REACTIONS, {}).items()}
+        save_json(GROUP_REACTIONS_FILE, group_reactions)
+    mark_migrated('group_reactions_by_id')
 group_read_receipts = load_json(GROUP_READ_RECEIPTS_FILE, {})
 
-action_logs = load_json(ACTION_LOGS_FILE, [])
-token_transactions = load_json(TOKEN_TRANSACTIONS_FILE, [])
+action_log_store = LogStore(ACTION_LOGS_FILE, ACTION_LOG_RETENTION, LEGACY_ACTION_LOGS,
+                            lambda legacy: {'action': legacy}, ids=True)
+action_logs = action_log_store.log('action')
+token_transaction_store = LogStore(TOKEN_TRANSACTIONS_FILE, TRANSACTION_LOG_RETENTION, LEGACY_TOKEN_TRANSACTIONS,
+                                   lambda legacy: {'transaction': legacy}, ids=True)
+token_transactions = token_transaction_store.log('transaction')
 reported_messages = load_json(REPORTED_MESSAGES_FILE, [])
+# Reports filed before message IDs point at a list index; re-key them to the
+# ID of the message at that index (None once it is gone)
+legacy_reports = [report for report in reported_messages if 'message_index' in report]
+for report in legacy_reports:
+    index = report.pop('message_index')
+    chat = messages.get(report.get('chat_key'), [])
+    if chat:
+        chat_feed(report['chat_key'])  # numbers a chat that has no IDs yet
+    report['message_id'] = chat[index]['seq'] if isinstance(index, int) and 0 <= index < len(chat) else None
+if legacy_reports:
+    save_json(REPORTED_MESSAGES_FILE, reported_messages)
 paychecks = load_json(PAYCHECKS_FILE, {
     'pending': [],
     'history': []
 })
-casino_stats = load_json(CASINO_STATS_FILE, {
-    'coinflip': [],
-    'tower': [],
-    'rps': []
-})
+casino_stats = LogStore(CASINO_STATS_FILE, CASINO_LOG_RETENTION, LEGACY_CASINO_STATS,
+                        lambda legacy: legacy)
 lottery_history = load_json(LOTTERY_HISTORY_FILE, [])
+report_load_timings(load_started)
 
 # ===============================================================
 # One-time data migration / normalization
 # ===============================================================
 # Migrate existing data
-for game_id in games:
-    if 'available' not in games[game_id]:
-        games[game_id]['available'] = True
-    if 'price' not in games[game_id]:
-        games[game_id]['price'] = 0
-    if 'free_for_all' not in games[game_id]:
-        games[game_id]['free_for_all'] = True
-    if 'is_own_game' not in games[game_id]:
-        games[game_id]['is_own_game'] = False
-    if 'is_roblox_game' not in games[game_id]:
-        games[game_id]['is_roblox_game'] = False
-    if 'is_pokemon_game' not in games[game_id]:  # ✅ ADD THIS
-        games[game_id]['is_pokemon_game'] = False  # ✅ ADD THIS
-    if 'is_minecraft_game' not in games[game_id]:
-        games[game_id]['is_minecraft_game'] = False
-    if 'background_image' not in games[game_id]:
-        games[game_id]['background_image'] = None
+GAME_DEFAULTS = {
+    'available': True,
+    'price': 0,
+    'free_for_all': True,
+    'is_own_game': False,
+    'is_roblox_game': False,
+    'is_pokemon_game': False,
+    'is_minecraft_game': False,
+    'background_image': None,
+}
+
+def migrate_games():
+    """Fill in metadata older games lack and move inline HTML to the content store"""
+    changed = []
+    for game_id, game in games.items():
+        missing = {key: value for key, value in GAME_DEFAULTS.items() if key not in game}
+        game.update(missing)
+        if 'html_content' in game:
+            store_game_html(game, game['html_content'])
+            changed.append(game_id)
+        elif missing:
+            changed.append(game_id)
+    if changed:
+        save_json(GAMES_FILE, games, keys=changed)
+
+migrate_games()
+collect_game_content()
 
 for username in users:
     if 'tokens' not in users[username]:
@@ -501,16 +2138,22 @@ for username in users:
         users[username]['password_changed'] = False
 
 save_json(USERS_FILE, users)
-save_json(GAMES_FILE, games)
+circulation.reconcile()
+
+# Typing status for chat - only stored when other workers need to see it
+typing_status = load_json(TYPING_STATUS_FILE, {}) if SHARED_STATE else {}
 
-# In-memory typing status for chat
-typing_status = {}
+@app.before_request
+def sync_shared_state():
+    if SHARED_STATE:
+        sync_stores()
 
 @app.before_request
 def track_user_activity():
     if 'username' in session:
         username = session['username']
-        user_activity[username] = get_ny_time().timestamp()
+        with locks.local(USER_ACTIVITY_FILE):
+            user_activity[username] = get_ny_time().timestamp()
 
 def periodic_save():
     while True:
@@ -530,6 +2173,108 @@ def periodic_rps_check():
 rps_check_thread = threading.Thread(target=periodic_rps_check, daemon=True)
 rps_check_thread.start()
 
+# Fold message journals into their snapshots
+def periodic_compact_journals():
+    while True:
+        # Wakes early when a journal grows past JOURNAL_COMPACT_BYTES, and
+        # then only folds the journals that did
+        early = journal_full.wait(JOURNAL_COMPACT_SECONDS)
+        journal_full.clear()
+        for journal in journals.values():
+            if early and journal.size < JOURNAL_COMPACT_BYTES:
+                continue
+            if journal.pending and journal.data is not None:
+                journal.compact(journal.data)
+
+compact_thread = threading.Thread(target=periodic_compact_journals, daemon=True)
+compact_thread.start()
+
+# Drop the tombstones deleted messages leave behind. The newest message stays
+# even when deleted: a feed restarts its counter from the highest seq in the
+# list, and IDs handed out again would pick up the old message's reactions,
+# reports and receipts.
+def has_droppable(msgs):
+    return any(msg.get('deleted') for msg in msgs[:-1])
+
+def without_tombstones(msgs):
+    return live_messages(msgs[:-1]) + msgs[-1:]
+
+def drop_tombstones():
+    with locks.stores(LOUNGE_FILE):
+        dropped = has_droppable(lounge_messages)
+        if dropped:
+            lounge_messages[:] = without_tombstones(lounge_messages)
+            # The edit log can't point at messages that are gone; cursors from
+            # before now reload instead of missing the deletes
+            lounge_changes.horizon = lounge_changes.rev
+            save_json(LOUNGE_FILE, lounge_messages)
+    if dropped:
+        rebuild_lounge_counters()
+    with locks.stores(GROUP_MESSAGES_FILE):
+        changed = [group_id for group_id, chat in group_messages.items()
+                   if has_droppable(chat)]
+        for group_id in changed:
+            group_messages[group_id][:] = without_tombstones(group_messages[group_id])
+            group_feed(group_id).horizon = group_feed(group_id).rev
+        if changed:
+            save_json(GROUP_MESSAGES_FILE, group_messages, keys=changed)
+
+def periodic_drop_tombstones():
+    while True:
+        time.sleep(TOMBSTONE_DROP_SECONDS)
+        drop_tombstones()
+
+tombstone_thread = threading.Thread(target=periodic_drop_tombstones, daemon=True)
+tombstone_thread.start()
+
+# Check the running token circulation against a full sum
+def periodic_reconcile_circulation():
+    while True:
+        time.sleep(CIRCULATION_RECONCILE_SECONDS)
+        circulation.reconcile()
+
+circulation_thread = threading.Thread(target=periodic_reconcile_circulation, daemon=True)
+circulation_thread.start()
+
+# Write-behind flush of dirty stores
+def periodic_flush():
+    while True:
+        time.sleep(max(FLUSH_INTERVAL_MS, 1) / 1000)
+        flush_stores()
+
+if FLUSH_INTERVAL_MS > 0:
+    persist_thread = threading.Thread(target=periodic_flush, daemon=True)
+    persist_thread.start()
+
+# Clean shutdown: nothing acknowledged may stay in memory only
+atexit.register(flush_stores)
+
+# Presence events for the live streams: who came online or dropped off
+ONLINE_THRESHOLD_SECONDS = 30
+PRESENCE_SWEEP_SECONDS = 5
+
+def periodic_presence():
+    online = set()
+    while True:
+        time.sleep(PRESENCE_SWEEP_SECONDS)
+        now = get_ny_time().timestamp()
+        current = {u for u, seen in list(user_activity.items()) if now - seen < ONLINE_THRESHOLD_SECONDS}
+        if current != online:
+            event_bus.publish('presence', {'online': sorted(current - online),
+                                           'offline': sorted(online - current)})
+            online = current
+
+if not SHARED_STATE:
+    presence_thread = threading.Thread(target=periodic_presence, daemon=True)
+    presence_thread.start()
+
+# The reloader parent of app.run(debug=True) never serves requests, so only
+# the process that does gets the gateway
+if GATEWAY_PORT and not SHARED_STATE and not (
+        __name__ == '__main__' and os.environ.get('WERKZEUG_RUN_MAIN') != 'true'):
+    event_gateway = EventGateway(GATEWAY_HOST, GATEWAY_PORT).start()
+    print(f"Event gateway listening on {GATEWAY_HOST}:{event_gateway.port}")
+
 # ===============================================================
 # Access control decorators
 # ===============================================================
@@ -621,11 +2366,133 @@ def permission_required(permission):
 
 
 # Helper functions
+# ===============================================================
+# Inbox index
+# ===============================================================
+# inboxes[username][other_user] describes one private chat as username sees
+# it: the last message (preview, timestamp, sender) and two unread counts -
+# 'unread', messages to username from anyone else (the chat list badges), and
+# 'unread_direct', only those from other_user (get_unread_count). Appending a
+# message updates both participants' entries and a read receipt rebuilds one
+# entry, so the chat list and unread badges cost O(my conversations) instead
+# of scanning every message on the site.
+inboxes = {}
+inbox_lock = threading.Lock()
+
+def message_preview(msg):
+    if msg.get('type') == 'snap':
+        return '📷 Snap'
+    if msg.get('type') == 'voice':
+        return '🎤 Voice message'
+    if msg.get('type') == 'token_gift':
+        return '🎁 Token gift'
+    text = msg.get('text', '')
+    return text[:50] + ('...' if len(text) > 50 else '')
+
+def inbox_entry(username, chat_key):
+    """One inbox entry built from the stores, or None if the chat is empty"""
+    chat = messages.get(chat_key)
+    participants = chat_participants(chat_key)
+    if not chat or username not in participants:
+        return None
+    other_user = participants[0] if participants[1] == username else participants[1]
+    last_read = read_receipts.get(username, {}).get(chat_key, '')
+    unread = unread_direct = 0
+    for msg in chat:
+        if msg.get('to') == username and msg.get('from') != username and msg['timestamp'] > last_read:
+            unread += 1
+            if msg.get('from') == other_user:
+                unread_direct += 1
+    last_msg = chat[-1]
+    return {'chat_key': chat_key, 'preview': message_preview(last_msg), 'timestamp': last_msg['timestamp'],
+            'from': last_msg['from'], 'unread': unread, 'unread_direct': unread_direct}
+
+def refresh_inbox(username, chat_key):
+    participants = chat_participants(chat_key)
+    if username not in participants:
+        return
+    other_user = participants[0] if participants[1] == username else participants[1]
+    with locks.local(MESSAGES_FILE), inbox_lock:
+        entry = inbox_entry(username, chat_key)
+        if entry:
+            inboxes.setdefault(username, {})[other_user] = entry
+        else:
+            inboxes.get(username, {}).pop(other_user, None)
+
+def inbox_added(chat_key, message):
+    """Update both participants' entries for a message being appended (called under the messages lock)"""
+    participants = chat_participants(chat_key)
+    if not participants:
+        return
+    with inbox_lock:
+        for username in participants:
+            other_user = participants[0] if participants[1] == username else participants[1]
+            entry = inboxes.setdefault(username, {}).setdefault(
+                other_user, {'chat_key': chat_key, 'unread': 0, 'unread_direct': 0})
+            entry.update(preview=message_preview(message), timestamp=message['timestamp'],
+                         **{'from': message['from']})
+            if (message.get('to') == username and message.get('from') != username and
+                    message['timestamp'] > read_receipts.get(username, {}).get(chat_key, '')):
+                entry['unread'] += 1
+                if message.get('from') == other_user:
+                    entry['unread_direct'] += 1
+
+def rebuild_inbox_index():
+    """Rebuild every inbox from the stores (startup, bulk receipt changes)"""
+    with locks.local(MESSAGES_FILE), inbox_lock:
+        inboxes.clear()
+        for chat_key in messages:
+            participants = chat_participants(chat_key)
+            for username in participants:
+                entry = inbox_entry(username, chat_key)
+                if entry:
+                    other_user = participants[0] if participants[1] == username else participants[1]
+                    inboxes.setdefault(username, {})[other_user] = entry
+
+def inbox(username):
+    """Copy of username's inbox entries, keyed by the other user"""
+    with inbox_lock:
+        return {other_user: dict(entry) for other_user, entry in inboxes.get(username, {}).items()}
+
+def set_read_receipt(username, chat_key, timestamp):
+    """Record how far username has read a chat; the caller saves READ_RECEIPTS_FILE"""
+    with locks.local(READ_RECEIPTS_FILE):
+        read_receipts.setdefault(username, {})[chat_key] = timestamp
+    refresh_inbox(username, chat_key)
+
+def inbox_last_message(entry, username):
+    """The last_message dict the chat list endpoints send, or None"""
+    if not entry:
+        return None
+    return {'preview': entry['preview'], 'timestamp': entry['timestamp'], 'from_me': entry['from'] == username}
+
+def last_seen(username, now):
+    """(is_online, 'Xm/h/d ago' text) from user_activity"""
+    if username not in user_activity:
+        return False, ''
+    time_diff = now - user_activity[username]
+    if time_diff < ONLINE_THRESHOLD_SECONDS:
+        return True, ''
+    hours_ago = int(time_diff / 3600)
+    if hours_ago < 1:
+        minutes_ago = int(time_diff / 60)
+        return False, f"{minutes_ago}m ago" if minutes_ago > 0 else "Just now"
+    if hours_ago < 24:
+        return False, f"{hours_ago}h ago"
+    return False, f"{int(hours_ago / 24)}d ago"
+
 def get_unread_count(username):
     """Count unread messages - messages TO you FROM others that you haven't read"""
+    with inbox_lock:
+        return sum(entry['unread_direct'] for entry in inboxes.get(username, {}).values())
+
+rebuild_inbox_index()
+
+def scan_unread_count(username):
+    """get_unread_count the slow way, by scanning every chat (verify-unread)"""
     unread = 0
     for chat_key, msgs in messages.items():
-        participants = chat_key.split('-')
+        participants = chat_participants(chat_key)
         if username not in participants:
             continue
 
@@ -643,30 +2510,281 @@ def get_unread_count(username):
 
     return unread
 
+# ===============================================================
+# Lounge unread counters
+# ===============================================================
+# Lounge read receipts hold the seq of the last message read, not a timestamp.
+# Messages stay in seq order, so "messages after my receipt" is a bisect on
+# the list, and lounge_own_seqs (each user's own message seqs, also sorted)
+# takes out the ones I sent, lounge_deleted_seqs the tombstones. Sends,
+# deletes and clears keep them exact.
+lounge_own_seqs = {}
+lounge_deleted_seqs = []
+lounge_own_lock = threading.Lock()
+
+def lounge_seq_key(msg):
+    return msg['seq']
+
+def lounge_own_added(message):
+    with lounge_own_lock:
+        lounge_own_seqs.setdefault(message.get('from'), []).append(message['seq'])
+
+def lounge_own_deleted(message):
+    """A message became a tombstone"""
+    with lounge_own_lock:
+        seqs = lounge_own_seqs.get(message.get('from'), [])
+        i = bisect.bisect_left(seqs, message['seq'])
+        if i < len(seqs) and seqs[i] == message['seq']:
+            seqs.pop(i)
+        bisect.insort(lounge_deleted_seqs, message['seq'])
+
+def rebuild_lounge_counters():
+    """Rebuild the counters from the lounge (startup, clears, tombstone drops, other workers)"""
+    with locks.local(LOUNGE_FILE), lounge_own_lock:
+        lounge_own_seqs.clear()
+        lounge_deleted_seqs.clear()
+        for msg in lounge_messages:
+            if msg.get('deleted'):
+                lounge_deleted_seqs.append(msg['seq'])
+            else:
+                lounge_own_seqs.setdefault(msg.get('from'), []).append(msg['seq'])
+
+def migrate_lounge_receipts():
+    """Turn timestamp receipts from older versions into seqs, once at startup"""
+    migrated = False
+    for username, last_read in list(lounge_read_receipts.items()):
+        if isinstance(last_read, str):
+            # The last message at or before that time; earlier ones were read
+            seq = 0
+            for msg in lounge_messages:
+                if msg['timestamp'] <= last_read:
+                    seq = msg['seq']
+            lounge_read_receipts[username] = seq
+            migrated = True
+        elif last_read > lounge_changes.rev:
+            # Numbering restarted after the lounge was emptied
+            lounge_read_receipts[username] = lounge_changes.rev
+            migrated = True
+    if migrated:
+        save_json(LOUNGE_READ_RECEIPTS_FILE, lounge_read_receipts)
+
+def set_lounge_read(username, seq):
+    """Record username has read the lounge up to seq and save the receipt"""
+    with locks.local(LOUNGE_READ_RECEIPTS_FILE):
+        lounge_read_receipts[username] = seq
+        save_json(LOUNGE_READ_RECEIPTS_FILE, lounge_read_receipts, keys=[username])
+
 def get_lounge_unread_count(username):
     """Count unread lounge messages - messages FROM others that you haven't read"""
-    if not lounge_messages:
-        return 0
+    last_read = lounge_read_receipts.get(username, 0)
+    with locks.local(LOUNGE_FILE):
+        after = len(lounge_messages) - bisect.bisect_right(lounge_messages, last_read, key=lounge_seq_key)
+    with lounge_own_lock:
+        own = lounge_own_seqs.get(username, [])
+        mine = len(own) - bisect.bisect_right(own, last_read)
+        deleted = len(lounge_deleted_seqs) - bisect.bisect_right(lounge_deleted_seqs, last_read)
+    return max(after - mine - deleted, 0)
+
+migrate_lounge_receipts()
+rebuild_lounge_counters()
 
-    last_read = lounge_read_receipts.get(username, '')
+# ===============================================================
+# Group index
+# ===============================================================
+# Lookups over the groups store so routes don't walk every group: each
+# group's member set (leader included), the groups each user is in, the
+# groups each user leads, and lowercase name -> group id. update() re-reads
+# one group after any route changes it; the routes call it through
+# reindex_group, which also fixes that group's unread counts.
+class GroupIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.members = {}  # group_id -> set of usernames
+        self.by_user = {}  # username -> set of group_ids
+        self.by_leader = {}  # username -> set of group_ids they lead
+        self.by_name = {}  # lowercase name -> group_id
+        self.entries = {}  # group_id -> (leader, lowercase name) as indexed
+
+    def update(self, group_id):
+        """Re-read one group from the store; returns its previous member set"""
+        with self.lock:
+            old_members = self.members.pop(group_id, set())
+            for username in old_members:
+                self.by_user.get(username, set()).discard(group_id)
+            if group_id in self.entries:
+                leader, name = self.entries.pop(group_id)
+                self.by_leader.get(leader, set()).discard(group_id)
+                if self.by_name.get(name) == group_id:
+                    del self.by_name[name]
+            group_data = groups.get(group_id)
+            if group_data:
+                members = set(group_member_list(group_data))
+                self.members[group_id] = members
+                for username in members:
+                    self.by_user.setdefault(username, set()).add(group_id)
+                name = group_data['name'].lower()
+                self.entries[group_id] = (group_data['leader'], name)
+                self.by_leader.setdefault(group_data['leader'], set()).add(group_id)
+                self.by_name[name] = group_id
+            return old_members
+
+    def is_member(self, username, group_id):
+        with self.lock:
+            return username in self.members.get(group_id, ())
+
+    def members_of(self, group_id):
+        with self.lock:
+            return set(self.members.get(group_id, ()))
+
+    def groups_of(self, username):
+        with self.lock:
+            return set(self.by_user.get(username, ()))
+
+    def leads_group(self, username):
+        with self.lock:
+            return bool(self.by_leader.get(username))
+
+    def name_taken(self, name, exclude=None):
+        """Whether another group already uses name (case-insensitive)"""
+        with self.lock:
+            group_id = self.by_name.get(name.lower())
+        return group_id is not None and group_id != exclude
+
+group_index = GroupIndex()
+
+def group_member_list(group_data):
+    return [group_data['leader']] + group_data.get('members', [])
 
-    # If never read lounge, count ALL messages from others
-    if not last_read:
-        return sum(1 for msg in lounge_messages if msg.get('from') != username)
+# ===============================================================
+# Group unread index
+# ===============================================================
+# group_unread[username][group_id] counts messages from other members after
+# username's receipt, and group_notices[username][group_id] is the newest of
+# those - one slot per group, so a busy group can't push a quieter one out
+# the way a ring of raw events would. A new message bumps the other members'
+# slots; a receipt recounts that group from the end back to the receipt,
+# which only touches unread messages.
+group_unread = {}
+group_notices = {}
+group_index_lock = threading.Lock()
+
+def group_notice(group_id, msg):
+    return {
+        'from': msg['from'],
+        'group_id': group_id,
+        'timestamp': msg['timestamp'],
+        'message_type': msg.get('type', 'message')
+    }
 
-    # Count messages from others that are newer than last_read
-    return sum(1 for msg in lounge_messages
-               if msg.get('from') != username and msg['timestamp'] > last_read)
+def refresh_group_unread(username, group_id):
+    """Recount one group for username from the store"""
+    with locks.local(GROUP_MESSAGES_FILE), group_index_lock:
+        if group_id not in groups:
+            # Deleted group - a late refresh must not put its count back
+            group_unread.get(username, {}).pop(group_id, None)
+            group_notices.get(username, {}).pop(group_id, None)
+            return
+        last_read = group_read_receipts.get(username, {}).get(group_id, '')
+        unread = 0
+        notice = None
+        for msg in reversed(group_messages.get(group_id, [])):
+            if msg['timestamp'] <= last_read:
+                break
+            if msg.get('from') != username and msg.get('from') != 'system' and not msg.get('deleted'):
+                unread += 1
+                if notice is None:
+                    notice = group_notice(group_id, msg)
+        group_unread.setdefault(username, {})[group_id] = unread
+        if notice:
+            group_notices.setdefault(username, {})[group_id] = notice
+        else:
+            group_notices.get(username, {}).pop(group_id, None)
+
+def group_index_added(group_id, message):
+    """Called from stamp_message as a group message is appended"""
+    sender = message.get('from')
+    if sender == 'system':
+        return
+    members = group_index.members_of(group_id)
+    with group_index_lock:
+        for member in members:
+            if (member != sender and
+                    message['timestamp'] > group_read_receipts.get(member, {}).get(group_id, '')):
+                counts = group_unread.setdefault(member, {})
+                counts[group_id] = counts.get(group_id, 0) + 1
+                group_notices.setdefault(member, {})[group_id] = group_notice(group_id, message)
+
+def reindex_group(group_id):
+    """Re-read one group's membership and unread counts after it changed"""
+    old_members = group_index.update(group_id)
+    members = group_index.members_of(group_id)
+    with group_index_lock:
+        for username in old_members - members:
+            group_unread.get(username, {}).pop(group_id, None)
+            group_notices.get(username, {}).pop(group_id, None)
+    for member in members:
+        refresh_group_unread(member, group_id)
+
+def rebuild_group_index():
+    for group_id in set(group_index.members) - set(groups):
+        reindex_group(group_id)
+    for group_id in list(groups):
+        reindex_group(group_id)
+
+def set_group_read(username, group_id, timestamp):
+    """Record how far username has read a group and save the receipt"""
+    with locks.local(GROUP_READ_RECEIPTS_FILE):
+        group_read_receipts.setdefault(username, {})[group_id] = timestamp
+        save_json(GROUP_READ_RECEIPTS_FILE, group_read_receipts, keys=[username])
+    refresh_group_unread(username, group_id)
+
+def remove_group(group_id):
+    """Delete a group with its messages, feed, reactions and read receipts.
+    The caller holds the group store locks"""
+    del groups[group_id]
+    group_messages.pop(group_id, None)
+    group_feeds.pop(group_id, None)
+    group_reactions.pop(group_id, None)
+    readers = [username for username, receipts in group_read_receipts.items() if group_id in receipts]
+    for username in readers:
+        del group_read_receipts[username][group_id]
+    save_json(GROUPS_FILE, groups, keys=[group_id])
+    save_json(GROUP_MESSAGES_FILE, group_messages, keys=[group_id])
+    save_json(GROUP_REACTIONS_FILE, group_reactions, keys=[group_id])
+    save_json(GROUP_READ_RECEIPTS_FILE, group_read_receipts, keys=readers)
+    reindex_group(group_id)
+
+rebuild_group_index()
+
+# (last_reset string, epoch seconds it expires at) - polls compare one string
+# and one float instead of parsing the timestamp on every hit
+cookie_deadline = (None, 0.0)
 
 def check_and_reset_cookie():
     """Reset cookie every 3 hours if needed"""
-    global cookie_state
-    now = get_ny_time()
+    last_reset, deadline = cookie_deadline
+    if (last_reset == cookie_state.get('last_reset') and cookie_state.get('fortune') is not None
+            and time.time() < deadline):
+        return
+    with locks.stores(COOKIE_FILE):
+        _check_and_reset_cookie()
+
+def cookie_stamp(state):
+    """Short token that changes whenever the cookie is reset or claimed"""
+    return f"{state.get('last_reset')}/{int(bool(state.get('claimed')))}"
+
+def cookie_reset_time(state):
+    """When the cookie was last reset (aware, New York time), or None if unreadable"""
     try:
-        last_reset = datetime.strptime(cookie_state['last_reset'], '%Y-%m-%d %H:%M:%S')
-        last_reset = pytz.timezone('America/New_York').localize(last_reset)
+        last_reset = datetime.strptime(state['last_reset'], '%Y-%m-%d %H:%M:%S')
+        return pytz.timezone('America/New_York').localize(last_reset)
     except:
-        last_reset = now - timedelta(hours=4)
+        return None
+
+def _check_and_reset_cookie():
+    global cookie_state, cookie_deadline
+    now = get_ny_time()
+    last_reset = cookie_reset_time(cookie_state) or now - timedelta(hours=4)
 
     time_diff = (now - last_reset).total_seconds() / 3600
     if time_diff >= 3:
@@ -684,6 +2802,10 @@ def check_and_reset_cookie():
         cookie_state['last_reset'] = now.strftime('%Y-%m-%d %H:%M:%S')
         save_json(COOKIE_FILE, cookie_state)
 
+    last_reset = cookie_reset_time(cookie_state)
+    if last_reset:
+        cookie_deadline = (cookie_state['last_reset'], last_reset.timestamp() + 3 * 3600)
+
 # Lunch menu data
 lunch_menu = {
     '2025-12-01': {'food': 'Rodeo Cheeseburger & Sweet Potato Fries', 'fact': 'Sweet potato fries became trendy in the 2000s as a "healthier" alternative - sweet potatoes have more fiber and vitamin A than regular potatoes!'},
@@ -737,15 +2859,18 @@ def login():
 
             # 🔹 NEW: Send login notification to admins/ambassadors
             login_time = get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
-            for admin_user in users:
-                if users[admin_user]['role'] in ['admin', 'ambassador']:
-                    if admin_user not in login_notifications:
-                        login_notifications[admin_user] = []
-                    login_notifications[admin_user].append({
-                        'username': actual_username,
-                        'timestamp': login_time
-                    })
-            save_json(LOGIN_NOTIFICATIONS_FILE, login_notifications)
+            with locks.stores(LOGIN_NOTIFICATIONS_FILE):
+                notified = []
+                for admin_user in users:
+                    if users[admin_user]['role'] in ['admin', 'ambassador']:
+                        if admin_user not in login_notifications:
+                            login_notifications[admin_user] = []
+                        login_notifications[admin_user].append({
+                            'username': actual_username,
+                            'timestamp': login_time
+                        })
+                        notified.append(admin_user)
+                save_json(LOGIN_NOTIFICATIONS_FILE, login_notifications, keys=notified)
 
             if users[actual_username]['role'] in ['admin', 'ambassador']:
                 return redirect(url_for('admin_panel'))
@@ -899,35 +3024,14 @@ def get_chat_notifications():
 def get_group_notifications():
     """Get recent unread group message notifications"""
     username = session['username']
-    notifications = []
-
-    for group_id, group_data in groups.items():
-        # Check if user is a member
-        if username != group_data['leader'] and username not in group_data.get('members', []):
-            continue
-
-        # Get last read timestamp for this group
-        last_read = group_read_receipts.get(username, {}).get(group_id, '')
-
-        # Get most recent unread message from others
-        if group_id in group_messages:
-            for msg in reversed(group_messages[group_id]):
-                if (msg.get('from') != username and
-                    msg.get('from') != 'system' and
-                    msg['timestamp'] > last_read):
-                    notifications.append({
-                        'from': msg['from'],
-                        'group_id': group_id,
-                        'group_name': group_data['name'],
-                        'timestamp': msg['timestamp'],
-                        'message_type': msg.get('type', 'message')
-                    })
-                    break  # Only get the most recent per group
+    with group_index_lock:
+        notifications = sorted(group_notices.get(username, {}).values(),
+                               key=lambda x: x['timestamp'], reverse=True)[:5]  # Limit to 5
+    # Names are looked up now so a rename shows up in pending notices
+    notifications = [dict(n, group_name=groups[n['group_id']]['name'])
+                     for n in notifications if n['group_id'] in groups]
 
-    # Sort by timestamp, most recent first
-    notifications.sort(key=lambda x: x['timestamp'], reverse=True)
-
-    return jsonify({'notifications': notifications[:5]})  # Limit to 5
+    return jsonify({'notifications': notifications})
 
 @app.route('/api/paycheck_notifications')
 @login_required
@@ -950,11 +3054,11 @@ def clear_paycheck_notification(index):
     """Clear a specific paycheck notification"""
     username = session['username']
 
-    if username in login_notifications:
-        user_notifs = login_notifications[username]
+    with locks.stores(LOGIN_NOTIFICATIONS_FILE):
+        user_notifs = login_notifications.get(username, [])
         if 0 <= index < len(user_notifs):
             user_notifs.pop(index)
-            save_json(LOGIN_NOTIFICATIONS_FILE, login_notifications)
+            save_json(LOGIN_NOTIFICATIONS_FILE, login_notifications, keys=[username])
             return jsonify({'success': True})
 
     return jsonify({'success': False, 'error': 'Notification not found'}), 404
@@ -988,6 +3092,21 @@ def casino():
         user_role=users[username]['role']
     )
 
+# Profile fields filled in from Instagram; cleared when the username goes
+INSTAGRAM_PROFILE_FIELDS = {
+    'instagram_username': None,
+    'profile_picture': None,
+    'instagram_followers': None,
+    'instagram_following': None,
+    'instagram_full_name': None
+}
+
+def set_profile_fields(username, **fields):
+    """Update and save username's profile under the store lock (network fetches happen before)"""
+    with locks.stores(PROFILES_FILE):
+        profiles.setdefault(username, {'setup_complete': False, 'bio': '', **INSTAGRAM_PROFILE_FIELDS}).update(fields)
+        save_json(PROFILES_FILE, profiles, keys=[username])
+
 @app.route('/profile', methods=['GET', 'POST'])
 @maintenance_check
 @login_required
@@ -996,16 +3115,9 @@ def profile():
     unread_count = get_unread_count(username)
     lounge_unread_count = get_lounge_unread_count(username)
 
-    if username not in profiles:
-        profiles[username] = {
-            'setup_complete': False,
-            'instagram_username': None,
-            'profile_picture': None,
-            'bio': '',
-            'instagram_followers': None,
-            'instagram_following': None,
-            'instagram_full_name': None
-        }
+    with locks.stores(PROFILES_FILE):
+        if username not in profiles:
+            profiles[username] = {'setup_complete': False, 'bio': '', **INSTAGRAM_PROFILE_FIELDS}
 
     profile_data = profiles[username]
 
@@ -1025,10 +3137,12 @@ def profile():
                     error="Insufficient tokens. You need 100 tokens to set up your profile."
                 )
 
-            users[username]['tokens'] -= 100
-            profiles[username]['setup_complete'] = True
-            save_json(USERS_FILE, users)
-            save_json(PROFILES_FILE, profiles)
+            with locks.balances(username):
+                if profiles[username]['setup_complete']:
+                    return redirect(url_for('profile'))
+                if not debit_tokens(username, 100):
+                    return redirect(url_for('profile'))
+                set_profile_fields(username, setup_complete=True)
 
             return redirect(url_for('profile'))
 
@@ -1037,7 +3151,7 @@ def profile():
             bio = request.form.get('bio', '').strip()
 
             # Update bio
-            profiles[username]['bio'] = bio
+            fields = {'bio': bio}
 
             # Fetch Instagram data if username provided
             if instagram_username:
@@ -1058,30 +3172,23 @@ def profile():
                     # Get profile picture URL and download it
                     profile_pic_url = profile.profile_pic_url
 
-                    # Download and convert to base64
-                    import base64
+                    # Download into the blob store
                     response = requests.get(profile_pic_url, timeout=15)
 
                     if response.status_code == 200:
-                        image_base64 = base64.b64encode(response.content).decode('utf-8')
-                        profile_pic_data_uri = f"data:image/jpeg;base64,{image_base64}"
+                        profile_picture = store_blob(response.content, '.jpg')
                     else:
-                        profile_pic_data_uri = None
+                        profile_picture = None
 
                     # Update profile with Instagram data
-                    profiles[username]['instagram_username'] = instagram_username
-                    profiles[username]['profile_picture'] = profile_pic_data_uri
-                    profiles[username]['instagram_followers'] = profile.followers
-                    profiles[username]['instagram_following'] = profile.followees
-                    profiles[username]['instagram_full_name'] = profile.full_name
+                    fields.update(instagram_username=instagram_username,
+                                  profile_picture=profile_picture,
+                                  instagram_followers=profile.followers,
+                                  instagram_following=profile.followees,
+                                  instagram_full_name=profile.full_name)
 
                 except instaloader.exceptions.ProfileNotExistsException:
-                    profiles[username]['instagram_username'] = instagram_username
-                    profiles[username]['profile_picture'] = None
-                    profiles[username]['instagram_followers'] = None
-                    profiles[username]['instagram_following'] = None
-                    profiles[username]['instagram_full_name'] = None
-                    save_json(PROFILES_FILE, profiles)
+                    set_profile_fields(username, **{**fields, **INSTAGRAM_PROFILE_FIELDS, 'instagram_username': instagram_username})
 
                     return render_template('profile.html',
                         profile=profiles[username],
@@ -1094,12 +3201,7 @@ def profile():
                     )
 
                 except Exception as e:
-                    profiles[username]['instagram_username'] = instagram_username
-                    profiles[username]['profile_picture'] = None
-                    profiles[username]['instagram_followers'] = None
-                    profiles[username]['instagram_following'] = None
-                    profiles[username]['instagram_full_name'] = None
-                    save_json(PROFILES_FILE, profiles)
+                    set_profile_fields(username, **{**fields, **INSTAGRAM_PROFILE_FIELDS, 'instagram_username': instagram_username})
 
                     return render_template('profile.html',
                         profile=profiles[username],
@@ -1112,13 +3214,9 @@ def profile():
                     )
             else:
                 # Clear Instagram data if no username provided
-                profiles[username]['instagram_username'] = None
-                profiles[username]['profile_picture'] = None
-                profiles[username]['instagram_followers'] = None
-                profiles[username]['instagram_following'] = None
-                profiles[username]['instagram_full_name'] = None
+                fields.update(INSTAGRAM_PROFILE_FIELDS)
 
-            save_json(PROFILES_FILE, profiles)
+            set_profile_fields(username, **fields)
 
             return render_template('profile.html',
                 profile=profiles[username],
@@ -1148,17 +3246,16 @@ def update_profile_instagram():
     instagram_username = request.form.get('instagram_username', '').strip()
     bio = request.form.get('bio', '').strip()
 
-    try:
-        # Update bio
-        profiles[username]['bio'] = bio
+    # Update bio
+    fields = {'bio': bio}
 
+    try:
         if instagram_username:
             # Validate username format
             if not re.match(r'^[a-zA-Z0-9._]+$', instagram_username):
                 return jsonify({'success': False, 'error': 'Invalid Instagram username format'})
 
             # Use Instaloader
-            import base64
             L = instaloader.Instaloader(
                 download_pictures=False,
                 save_metadata=False,
@@ -1172,45 +3269,30 @@ def update_profile_instagram():
             response = requests.get(profile_pic_url, timeout=15)
 
             if response.status_code == 200:
-                image_base64 = base64.b64encode(response.content).decode('utf-8')
-                profile_pic_data_uri = f"data:image/jpeg;base64,{image_base64}"
+                profile_picture = store_blob(response.content, '.jpg')
             else:
-                profile_pic_data_uri = None
+                profile_picture = None
 
             # Update profile with Instagram data
-            profiles[username]['instagram_username'] = instagram_username
-            profiles[username]['profile_picture'] = profile_pic_data_uri
-            profiles[username]['instagram_followers'] = profile.followers
-            profiles[username]['instagram_following'] = profile.followees
-            profiles[username]['instagram_full_name'] = profile.full_name
+            fields.update(instagram_username=instagram_username,
+                          profile_picture=profile_picture,
+                          instagram_followers=profile.followers,
+                          instagram_following=profile.followees,
+                          instagram_full_name=profile.full_name)
 
         else:
             # Clear Instagram data if no username provided
-            profiles[username]['instagram_username'] = None
-            profiles[username]['profile_picture'] = None
-            profiles[username]['instagram_followers'] = None
-            profiles[username]['instagram_following'] = None
-            profiles[username]['instagram_full_name'] = None
+            fields.update(INSTAGRAM_PROFILE_FIELDS)
 
-        save_json(PROFILES_FILE, profiles)
+        set_profile_fields(username, **fields)
         return jsonify({'success': True})
 
     except instaloader.exceptions.ProfileNotExistsException:
-        profiles[username]['instagram_username'] = instagram_username
-        profiles[username]['profile_picture'] = None
-        profiles[username]['instagram_followers'] = None
-        profiles[username]['instagram_following'] = None
-        profiles[username]['instagram_full_name'] = None
-        save_json(PROFILES_FILE, profiles)
+        set_profile_fields(username, **{**fields, **INSTAGRAM_PROFILE_FIELDS, 'instagram_username': instagram_username})
         return jsonify({'success': False, 'error': f"Instagram username '@{instagram_username}' not found."})
 
     except Exception as e:
-        profiles[username]['instagram_username'] = instagram_username
-        profiles[username]['profile_picture'] = None
-        profiles[username]['instagram_followers'] = None
-        profiles[username]['instagram_following'] = None
-        profiles[username]['instagram_full_name'] = None
-        save_json(PROFILES_FILE, profiles)
+        set_profile_fields(username, **{**fields, **INSTAGRAM_PROFILE_FIELDS, 'instagram_username': instagram_username})
         return jsonify({'success': False, 'error': f"Failed to fetch Instagram data: {str(e)}"})
 
 
@@ -1234,16 +3316,13 @@ def view_profile(username):
     user_tokens = users[username].get('tokens', 0)
 
     # Get user's most played games
-    user_plays = plays.get(username, {})
     most_played = []
-    if user_plays:
-        sorted_plays = sorted(user_plays.items(), key=lambda x: x[1], reverse=True)[:5]
-        for game_id, play_count in sorted_plays:
-            if game_id in games:
-                most_played.append({
-                    'name': games[game_id]['name'],
-                    'plays': play_count
-                })
+    for game_id, play_count in top_plays.get(username, []):
+        if game_id in games:
+            most_played.append({
+                'name': games[game_id]['name'],
+                'plays': play_count
+            })
 
     return render_template('view_profile.html',
         profile=profile_data,
@@ -1301,9 +3380,8 @@ def coinflip():
     if chosen_side not in ['heads', 'tails']:
         return jsonify({'error': 'Invalid side choice'}), 400
 
-    # Check if user has enough tokens
-    user_tokens = users[username].get('tokens', 0)
-    if user_tokens < bet_amount:
+    # Take the stake up front so two concurrent flips can't both spend it
+    if not debit_tokens(username, bet_amount):
         return jsonify({'error': 'Insufficient tokens'}), 400
 
     # Flip the coin (50/50 chance)
@@ -1312,8 +3390,7 @@ def coinflip():
 
     # Update balance
     if won:
-        users[username]['tokens'] += bet_amount
-        new_balance = users[username]['tokens']
+        new_balance = credit_tokens(username, bet_amount * 2)
 
         # Record win in top wins if it's big enough
         wins = load_coinflip_wins()
@@ -1332,12 +3409,10 @@ def coinflip():
 
         save_coinflip_wins(wins)
     else:
-        users[username]['tokens'] -= bet_amount
-        new_balance = users[username]['tokens']
+        new_balance = users[username].get('tokens', 0)
 
     log_casino_game('coinflip', username, bet_amount, won, bet_amount if won else -bet_amount)
     log_transaction('creation' if won else 'destruction', bet_amount, username, 'casino_coinflip')
-    save_json(USERS_FILE, users)
 
     return jsonify({
         'success': True,
@@ -1361,49 +3436,25 @@ def coinflip_top_wins():
 def chat():
     current_user = session['username']
     user_list = [u for u in users.keys() if u != current_user]
+    my_inbox = inbox(current_user)
     user_unread = {}
     user_last_message = {}
     for other_user in user_list:
-        chat_key = get_chat_key(current_user, other_user)
-        if chat_key in messages:
-            unread = 0
-            last_read = read_receipts.get(current_user, {}).get(chat_key, '')
-            for msg in messages[chat_key]:
-                # Only count messages TO you FROM the other person
-                if (msg.get('to') == current_user and
-                    msg.get('from') != current_user and
-                    msg['timestamp'] > last_read):
-                    unread += 1
-            user_unread[other_user] = unread
-            if messages[chat_key]:
-                last_msg = messages[chat_key][-1]
-                if last_msg.get('type') == 'snap':
-                    preview = '📷 Snap'
-                elif last_msg.get('type') == 'voice':
-                    preview = '🎤 Voice message'
-                elif last_msg.get('type') == 'token_gift':
-                    preview = '🎁 Token gift'
-                else:
-                    preview = last_msg.get('text', '')[:50] + ('...' if len(last_msg.get('text', '')) > 50 else '')
-                user_last_message[other_user] = {
-                    'preview': preview,
-                    'timestamp': last_msg['timestamp'],
-                    'from_me': last_msg['from'] == current_user
-                }
-        else:
-            user_unread[other_user] = 0
-            user_last_message[other_user] = None
+        entry = my_inbox.get(other_user)
+        user_unread[other_user] = entry['unread'] if entry else 0
+        user_last_message[other_user] = inbox_last_message(entry, current_user)
 
     # Get groups data for the Groups tab
+    my_group_ids = group_index.groups_of(current_user)
     groups_data = []
     for group_id, group_data in groups.items():
-        is_member = current_user == group_data['leader'] or current_user in group_data.get('members', [])
+        is_member = group_id in my_group_ids
         unread = get_group_unread_count(current_user, group_id) if is_member else 0
 
         # Get last message preview
         last_message = None
-        if group_id in group_messages and group_messages[group_id]:
-            last_msg = group_messages[group_id][-1]
+        last_msg = last_live_message(group_messages.get(group_id, []))
+        if last_msg:
             if last_msg.get('type') == 'snap':
                 preview = '📷 Snap'
             elif last_msg.get('type') == 'voice':
@@ -1432,7 +3483,7 @@ def chat():
     groups_data.sort(key=lambda x: x['last_message']['timestamp'] if x['last_message'] else '', reverse=True)
 
     # Check if user already has a group they lead
-    user_has_group = any(g['leader'] == current_user for g in groups.values())
+    user_has_group = group_index.leads_group(current_user)
 
     return render_template('chat_list.html',
         users=user_list,
@@ -1451,12 +3502,13 @@ def chat_conversation(other_user):
         return redirect(url_for('chat'))
     current_user = session['username']
     chat_key = get_chat_key(current_user, other_user)
-    if chat_key not in messages:
-        messages[chat_key] = []
+    # Read before rendering: anything newer is re-sent and the page skips it
+    chat_cursor = chat_feed(chat_key).rev
 
     return render_template('chat_conversation.html',
         other_user=other_user,
         messages=messages[chat_key],
+        chat_cursor=chat_cursor,
         current_user=current_user,
         read_receipts=read_receipts,
         users=users,
@@ -1474,35 +3526,26 @@ def send_message(other_user):
 
     if message_text:
         chat_key = get_chat_key(current_user, other_user)
-        if chat_key not in messages:
-            messages[chat_key] = []
 
         new_timestamp = get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
 
-        messages[chat_key].append({
+        append_message(MESSAGES_FILE, messages, {
             'from': current_user,
             'to': other_user,
             'text': message_text,
             'timestamp': new_timestamp,
             'read': False
-        })
-        save_json(MESSAGES_FILE, messages)
+        }, key=chat_key)
 
         # ✅ CRITICAL FIX: Mark as read for BOTH sender and receiver to prevent false unreads
-        if current_user not in read_receipts:
-            read_receipts[current_user] = {}
-        if other_user not in read_receipts:
-            read_receipts[other_user] = {}
-
         # Mark as read for sender (you)
-        read_receipts[current_user][chat_key] = new_timestamp
+        set_read_receipt(current_user, chat_key, new_timestamp)
 
         # DO NOT mark as read for receiver - let them mark it themselves
         # But ensure they have an entry (can be empty or old timestamp)
-        if chat_key not in read_receipts[other_user]:
-            read_receipts[other_user][chat_key] = ""
-
-        save_json(READ_RECEIPTS_FILE, read_receipts)
+        with locks.local(READ_RECEIPTS_FILE):
+            read_receipts.setdefault(other_user, {}).setdefault(chat_key, "")
+            save_json(READ_RECEIPTS_FILE, read_receipts, keys=[current_user, other_user])
 
         return jsonify({'success': True})
 
@@ -1513,9 +3556,20 @@ def get_messages(other_user):
         return jsonify({'error': 'User not found'}), 404
     current_user = session['username']
     chat_key = get_chat_key(current_user, other_user)
-    if chat_key not in messages:
-        messages[chat_key] = []
-    return jsonify({'messages': messages[chat_key]})
+    feed = chat_feed(chat_key)
+    since = request.args.get('since', type=int)
+    if since is None:
+        return jsonify({'messages': messages[chat_key], 'cursor': feed.rev})
+
+    with locks.local(MESSAGES_FILE):
+        cursor = feed.rev
+        changes = feed.changes(messages[chat_key], since)
+    if changes is None:
+        return jsonify({'reset': True, 'cursor': cursor})
+    return jsonify({
+        'cursor': cursor,
+        'changes': [{'index': index, 'message': msg} for index, msg in changes]
+    })
 
 @app.route('/chat/<other_user>/read_status')
 @login_required
@@ -1536,6 +3590,9 @@ def send_typing(other_user):
         'user': current_user,
         'timestamp': datetime.now().timestamp()
     }
+    if SHARED_STATE:
+        save_json(TYPING_STATUS_FILE, typing_status, keys=[chat_key])
+    event_bus.publish('typing', {'from': current_user}, to=[other_user])
     return jsonify({'success': True})
 
 @app.route('/chat/<other_user>/is_typing')
@@ -1562,15 +3619,13 @@ def mark_read(other_user):
     last_message = messages[chat_key][-1]
     new_timestamp = last_message['timestamp']
 
-    if current_user not in read_receipts:
-        read_receipts[current_user] = {}
-
     # ✅ CRITICAL: Only update if the new timestamp is NEWER than existing
-    existing_timestamp = read_receipts[current_user].get(chat_key, '')
+    existing_timestamp = read_receipts.get(current_user, {}).get(chat_key, '')
 
     if new_timestamp > existing_timestamp or not existing_timestamp:
-        read_receipts[current_user][chat_key] = new_timestamp
-        save_json(READ_RECEIPTS_FILE, read_receipts)
+        set_read_receipt(current_user, chat_key, new_timestamp)
+        save_json(READ_RECEIPTS_FILE, read_receipts, keys=[current_user])
+        event_bus.publish('read', {'by': current_user}, to=[other_user])
 
     return jsonify({'success': True})
 
@@ -1585,27 +3640,22 @@ def send_snap(other_user):
 
     if photo_data:
         chat_key = get_chat_key(current_user, other_user)
-        if chat_key not in messages:
-            messages[chat_key] = []
 
         new_timestamp = get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
 
-        messages[chat_key].append({
+        append_message(MESSAGES_FILE, messages, {
             'from': current_user,
             'to': other_user,
             'type': 'snap',
-            'photo': photo_data,
+            'photo': media_ref(photo_data),
             'opened': False,
             'timestamp': new_timestamp,
             'read': False
-        })
-        save_json(MESSAGES_FILE, messages)
+        }, key=chat_key)
 
         # ✅ Mark as read for yourself after sending
-        if current_user not in read_receipts:
-            read_receipts[current_user] = {}
-        read_receipts[current_user][chat_key] = new_timestamp
-        save_json(READ_RECEIPTS_FILE, read_receipts)
+        set_read_receipt(current_user, chat_key, new_timestamp)
+        save_json(READ_RECEIPTS_FILE, read_receipts, keys=[current_user])
 
         return jsonify({'success': True})
 
@@ -1621,42 +3671,40 @@ def send_voice(other_user):
 
     if audio_data:
         chat_key = get_chat_key(current_user, other_user)
-        if chat_key not in messages:
-            messages[chat_key] = []
 
         new_timestamp = get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
 
-        messages[chat_key].append({
+        append_message(MESSAGES_FILE, messages, {
             'from': current_user,
             'to': other_user,
             'type': 'voice',
-            'audio': audio_data,
+            'audio': media_ref(audio_data),
             'duration': duration,
             'timestamp': new_timestamp,
             'read': False
-        })
-        save_json(MESSAGES_FILE, messages)
+        }, key=chat_key)
 
         # ✅ Mark as read for yourself after sending
-        if current_user not in read_receipts:
-            read_receipts[current_user] = {}
-        read_receipts[current_user][chat_key] = new_timestamp
-        save_json(READ_RECEIPTS_FILE, read_receipts)
+        set_read_receipt(current_user, chat_key, new_timestamp)
+        save_json(READ_RECEIPTS_FILE, read_receipts, keys=[current_user])
 
         return jsonify({'success': True})
 
-@app.route('/chat/<other_user>/open_snap/<int:message_index>', methods=['POST'])
+@app.route('/chat/<other_user>/open_snap/<int:message_id>', methods=['POST'])
 @login_required
-def open_snap(other_user, message_index):
+def open_snap(other_user, message_id):
     current_user = session['username']
     chat_key = get_chat_key(current_user, other_user)
-    if chat_key in messages and message_index < len(messages[chat_key]):
-        msg = messages[chat_key][message_index]
-        if msg.get('type') == 'snap' and msg.get('to') == current_user:
-            msg['opened'] = True
-            save_json(MESSAGES_FILE, messages)
-            return jsonify({'success': True, 'photo': msg['photo']})
-    return jsonify({'error': 'Snap not found'}), 404
+    with locks.stores(MESSAGES_FILE):
+        position = message_position(messages.get(chat_key, []), message_id)
+        msg = messages[chat_key][position] if position is not None else None
+        if msg is None or msg.get('type') != 'snap' or msg.get('to') != current_user:
+            return jsonify({'error': 'Snap not found'}), 404
+        msg['opened'] = True
+        chat_feed(chat_key).edited(msg)
+        save_json(MESSAGES_FILE, messages, keys=[chat_key])
+    notify_chat(chat_key)
+    return jsonify({'success': True, 'photo': msg['photo']})
 
 @app.route('/chat/<other_user>/send_tokens', methods=['POST'])
 @login_required
@@ -1671,30 +3719,24 @@ def send_tokens(other_user):
     if not amount or amount <= 0:
         return jsonify({'error': 'Invalid amount'}), 400
 
-    if users[current_user].get('tokens', 0) < amount:
+    if not transfer_tokens(current_user, other_user, amount):
         return jsonify({'error': 'Insufficient balance'}), 400
 
-    users[current_user]['tokens'] -= amount
-    users[other_user]['tokens'] = users[other_user].get('tokens', 0) + amount
-    save_json(USERS_FILE, users)
     log_transaction('transfer', amount, current_user, 'gift_sent', f'To: {other_user}')
     log_transaction('transfer', amount, other_user, 'gift_received', f'From: {current_user}')
 
     chat_key = get_chat_key(current_user, other_user)
-    if chat_key not in messages:
-        messages[chat_key] = []
 
     new_timestamp = get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
 
-    messages[chat_key].append({
+    append_message(MESSAGES_FILE, messages, {
         'from': 'system',
         'to': other_user,
         'type': 'token_gift',
         'text': f'{current_user} sent {amount} tokens to {other_user}!️',
         'timestamp': new_timestamp,
         'read': False
-    })
-    save_json(MESSAGES_FILE, messages)
+    }, key=chat_key)
 
 
     return jsonify({'success': True, 'new_balance': users[current_user]['tokens']})
@@ -1705,12 +3747,36 @@ def get_user_balance():
     username = session['username']
     return jsonify({'balance': users[username].get('tokens', 0)})
 
+@app.route('/api/events')
+@login_required
+def event_stream():
+    """Server-Sent Events stream of live events for the logged-in user"""
+    if SHARED_STATE:
+        return '', 204  # 204 tells EventSource not to reconnect; pages keep polling
+    username = session['username']
+
+    def generate():
+        stream = event_bus.subscribe(username)
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                try:
+                    yield stream.get(timeout=EVENT_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ': ping\n\n'  # also how a closed connection gets noticed
+        finally:
+            event_bus.unsubscribe(username, stream)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/heartbeat', methods=['POST'])
 @login_required
 def heartbeat():
     username = session['username']
-    user_activity[username] = get_ny_time().timestamp()
-    save_json(USER_ACTIVITY_FILE, user_activity)
+    with locks.local(USER_ACTIVITY_FILE):
+        user_activity[username] = get_ny_time().timestamp()
+        save_json(USER_ACTIVITY_FILE, user_activity, keys=[username])
     return jsonify({'success': True})
 
 @app.route('/api/online_users')
@@ -1744,7 +3810,7 @@ def get_online_users():
 def get_users_with_ranks():
     current_user = session['username']
     current_time = get_ny_time().timestamp()
-    online_threshold = 30
+    my_inbox = inbox(current_user)
     users_by_rank = {}
 
     for username in users.keys():
@@ -1755,51 +3821,8 @@ def get_users_with_ranks():
         if rank_id not in users_by_rank:
             users_by_rank[rank_id] = []
 
-        is_online = False
-        last_seen_text = ''
-        if username in user_activity:
-            time_diff = current_time - user_activity[username]
-            if time_diff < online_threshold:
-                is_online = True
-            else:
-                hours_ago = int(time_diff / 3600)
-                if hours_ago < 1:
-                    minutes_ago = int(time_diff / 60)
-                    last_seen_text = f"{minutes_ago}m ago" if minutes_ago > 0 else "Just now"
-                elif hours_ago < 24:
-                    last_seen_text = f"{hours_ago}h ago"
-                else:
-                    days_ago = int(hours_ago / 24)
-                    last_seen_text = f"{days_ago}d ago"
-
-        chat_key = get_chat_key(current_user, username)
-        unread = 0
-        last_message = None
-        last_message_timestamp = None
-
-        if chat_key in messages and messages[chat_key]:
-            last_read = read_receipts.get(current_user, {}).get(chat_key, '')
-            for msg in messages[chat_key]:
-                if msg['to'] == current_user and msg['timestamp'] > last_read:
-                    unread += 1
-
-            last_msg = messages[chat_key][-1]
-            last_message_timestamp = last_msg['timestamp']
-
-            if last_msg.get('type') == 'snap':
-                preview = '📷 Snap'
-            elif last_msg.get('type') == 'voice':
-                preview = '🎤 Voice message'
-            elif last_msg.get('type') == 'token_gift':
-                preview = '🎁 Token gift'
-            else:
-                preview = last_msg.get('text', '')[:50] + ('...' if len(last_msg.get('text', '')) > 50 else '')
-
-            last_message = {
-                'preview': preview,
-                'timestamp': last_msg['timestamp'],
-                'from_me': last_msg['from'] == current_user
-            }
+        is_online, last_seen_text = last_seen(username, current_time)
+        entry = my_inbox.get(username)
 
         # Get Instagram full name if profile exists
         instagram_name = None
@@ -1814,69 +3837,34 @@ def get_users_with_ranks():
             'profile_picture': profile_picture,
             'is_online': is_online,
             'last_seen': last_seen_text,
-            'unread': unread,
-            'last_message': last_message,
-            'last_message_timestamp': last_message_timestamp
+            'unread': entry['unread'] if entry else 0,
+            'last_message': inbox_last_message(entry, current_user),
+            'last_message_timestamp': entry['timestamp'] if entry else None
         })
 
+    # Most recent conversation first within each rank
+    for rank_users in users_by_rank.values():
+        rank_users.sort(key=lambda u: u['last_message_timestamp'] or '', reverse=True)
+
     return jsonify({'users_by_rank': users_by_rank})
 
 @app.route('/api/chat_list_data')
 @login_required
 def get_chat_list_data():
+    """My conversations, most recent first"""
     current_user = session['username']
     current_time = get_ny_time().timestamp()
-    online_threshold = 30
-    user_list = [u for u in users.keys() if u != current_user]
     chat_data = []
-    for other_user in user_list:
-        chat_key = get_chat_key(current_user, other_user)
-        is_online = False
-        last_seen_text = ''
-        if other_user in user_activity:
-            time_diff = current_time - user_activity[other_user]
-            if time_diff < online_threshold:
-                is_online = True
-            else:
-                hours_ago = int(time_diff / 3600)
-                if hours_ago < 1:
-                    minutes_ago = int(time_diff / 60)
-                    last_seen_text = f"{minutes_ago}m ago" if minutes_ago > 0 else "Just now"
-                elif hours_ago < 24:
-                    last_seen_text = f"{hours_ago}h ago"
-                else:
-                    days_ago = int(hours_ago / 24)
-                    last_seen_text = f"{days_ago}d ago"
-        unread = 0
-        last_message = None
-        if chat_key in messages and messages[chat_key]:
-            last_read = read_receipts.get(current_user, {}).get(chat_key, '')
-            for msg in messages[chat_key]:
-                if msg['to'] == current_user and msg['timestamp'] > last_read:
-                    unread += 1
-
-            last_msg = messages[chat_key][-1]
-            if last_msg.get('type') == 'snap':
-                preview = '📷 Snap'
-            elif last_msg.get('type') == 'voice':
-                preview = '🎤 Voice message'
-            elif last_msg.get('type') == 'token_gift':
-                preview = '🎁 Token gift'
-            else:
-                preview = last_msg.get('text', '')[:50] + ('...' if len(last_msg.get('text', '')) > 50 else '')
-
-            last_message = {
-                'preview': preview,
-                'timestamp': last_msg['timestamp'],
-                'from_me': last_msg['from'] == current_user
-            }
+    for other_user, entry in inbox(current_user).items():
+        is_online, last_seen_text = last_seen(other_user, current_time)
         chat_data.append({
             'username': other_user,
             'is_online': is_online,
             'last_seen': last_seen_text,
-            'unread': unread,
-            'last_message': last_message
+            'unread': entry['unread'],
+            'last_message': inbox_last_message(entry, current_user)
         })
+    chat_data.sort(key=lambda chat: chat['last_message']['timestamp'], reverse=True)
     return jsonify({'chats': chat_data})
 
 @app.route('/lounge')
@@ -1889,23 +3877,17 @@ def lounge():
 
     # ✅ MARK AS READ IMMEDIATELY ON PAGE LOAD (server-side)
     if lounge_messages:
-        # Get last message from others
-        last_msg_from_others = None
-        for msg in reversed(lounge_messages):
-            if msg.get('from') != username:
-                last_msg_from_others = msg
-                break
-
-        if last_msg_from_others:
-            lounge_read_receipts[username] = last_msg_from_others['timestamp']
-            save_json(LOUNGE_READ_RECEIPTS_FILE, lounge_read_receipts)
+        set_lounge_read(username, lounge_messages[-1]['seq'])
 
+    lounge_cursor = lounge_changes.rev
     return render_template('lounge.html',
-        messages=lounge_messages,
+        messages=lounge_feed['messages'],
         cookie_state=cookie_state,
         current_user=username,
         user_role=users[username]['role'],
-        reactions=lounge_reactions
+        reactions=lounge_reactions,
+        lounge_cursor=lounge_cursor,
+        cookie_stamp=cookie_stamp(cookie_state)
     )
 
 @app.route('/lounge/mark_read', methods=['POST'])
@@ -1913,12 +3895,10 @@ def lounge():
 def mark_lounge_read():
     username = session['username']
 
-    # ✅ Mark ALL messages as read - use the VERY LAST message timestamp
+    # ✅ Mark ALL messages as read - up to the VERY LAST message
     if lounge_messages:
-        # Get the absolute last message (regardless of who sent it)
-        last_message = lounge_messages[-1]
-        lounge_read_receipts[username] = last_message['timestamp']
-        save_json(LOUNGE_READ_RECEIPTS_FILE, lounge_read_receipts)
+        # The absolute last message (regardless of who sent it)
+        set_lounge_read(username, lounge_messages[-1]['seq'])
 
     return jsonify({'success': True})
 
@@ -1931,16 +3911,15 @@ def send_lounge_message():
     if message_text:
         new_timestamp = get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
 
-        lounge_messages.append({
+        message = {
             'from': current_user,
             'text': message_text,
             'timestamp': new_timestamp
-        })
-        save_json(LOUNGE_FILE, lounge_messages)
+        }
+        append_message(LOUNGE_FILE, lounge_messages, message)
 
         # ✅ CRITICAL: Mark lounge as read for yourself after sending
-        lounge_read_receipts[current_user] = new_timestamp
-        save_json(LOUNGE_READ_RECEIPTS_FILE, lounge_read_receipts)
+        set_lounge_read(current_user, message['seq'])
 
         return jsonify({'success': True})
 
@@ -1953,79 +3932,115 @@ def get_lounge_messages():
 
     # ✅ DO NOT mark as read when polling - only when user explicitly marks
 
-    return jsonify({
-        'messages': lounge_messages,
-        'cookie_state': cookie_state,
-        'reactions': lounge_reactions,
-        'user_role': users[session['username']]['role']
-    })
+    since = request.args.get('since', type=int)
+    if since is None:
+        feed = lounge_feed
+        return jsonify({
+            'messages': feed['messages'],
+            'cookie_state': cookie_state,
+            'reactions': feed['reactions'],
+            'user_role': users[session['username']]['role'],
+            'cursor': lounge_changes.rev
+        })
+
+    # Delta poll: ?since=<cursor>&cookie=<cookie_stamp the page has>. The
+    # common case - nothing new - answers without touching the message list.
+    stamp = cookie_stamp(cookie_state)
+    cookie = {'state': cookie_state, 'stamp': stamp} if request.args.get('cookie') != stamp else None
+    if since == lounge_changes.rev:
+        response = {'cursor': since, 'count': len(lounge_feed['messages'])}
+        if cookie:
+            response['cookie'] = cookie
+        return jsonify(response)
+    with locks.local(LOUNGE_FILE):
+        cursor = lounge_changes.rev
+        changes = lounge_changes.changes(lounge_messages, since)
+    if changes is None:
+        return jsonify({'reset': True, 'cursor': cursor})
+    # Deleted messages come back as tombstones ('deleted': True)
+    reactions = lounge_feed['reactions']
+    response = {
+        'cursor': cursor,
+        'count': len(lounge_feed['messages']),
+        'changes': [{'id': msg['seq'], 'message': msg, 'reactions': reactions.get(str(msg['seq']), {})}
+                    for _, msg in changes]
+    }
+    if cookie:
+        response['cookie'] = cookie
+    return jsonify(response)
 
 @app.route('/lounge/claim_cookie', methods=['POST'])
 @login_required
 def claim_cookie():
     global cookie_state
-    check_and_reset_cookie()
-    if cookie_state['claimed']:
-        return jsonify({'error': 'Cookie already claimed'}), 400
     username = session['username']
-    cookie_state['claimed'] = True
-    cookie_state['claimed_by'] = username
-    cookie_state['claimed_at'] = get_ny_time().strftime('%I:%M %p')
-    cookie_state['last_reset'] = get_ny_time().strftime('%Y-%m-%d %H:%M:%S')  # ✅ ADD THIS LINE
-    users[username]['tokens'] = users[username].get('tokens', 0) + 5  # ✅ FIXED TO 5
-    save_json(COOKIE_FILE, cookie_state)
-    save_json(USERS_FILE, users)
+    # Check-and-claim under the cookie lock so only one request can win it
+    with locks.stores(COOKIE_FILE):
+        check_and_reset_cookie()
+        if cookie_state['claimed']:
+            return jsonify({'error': 'Cookie already claimed'}), 400
+        cookie_state['claimed'] = True
+        cookie_state['claimed_by'] = username
+        cookie_state['claimed_at'] = get_ny_time().strftime('%I:%M %p')
+        cookie_state['last_reset'] = get_ny_time().strftime('%Y-%m-%d %H:%M:%S')  # ✅ ADD THIS LINE
+        save_json(COOKIE_FILE, cookie_state)
+    new_balance = credit_tokens(username, 5)  # ✅ FIXED TO 5
     log_transaction('creation', 5, username, 'fortune_cookie')
-    lounge_messages.append({
+    append_message(LOUNGE_FILE, lounge_messages, {
         'from': 'system',
         'text': f'🥠 {username} claimed the fortune cookie! "{cookie_state["fortune"]}"',
         'timestamp': get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
     })
-    save_json(LOUNGE_FILE, lounge_messages)
     return jsonify({
         'success': True,
         'fortune': cookie_state['fortune'],
-        'new_balance': users[username]['tokens']
+        'new_balance': new_balance
     })
 
-@app.route('/lounge/react/<int:message_index>', methods=['POST'])
+@app.route('/lounge/react/<int:message_id>', methods=['POST'])
 @login_required
-def react_to_lounge_message(message_index):
+def react_to_lounge_message(message_id):
     emoji = request.json.get('emoji')
     username = session['username']
-    if message_index >= len(lounge_messages):
-        return jsonify({'error': 'Message not found'}), 404
-    msg_key = str(message_index)
-    if msg_key not in lounge_reactions:
-        lounge_reactions[msg_key] = {}
-    if emoji not in lounge_reactions[msg_key]:
-        lounge_reactions[msg_key][emoji] = []
-    if username in lounge_reactions[msg_key][emoji]:
-        lounge_reactions[msg_key][emoji].remove(username)
-        if not lounge_reactions[msg_key][emoji]:
-            del lounge_reactions[msg_key][emoji]
-    else:
-        lounge_reactions[msg_key][emoji].append(username)
-    save_json(LOUNGE_REACTIONS_FILE, lounge_reactions)
-    return jsonify({'success': True, 'reactions': lounge_reactions.get(msg_key, {})})
-
-@app.route('/lounge/delete/<int:message_index>', methods=['POST'])
+    with locks.stores(LOUNGE_FILE, LOUNGE_REACTIONS_FILE):
+        position = live_position(lounge_messages, message_id)
+        if position is None:
+            return jsonify({'error': 'Message not found'}), 404
+        msg_key = str(message_id)
+        if msg_key not in lounge_reactions:
+            lounge_reactions[msg_key] = {}
+        if emoji not in lounge_reactions[msg_key]:
+            lounge_reactions[msg_key][emoji] = []
+        if username in lounge_reactions[msg_key][emoji]:
+            lounge_reactions[msg_key][emoji].remove(username)
+            if not lounge_reactions[msg_key][emoji]:
+                del lounge_reactions[msg_key][emoji]
+        else:
+            lounge_reactions[msg_key][emoji].append(username)
+        save_json(LOUNGE_REACTIONS_FILE, lounge_reactions, keys=[msg_key])
+        # New rev on the message so delta pollers pick up its reactions
+        msg = dict(lounge_messages[position])
+        lounge_changes.edited(msg)
+        lounge_messages[position] = msg
+        save_json(LOUNGE_FILE, lounge_messages, keys=[position])
+        publish_lounge_feed()
+    return jsonify({'success': True, 'reactions': lounge_feed['reactions'].get(msg_key, {})})
+
+@app.route('/lounge/delete/<int:message_id>', methods=['POST'])
 @panel_access_required
-def delete_lounge_message(message_index):
-    if message_index >= len(lounge_messages):
-        return jsonify({'error': 'Message not found'}), 404
-    lounge_messages.pop(message_index)
-    save_json(LOUNGE_FILE, lounge_messages)
-    global lounge_reactions
-    new_reactions = {}
-    for key, reactions in lounge_reactions.items():
-        idx = int(key)
-        if idx < message_index:
-            new_reactions[key] = reactions
-        elif idx > message_index:
-            new_reactions[str(idx - 1)] = reactions
-    lounge_reactions = new_reactions
-    save_json(LOUNGE_REACTIONS_FILE, lounge_reactions)
+def delete_lounge_message(message_id):
+    with locks.stores(LOUNGE_FILE, LOUNGE_REACTIONS_FILE):
+        position = live_position(lounge_messages, message_id)
+        if position is None:
+            return jsonify({'error': 'Message not found'}), 404
+        msg = tombstone(lounge_messages[position])
+        lounge_changes.edited(msg)
+        lounge_own_deleted(msg)
+        lounge_messages[position] = msg
+        save_json(LOUNGE_FILE, lounge_messages, keys=[position])
+        if lounge_reactions.pop(str(message_id), None) is not None:
+            save_json(LOUNGE_REACTIONS_FILE, lounge_reactions, keys=[str(message_id)])
+        publish_lounge_feed()
     return jsonify({'success': True})
 
 @app.route('/lounge/send_snap', methods=['POST'])
@@ -2037,18 +4052,17 @@ def send_lounge_snap():
     if photo_data:
         new_timestamp = get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
 
-        lounge_messages.append({
+        message = {
             'from': current_user,
             'type': 'snap',
-            'photo': photo_data,
+            'photo': media_ref(photo_data),
             'opened_by': [],
             'timestamp': new_timestamp
-        })
-        save_json(LOUNGE_FILE, lounge_messages)
+        }
+        append_message(LOUNGE_FILE, lounge_messages, message)
 
         # ✅ CRITICAL: Mark lounge as read for yourself after sending snap
-        lounge_read_receipts[current_user] = new_timestamp
-        save_json(LOUNGE_READ_RECEIPTS_FILE, lounge_read_receipts)
+        set_lounge_read(current_user, message['seq'])
 
         return jsonify({'success': True})
 
@@ -2064,38 +4078,41 @@ def send_lounge_voice():
     if audio_data:
         new_timestamp = get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
 
-        lounge_messages.append({
+        message = {
             'from': current_user,
             'type': 'voice',
-            'audio': audio_data,
+            'audio': media_ref(audio_data),
             'duration': duration,
             'timestamp': new_timestamp
-        })
-        save_json(LOUNGE_FILE, lounge_messages)
+        }
+        append_message(LOUNGE_FILE, lounge_messages, message)
 
         # Mark lounge as read for yourself after sending voice
-        lounge_read_receipts[current_user] = new_timestamp
-        save_json(LOUNGE_READ_RECEIPTS_FILE, lounge_read_receipts)
+        set_lounge_read(current_user, message['seq'])
 
         return jsonify({'success': True})
 
     return jsonify({'error': 'No audio provided'}), 400
 
-@app.route('/lounge/open_snap/<int:message_index>', methods=['POST'])
+@app.route('/lounge/open_snap/<int:message_id>', methods=['POST'])
 @login_required
-def open_lounge_snap(message_index):
+def open_lounge_snap(message_id):
     username = session['username']
-    if message_index >= len(lounge_messages):
-        return jsonify({'error': 'Snap not found'}), 404
-    msg = lounge_messages[message_index]
-    if msg.get('type') != 'snap':
-        return jsonify({'error': 'Not a snap'}), 400
-    if username in msg.get('opened_by', []):
-        return jsonify({'error': 'Already opened'}), 400
-    if 'opened_by' not in msg:
-        msg['opened_by'] = []
-    msg['opened_by'].append(username)
-    save_json(LOUNGE_FILE, lounge_messages)
+    with locks.stores(LOUNGE_FILE, LOUNGE_REACTIONS_FILE):
+        position = live_position(lounge_messages, message_id)
+        if position is None:
+            return jsonify({'error': 'Snap not found'}), 404
+        msg = lounge_messages[position]
+        if msg.get('type') != 'snap':
+            return jsonify({'error': 'Not a snap'}), 400
+        if username in msg.get('opened_by', []):
+            return jsonify({'error': 'Already opened'}), 400
+        # Copy-on-write: the published feed still references the old dict
+        msg = dict(msg, opened_by=msg.get('opened_by', []) + [username])
+        lounge_changes.edited(msg)
+        lounge_messages[position] = msg
+        save_json(LOUNGE_FILE, lounge_messages, keys=[position])
+        publish_lounge_feed()
     return jsonify({
         'success': True,
         'photo': msg['photo'],
@@ -2106,8 +4123,9 @@ def open_lounge_snap(message_index):
 @panel_access_required
 def clear_login_notifications():
     username = session['username']
-    login_notifications[username] = []  # Clear the list instead of deleting the key
-    save_json(LOGIN_NOTIFICATIONS_FILE, login_notifications)
+    with locks.stores(LOGIN_NOTIFICATIONS_FILE):
+        login_notifications[username] = []  # Clear the list instead of deleting the key
+        save_json(LOGIN_NOTIFICATIONS_FILE, login_notifications, keys=[username])
     return jsonify({'success': True})
 
 @app.route('/proxy')
@@ -2165,10 +4183,16 @@ def reddit():
         )
     return render_template('twitch.html')
 
-# Serve UV config
-@app.route('/uv.config.js')
-def serve_config():
-    config = """
+# ===============================================================
+# Ultraviolet scripts
+# ===============================================================
+# Browsers re-check service worker scripts often, so the UV endpoints are
+# served from memory: each script is read and compressed once, carries a
+# strong ETag (conditional requests get a 304), and file-backed ones are
+# reloaded when the file's mtime or size changes.
+UV_SERVICE_DIR = os.path.join(app.root_path, 'static', 'service')
+
+UV_CONFIG_JS = """
 self.__uv$config = {
     prefix: '/service/',
     bare: 'https://uv.holy.how/bare/',
@@ -2186,12 +4210,9 @@ self.__uv$bareOptions = {
     type: 'fetch'
 };
 """
-    return Response(config, mimetype='application/javascript')
 
-# Serve WRAPPER service worker that imports everything
-@app.route('/uv.sw.js')
-def serve_sw():
-    wrapper = """// Import Ultraviolet bundle first
+# WRAPPER service worker that imports everything
+UV_SW_JS = """// Import Ultraviolet bundle first
 importScripts('/static/uv/uv.bundle.js');
 importScripts('/uv.config.js');
 
@@ -2239,43 +4260,85 @@ self.addEventListener('fetch', (event) => {
     }
 });
 """
-    response = Response(wrapper, mimetype='application/javascript')
+
+class ScriptCache:
+    """Precompressed JavaScript responses by name"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sources = {}  # name -> script text, or a file path for files
+        self.entries = {}  # name -> (file stamp, etag, {encoding: body})
+
+    def add_text(self, name, text):
+        self.sources[name] = text
+
+    def add_file(self, name, path):
+        self.sources[name] = ('file', path)
+
+    def get(self, name):
+        source = self.sources[name]
+        stamp = None
+        if isinstance(source, tuple):
+            stat = os.stat(source[1])
+            stamp = (stat.st_mtime_ns, stat.st_size)
+        entry = self.entries.get(name)
+        if entry is None or entry[0] != stamp:
+            if stamp is None:
+                payload = source.encode('utf-8')
+            else:
+                with open(source[1], 'rb') as f:
+                    payload = f.read()
+            bodies = {'identity': payload}
+            for encoding, compress in static_compressors():
+                bodies[encoding] = compress(payload)
+            entry = (stamp, hashlib.sha256(payload).hexdigest()[:16], bodies)
+            with self.lock:
+                self.entries[name] = entry
+        return entry
+
+    def response(self, name):
+        try:
+            stamp, etag, bodies = self.get(name)
+        except OSError as e:
+            return str(e), 500
+        encoding = next((e for e in ('br', 'gzip') if e in bodies and request.accept_encodings[e]), 'identity')
+        response = Response(bodies[encoding], mimetype='application/javascript')
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = 'no-cache'
+        response.set_etag(f'{etag}.{encoding}')
+        return response.make_conditional(request)
+
+uv_scripts = ScriptCache()
+uv_scripts.add_text('uv.config.js', UV_CONFIG_JS)
+uv_scripts.add_text('uv.sw.js', UV_SW_JS)
+# The ACTUAL service worker code
+uv_scripts.add_file('uv.sw-core.js', os.path.join(UV_SERVICE_DIR, 'uv.sw.js'))
+uv_scripts.add_file('uv.handler.js', os.path.join(UV_SERVICE_DIR, 'uv.handler.js'))
+uv_scripts.add_file('uv.client.js', os.path.join(UV_SERVICE_DIR, 'uv.client.js'))
+
+@app.route('/uv.config.js')
+def serve_config():
+    return uv_scripts.response('uv.config.js')
+
+@app.route('/uv.sw.js')
+def serve_sw():
+    response = uv_scripts.response('uv.sw.js')
     response.headers['Service-Worker-Allowed'] = '/'
     return response
 
-# Serve the ACTUAL service worker code
 @app.route('/uv.sw-core.js')
 def serve_sw_core():
-    try:
-        file_path = os.path.join(app.root_path, 'static', 'service', 'uv.sw.js')
-        with open(file_path, 'r') as f:
-            content = f.read()
-        return Response(content, mimetype='application/javascript')
-    except Exception as e:
-        return str(e), 500
+    return uv_scripts.response('uv.sw-core.js')
 
-# Serve other UV files
 @app.route('/uv.handler.js')
 def serve_handler():
-    try:
-        return send_from_directory(
-            os.path.join(app.root_path, 'static', 'service'),
-            'uv.handler.js',
-            mimetype='application/javascript'
-        )
-    except Exception as e:
-        return str(e), 500
+    return uv_scripts.response('uv.handler.js')
 
 @app.route('/uv.client.js')
 def serve_client():
-    try:
-        return send_from_directory(
-            os.path.join(app.root_path, 'static', 'service'),
-            'uv.client.js',
-            mimetype='application/javascript'
-        )
-    except Exception as e:
-        return str(e), 500
+    return uv_scripts.response('uv.client.js')
 
 @app.route('/lounge/clear_history', methods=['POST'])
 @login_required
@@ -2287,25 +4350,27 @@ def clear_lounge_history():
         return jsonify({'success': False, 'error': 'Admin only'}), 403
 
     try:
-        global lounge_messages, lounge_reactions, lounge_read_receipts
-
-        # Clear all lounge data
-        lounge_messages.clear()
-        lounge_reactions.clear()
-        lounge_read_receipts.clear()
-
-        # Save empty data
-        save_json(LOUNGE_FILE, [])
-        save_json(LOUNGE_REACTIONS_FILE, {})
-        save_json(LOUNGE_READ_RECEIPTS_FILE, {})
+        with locks.stores(LOUNGE_FILE, LOUNGE_REACTIONS_FILE, LOUNGE_READ_RECEIPTS_FILE):
+            # Clear all lounge data
+            lounge_messages.clear()
+            lounge_reactions.clear()
+            lounge_read_receipts.clear()
+
+            # Save the emptied stores
+            save_json(LOUNGE_REACTIONS_FILE, lounge_reactions)
+            save_json(LOUNGE_READ_RECEIPTS_FILE, lounge_read_receipts)
 
-        # Add system message that history was cleared
-        lounge_messages.append({
-            'from': 'system',
-            'text': f'🗑️ Lounge history was cleared by {session["username"]}',
-            'timestamp': get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
-        })
-        save_json(LOUNGE_FILE, lounge_messages)
+            # Add system message that history was cleared
+            cleared_msg = {
+                'from': 'system',
+                'text': f'🗑️ Lounge history was cleared by {session["username"]}',
+                'timestamp': get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
+            }
+            lounge_changes.added(cleared_msg)
+            lounge_messages.append(cleared_msg)
+            save_json(LOUNGE_FILE, lounge_messages)
+            rebuild_lounge_counters()
+            publish_lounge_feed()
 
         return jsonify({'success': True, 'message': 'Lounge history cleared'})
 
@@ -2320,20 +4385,22 @@ def mark_all_as_read():
     try:
         current_time = get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
 
-        # ✅ Mark all private chats as read for ALL users
-        for chat_key in messages.keys():
-            participants = chat_key.split('-')
-            for user in participants:
-                if user not in read_receipts:
-                    read_receipts[user] = {}
-                read_receipts[user][chat_key] = current_time
+        with locks.stores(READ_RECEIPTS_FILE, LOUNGE_READ_RECEIPTS_FILE):
+            # ✅ Mark all private chats as read for ALL users
+            for chat_key in list(messages):
+                participants = chat_participants(chat_key)
+                for user in participants:
+                    if user not in read_receipts:
+                        read_receipts[user] = {}
+                    read_receipts[user][chat_key] = current_time
 
-        # ✅ Mark lounge as read for ALL users
-        for username in users.keys():
-            lounge_read_receipts[username] = current_time
+            # ✅ Mark lounge as read for ALL users
+            for username in users.keys():
+                lounge_read_receipts[username] = lounge_changes.rev
 
-        save_json(READ_RECEIPTS_FILE, read_receipts)
-        save_json(LOUNGE_READ_RECEIPTS_FILE, lounge_read_receipts)
+            save_json(READ_RECEIPTS_FILE, read_receipts)
+            save_json(LOUNGE_READ_RECEIPTS_FILE, lounge_read_receipts)
+        rebuild_inbox_index()
 
         return jsonify({'success': True})
     except Exception as e:
@@ -2344,8 +4411,10 @@ def mark_all_as_read():
 @admin_required
 def clear_all_read_receipts():
     try:
-        # Create empty read receipts file
-        save_json(READ_RECEIPTS_FILE, {})
+        with locks.stores(READ_RECEIPTS_FILE):
+            read_receipts.clear()
+            save_json(READ_RECEIPTS_FILE, read_receipts)
+        rebuild_inbox_index()
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
@@ -2364,45 +4433,311 @@ def get_lunch_menu():
         'fact': 'Enjoy your day off!'
     })
 
-    # Get tomorrow's menu (can be None if not available)
-    tomorrow_menu = lunch_menu.get(tomorrow_str)
+    # Get tomorrow's menu (can be None if not available)
+    tomorrow_menu = lunch_menu.get(tomorrow_str)
+
+    return jsonify({
+        'today': today_menu,
+        'tomorrow': tomorrow_menu,
+        'date': today.strftime('%A, %B %d, %Y')
+    })
+
+# ===============================================================
+# Play counts
+# ===============================================================
+# A game launch only bumps a counter in one of PLAY_SHARDS in-memory shards.
+# periodic_flush_plays folds the pending counts into plays (per-user totals)
+# and play_buckets (launches per game per hour and per day) every
+# STUDYHALL_PLAY_FLUSH_SECONDS with one keyed save each, and refreshes the
+# affected users' top_plays, the top PLAY_TOP_K list view_profile shows.
+PLAY_FLUSH_SECONDS = int(os.environ.get('STUDYHALL_PLAY_FLUSH_SECONDS', 10))
+PLAY_SHARDS = 16
+PLAY_TOP_K = 5
+PLAY_HOURLY_RETENTION = timedelta(hours=48)
+PLAY_DAILY_RETENTION = timedelta(days=90)
+
+class PlayCounter:
+    """Pending launch counts by (username, game_id, hour), sharded by user"""
+
+    def __init__(self, shards):
+        self.shards = [({}, threading.Lock()) for _ in range(shards)]
+
+    def record(self, username, game_id):
+        pending, lock = self.shards[hash(username) % len(self.shards)]
+        key = (username, game_id, get_ny_time().strftime('%Y-%m-%d %H'))
+        with lock:
+            pending[key] = pending.get(key, 0) + 1
+
+    def drain(self):
+        """Take every pending count, leaving the shards empty"""
+        drained = {}
+        for pending, lock in self.shards:
+            with lock:
+                taken = dict(pending)
+                pending.clear()
+            for key, count in taken.items():
+                drained[key] = drained.get(key, 0) + count
+        return drained
+
+play_counter = PlayCounter(PLAY_SHARDS)
+top_plays = {}  # username -> [(game_id, plays)], most played first
+
+def refresh_top_plays(username):
+    user_plays = plays.get(username, {})
+    top_plays[username] = heapq.nlargest(
+        PLAY_TOP_K, ((game_id, count) for game_id, count in user_plays.items() if game_id in games),
+        key=lambda item: item[1])
+
+def flush_plays():
+    """Fold pending launches into plays and play_buckets"""
+    pending = play_counter.drain()
+    if not pending:
+        return
+    now = get_ny_time()
+    hourly_cutoff = (now - PLAY_HOURLY_RETENTION).strftime('%Y-%m-%d %H')
+    daily_cutoff = (now - PLAY_DAILY_RETENTION).strftime('%Y-%m-%d')
+    changed_users = set()
+    changed_games = set()
+    with locks.stores(PLAYS_FILE, PLAY_BUCKETS_FILE):
+        for (username, game_id, hour), count in pending.items():
+            user_plays = plays.setdefault(username, {})
+            user_plays[game_id] = user_plays.get(game_id, 0) + count
+            buckets = play_buckets.setdefault(game_id, {'hourly': {}, 'daily': {}})
+            buckets['hourly'][hour] = buckets['hourly'].get(hour, 0) + count
+            buckets['daily'][hour[:10]] = buckets['daily'].get(hour[:10], 0) + count
+            changed_users.add(username)
+            changed_games.add(game_id)
+        for game_id in changed_games:
+            buckets = play_buckets[game_id]
+            buckets['hourly'] = {h: c for h, c in buckets['hourly'].items() if h >= hourly_cutoff}
+            buckets['daily'] = {d: c for d, c in buckets['daily'].items() if d >= daily_cutoff}
+        save_json(PLAYS_FILE, plays, keys=changed_users)
+        save_json(PLAY_BUCKETS_FILE, play_buckets, keys=changed_games)
+    for username in changed_users:
+        refresh_top_plays(username)
+
+def periodic_flush_plays():
+    while True:
+        time.sleep(PLAY_FLUSH_SECONDS)
+        flush_plays()
+
+for username in plays:
+    refresh_top_plays(username)
+
+play_flush_thread = threading.Thread(target=periodic_flush_plays, daemon=True)
+play_flush_thread.start()
+# Registered after flush_stores, so it runs first at exit
+atexit.register(flush_plays)
+
+# ===============================================================
+# Static assets
+# ===============================================================
+# build_static_assets fingerprints every file under static/ and writes gzip
+# (and, with the optional brotli module, br) variants of the compressible
+# ones to STATIC_BUILD_DIR, plus a manifest. url_for('static', ...) and
+# /static/ URLs in game pages then point at <name>.<hash><ext>, which is
+# served with Cache-Control: immutable; the plain names still work and
+# revalidate by ETag. Unchanged files (same size and mtime) are skipped on
+# later builds, which run at startup in the background or via
+# `flask --app flask_app build-assets`.
+STATIC_BUILD_DIR = os.path.join(DATA_DIR, 'static_build')
+STATIC_MANIFEST_FILE = os.path.join(STATIC_BUILD_DIR, 'manifest.json')
+STATIC_PRECOMPRESS_MIN_BYTES = 1024
+# Formats that are compressed already; gzip/brotli can't shrink them
+STATIC_COMPRESSED_EXTENSIONS = {'.mp3', '.m4a', '.ogg', '.wav', '.mp4', '.webm', '.png', '.jpg', '.jpeg',
+                                '.gif', '.webp', '.ico', '.zip', '.gz', '.br', '.woff', '.woff2'}
+STATIC_ENCODINGS = {'gzip': '.gz', 'br': '.br'}
+STATIC_URL_RE = re.compile(r'/static/([^"\'\s()?#<>]+)')
+
+def empty_static_manifest():
+    return {'version': '', 'files': {}, 'hashed': {}}
+
+def load_static_manifest():
+    try:
+        with open(STATIC_MANIFEST_FILE, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        manifest['hashed'] = {entry['hashed']: path for path, entry in manifest['files'].items()}
+        return manifest
+    except (OSError, ValueError, KeyError):
+        return empty_static_manifest()
+
+# Replaced wholesale by each build, so readers never see a half-built one
+static_manifest = load_static_manifest()
+
+def reload_static_manifest():
+    global static_manifest
+    static_manifest = load_static_manifest()
+
+# Every worker builds at startup; one at a time, each starting from the
+# manifest the previous one published so unchanged files are skipped
+os.makedirs(STATIC_BUILD_DIR, exist_ok=True)
+static_build_lock = WorkerLock(os.path.join(STATIC_BUILD_DIR, '.build.lock'), reload_static_manifest)
+
+def static_variant_path(path, encoding):
+    return os.path.join(STATIC_BUILD_DIR, *path.split('/')) + STATIC_ENCODINGS[encoding]
+
+def static_compressors():
+    yield 'gzip', lambda payload: gzip.compress(payload, 9)
+    if brotli is not None:
+        yield 'br', lambda payload: brotli.compress(payload, quality=11)
+
+def write_atomic(path, payload):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{threading.get_ident()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(payload)
+    os.replace(tmp, path)
+
+def build_static_assets():
+    """Fingerprint and precompress static/, then publish the new manifest"""
+    with static_build_lock:
+        return _build_static_assets()
+
+def _build_static_assets():
+    global static_manifest
+    previous = static_manifest['files']
+    available = [encoding for encoding, compress in static_compressors()]
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(app.static_folder):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        for name in sorted(filenames):
+            if name.startswith('.'):
+                continue
+            full_path = os.path.join(dirpath, name)
+            path = os.path.relpath(full_path, app.static_folder).replace(os.sep, '/')
+            root, ext = os.path.splitext(path)
+            stat = os.stat(full_path)
+            compressible = ext.lower() not in STATIC_COMPRESSED_EXTENSIONS and stat.st_size >= STATIC_PRECOMPRESS_MIN_BYTES
+            old = previous.get(path)
+            # Redone if the file changed or a compressor became available since
+            if (old and old['size'] == stat.st_size and old['mtime'] == stat.st_mtime
+                    and (not compressible or set(old['tried']) >= set(available))
+                    and all(os.path.exists(static_variant_path(path, e)) for e in old['encodings'])):
+                files[path] = old
+                continue
+            with open(full_path, 'rb') as f:
+                payload = f.read()
+            digest = hashlib.sha256(payload).hexdigest()[:12]
+            encodings = []
+            if compressible:
+                for encoding, compress in static_compressors():
+                    body = compress(payload)
+                    # Not worth a variant unless it saves at least 10%
+                    if len(body) < len(payload) * 0.9:
+                        write_atomic(static_variant_path(path, encoding), body)
+                        encodings.append(encoding)
+            files[path] = {
+                'hash': digest,
+                'hashed': f'{root}.{digest}{ext}',
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'tried': available if compressible else [],
+                'encodings': encodings,
+            }
+
+    # Variants of files that were removed or stopped compressing
+    expected = {static_variant_path(path, e) for path, entry in files.items() for e in entry['encodings']}
+    for dirpath, dirnames, filenames in os.walk(STATIC_BUILD_DIR):
+        for name in filenames:
+            full_path = os.path.join(dirpath, name)
+            # Lock file and in-flight writes (a build-assets run holds the same lock)
+            if name.startswith('.') or name.endswith('.tmp'):
+                continue
+            if full_path != STATIC_MANIFEST_FILE and full_path not in expected:
+                os.remove(full_path)
+
+    version = hashlib.sha256(''.join(f'{path}:{entry["hash"]}' for path, entry in sorted(files.items())).encode()).hexdigest()[:8]
+    manifest = {'version': version, 'files': files}
+    write_atomic(STATIC_MANIFEST_FILE, json.dumps(manifest, indent=2).encode('utf-8'))
+    manifest['hashed'] = {entry['hashed']: path for path, entry in files.items()}
+    static_manifest = manifest
+    return manifest
+
+def static_url(path):
+    """/static/ URL for path, fingerprinted if it is in the manifest"""
+    entry = static_manifest['files'].get(path)
+    return '/static/' + (entry['hashed'] if entry else path)
+
+def rewrite_static_urls(html):
+    return STATIC_URL_RE.sub(lambda match: static_url(match.group(1)), html)
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    if endpoint == 'static' and values.get('filename') in static_manifest['files']:
+        values['filename'] = static_manifest['files'][values['filename']]['hashed']
+
+def serve_static(filename):
+    """Replaces Flask's static view: fingerprinted names, precompressed variants, ranges"""
+    manifest = static_manifest
+    path = manifest['hashed'].get(filename)
+    immutable = path is not None
+    entry = manifest['files'].get(path if immutable else filename)
+    if entry is None:
+        return app.send_static_file(filename)
+    path = path or filename
+    source = os.path.join(app.static_folder, *path.split('/'))
+    try:
+        stat = os.stat(source)
+    except OSError:
+        return "Not found", 404
+    if (stat.st_size, stat.st_mtime) != (entry['size'], entry['mtime']):
+        # Changed since the last build; its hash and variants are stale
+        if immutable:
+            return "Not found", 404
+        return app.send_static_file(filename)
+
+    encoding = 'identity'
+    # Byte ranges are served from the original file
+    if request.range is None:
+        encoding = next((e for e in ('br', 'gzip') if e in entry['encodings'] and request.accept_encodings[e]), 'identity')
+    file_path = source if encoding == 'identity' else static_variant_path(path, encoding)
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    response = send_file(file_path, mimetype=mimetype, conditional=True, etag=f"{entry['hash']}.{encoding}")
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    if entry['encodings']:
+        response.headers['Vary'] = 'Accept-Encoding'
+    if immutable:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'public, no-cache'
+    return response
 
-    return jsonify({
-        'today': today_menu,
-        'tomorrow': tomorrow_menu,
-        'date': today.strftime('%A, %B %d, %Y')
-    })
+app.view_functions['static'] = serve_static
 
-@app.route('/play/<game_id>')
-@login_required
-def play_game(game_id):
-    if game_id not in games:
-        return "Game not found", 404
-    if not games[game_id].get('available', True):
-        return "This game is currently unavailable for maintenance", 503
-    game = games[game_id]
-    username = session['username']
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Fingerprint and precompress static/ now (startup also does this in the background)"""
+    started = time.perf_counter()
+    manifest = build_static_assets()
+    compressed = sum(1 for entry in manifest['files'].values() if entry['encodings'])
+    print(f"{len(manifest['files'])} assets, {compressed} precompressed, "
+          f"manifest {manifest['version']} in {time.perf_counter() - started:.1f}s")
 
-    # Check if this is a minecraft game - redirect to download
-    if game.get('is_minecraft_game', False):
-        return redirect(url_for('download', game_id=game_id))
+def background_build_static_assets():
+    try:
+        build_static_assets()
+    except Exception as e:
+        print(f"Building static assets failed: {e}")
 
-    if game.get('free_for_all', True):
-        pass
-    else:
-        if username not in purchases:
-            purchases[username] = []
-        if game_id not in purchases[username]:
-            return "You must purchase this game first", 403
-    if username not in plays:
-        plays[username] = {}
-    if game_id not in plays[username]:
-        plays[username][game_id] = 0
-    plays[username][game_id] += 1
-    save_json(PLAYS_FILE, plays)
-
-    # Inject notification system into game HTML
-    notification_html = '''
+static_build_thread = threading.Thread(target=background_build_static_assets, daemon=True)
+static_build_thread.start()
+
+# ===============================================================
+# Game pages
+# ===============================================================
+# play_game serves a game's HTML with the chat notification snippet injected.
+# Each (game, content version) is assembled and compressed once, then kept in
+# memory (LRU, bounded by bytes) and under GAME_PAGES_DIR, and served with an
+# ETag and Last-Modified so relaunches of an unchanged game are 304s.
+GAME_PAGES_DIR = os.path.join(DATA_DIR, 'game_pages')
+GAME_PAGE_CACHE_BYTES = int(os.environ.get('STUDYHALL_GAME_PAGE_CACHE_BYTES', 64 * 1024 * 1024))
+# Preferred first; brotli is optional
+GAME_PAGE_ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+GAME_PAGE_SUFFIXES = {'identity': '.html', 'gzip': '.html.gz', 'br': '.html.br'}
+
+# Chat notification system injected into every game page
+GAME_NOTIFICATION_HTML = '''
     <!-- Chat Notification Container -->
     <div id="chatNotificationContainer"></div>
     <style>
@@ -2635,24 +4970,178 @@ def play_game(game_id):
         }, 300);
     }
 
-    setInterval(checkChatNotifications, 2000);
-    setInterval(checkGroupNotifications, 2000);
     checkChatNotifications();
     checkGroupNotifications();
+
+    // Live updates: while the /api/events stream is connected events trigger
+    // the checks instead of polling every 2 seconds
+    let notificationTimers = [];
+    function startNotificationPolling() {
+        if (notificationTimers.length) return;
+        notificationTimers = [
+            setInterval(checkChatNotifications, 2000),
+            setInterval(checkGroupNotifications, 2000)
+        ];
+    }
+    startNotificationPolling();
+    const liveEvents = new EventSource(''' + json.dumps(EVENTS_URL) + ''', { withCredentials: true });
+    liveEvents.onopen = () => {
+        notificationTimers.forEach(clearInterval);
+        notificationTimers = [];
+        checkChatNotifications();
+        checkGroupNotifications();
+    };
+    liveEvents.onerror = startNotificationPolling;
+    liveEvents.addEventListener('chat', checkChatNotifications);
+    liveEvents.addEventListener('group', checkGroupNotifications);
     </script>
     '''
+GAME_NOTIFICATION_VERSION = hashlib.sha256(GAME_NOTIFICATION_HTML.encode('utf-8')).hexdigest()[:8]
 
-    # Inject the notification HTML
-    game_html = game['html_content']
-
-    # Insert before closing </body> tag if it exists
+def inject_notifications(game_html):
+    # Insert before closing </body> tag if it exists, otherwise append to end
     if '</body>' in game_html:
-        game_html = game_html.replace('</body>', notification_html + '</body>')
+        return game_html.replace('</body>', GAME_NOTIFICATION_HTML + '</body>')
+    return game_html + GAME_NOTIFICATION_HTML
+
+class GamePageCache:
+    """Assembled game pages with their precompressed variants, by page key"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # One build at a time, so a launch stampede assembles a page once
+        self.build_lock = threading.Lock()
+        self.pages = OrderedDict()  # page key -> {encoding: body}, least recently used first
+        self.size = 0
+
+    def prefix(self, game_id):
+        return re.sub(r'[^0-9A-Za-z_-]', '_', game_id) + '.'
+
+    def page_key(self, game_id, game):
+        # A new static build changes the fingerprinted asset URLs in the page
+        return f"{self.prefix(game_id)}{game['html_version']}.{GAME_NOTIFICATION_VERSION}.{static_manifest['version']}"
+
+    def path(self, key, encoding):
+        return os.path.join(self.directory, key + GAME_PAGE_SUFFIXES[encoding])
+
+    def get(self, game_id, game):
+        """(page key, {encoding: body}) for the game's current HTML.
+
+        Bodies is None for pages too big to keep in memory; play_game
+        streams those from their files.
+        """
+        key = self.page_key(game_id, game)
+        with self.lock:
+            if key in self.pages:
+                self.pages.move_to_end(key)
+                return key, self.pages[key]
+        with self.build_lock:
+            with self.lock:
+                bodies = self.pages.get(key)
+            if bodies is None:
+                paths = [self.path(key, encoding) for encoding in ('identity',) + GAME_PAGE_ENCODINGS]
+                if not all(os.path.exists(path) for path in paths):
+                    bodies = self.build(game_id, key, game)
+                elif sum(os.path.getsize(path) for path in paths) <= self.max_bytes:
+                    bodies = self.read(key)
+                if bodies is not None and not self.remember(key, bodies):
+                    bodies = None
+        return key, bodies
+
+    def read(self, key):
+        bodies = {}
+        for encoding in ('identity',) + GAME_PAGE_ENCODINGS:
+            with open(self.path(key, encoding), 'rb') as f:
+                bodies[encoding] = f.read()
+        return bodies
+
+    def build(self, game_id, key, game):
+        identity = inject_notifications(rewrite_static_urls(read_game_html(game))).encode('utf-8')
+        bodies = {'identity': identity, 'gzip': gzip.compress(identity, 9)}
+        if brotli is not None:
+            bodies['br'] = brotli.compress(identity, quality=9)
+        self.forget(game_id)
+        os.makedirs(self.directory, exist_ok=True)
+        for encoding, body in bodies.items():
+            path = self.path(key, encoding)
+            tmp = f'{path}.{threading.get_ident()}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(body)
+            os.replace(tmp, path)
+        return bodies
+
+    def remember(self, key, bodies):
+        """Keep bodies in memory. False if they alone would exceed max_bytes"""
+        size = sum(len(body) for body in bodies.values())
+        if size > self.max_bytes:
+            return False
+        with self.lock:
+            if key in self.pages:
+                return True
+            self.pages[key] = bodies
+            self.size += size
+            while self.size > self.max_bytes:
+                old_key, old_bodies = self.pages.popitem(last=False)
+                self.size -= sum(len(body) for body in old_bodies.values())
+        return True
+
+    def forget(self, game_id):
+        """Drop every cached version of a game, in memory and on disk"""
+        prefix = self.prefix(game_id)
+        with self.lock:
+            for key in [k for k in self.pages if k.startswith(prefix)]:
+                self.size -= sum(len(body) for body in self.pages.pop(key).values())
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.startswith(prefix):
+                    try:
+                        os.remove(os.path.join(self.directory, name))
+                    except OSError:
+                        pass
+
+game_pages = GamePageCache(GAME_PAGES_DIR, GAME_PAGE_CACHE_BYTES)
+
+@app.route('/play/<game_id>')
+@login_required
+def play_game(game_id):
+    if game_id not in games:
+        return "Game not found", 404
+    if not games[game_id].get('available', True):
+        return "This game is currently unavailable for maintenance", 503
+    game = games[game_id]
+    username = session['username']
+
+    # Check if this is a minecraft game - redirect to download
+    if game.get('is_minecraft_game', False):
+        return redirect(url_for('download', game_id=game_id))
+
+    if game.get('free_for_all', True):
+        pass
     else:
-        # Otherwise append to end
-        game_html = game_html + notification_html
+        if username not in purchases:
+            purchases[username] = []
+        if game_id not in purchases[username]:
+            return "You must purchase this game first", 403
+    play_counter.record(username, game_id)
 
-    return game_html
+    key, bodies = game_pages.get(game_id, game)
+    encoding = next((e for e in GAME_PAGE_ENCODINGS if request.accept_encodings[e]), 'identity')
+    if bodies is None:
+        response = send_file(game_pages.path(key, encoding), mimetype='text/html')
+    else:
+        response = make_response(bodies[encoding])
+        response.content_type = 'text/html; charset=utf-8'
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(f'{key}.{encoding}')
+    response.last_modified = datetime.fromtimestamp(game.get('html_updated', 0), pytz.utc)
+    # Purchases and play counts are checked on every launch, so browsers
+    # revalidate instead of reusing the page; unchanged pages come back as 304
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
 
 @app.route('/purchase_game/<game_id>', methods=['POST'])
 @login_required
@@ -2661,20 +5150,17 @@ def purchase_game(game_id):
         return jsonify({'error': 'Game not found'}), 404
     username = session['username']
     game = games[game_id]
-    if username not in purchases:
-        purchases[username] = []
-    if game_id in purchases[username]:
-        return jsonify({'error': 'Already purchased'}), 400
     if game.get('free_for_all', True):
         return jsonify({'error': 'Game is free'}), 400
     price = game.get('price', 0)
-    user_tokens = users[username].get('tokens', 0)
-    if user_tokens < price:
-        return jsonify({'error': 'Insufficient tokens'}), 400
-    users[username]['tokens'] -= price
-    purchases[username].append(game_id)
-    save_json(USERS_FILE, users)
-    save_json(PURCHASES_FILE, purchases)
+    with locks.balances(username):
+        if game_id in purchases.get(username, []):
+            return jsonify({'error': 'Already purchased'}), 400
+        if not debit_tokens(username, price):
+            return jsonify({'error': 'Insufficient tokens'}), 400
+        with locks.stores(PURCHASES_FILE):
+            purchases.setdefault(username, []).append(game_id)
+        save_json(PURCHASES_FILE, purchases, keys=[username])
     log_transaction('destruction', price, username, 'game_purchase', f'Game: {game_id}')
     return jsonify({'success': True, 'new_balance': users[username]['tokens']})
 
@@ -2693,24 +5179,19 @@ def purchase_access(site_id):
     if site_id not in site_prices:
         return jsonify({'error': 'Site not found'}), 404
 
-    # Check if user already has access
-    if username in site_access and site_id in site_access.get(username, []):
-        return jsonify({'error': 'Already purchased'}), 400
-
     price = site_prices[site_id]
-    user_tokens = users[username].get('tokens', 0)
-
-    if user_tokens < price:
-        return jsonify({'error': 'Insufficient tokens'}), 400
 
-    # Deduct tokens and grant access
-    users[username]['tokens'] -= price
-    if username not in site_access:
-        site_access[username] = []
-    site_access[username].append(site_id)
+    with locks.balances(username):
+        # Check if user already has access
+        if username in site_access and site_id in site_access.get(username, []):
+            return jsonify({'error': 'Already purchased'}), 400
 
-    save_json(USERS_FILE, users)
-    save_json(SITE_ACCESS_FILE, site_access)
+        # Deduct tokens and grant access
+        if not debit_tokens(username, price):
+            return jsonify({'error': 'Insufficient tokens'}), 400
+        with locks.stores(SITE_ACCESS_FILE):
+            site_access.setdefault(username, []).append(site_id)
+        save_json(SITE_ACCESS_FILE, site_access, keys=[username])
 
     return jsonify({'success': True, 'new_balance': users[username]['tokens']})
 
@@ -2727,21 +5208,20 @@ def purchase_rank(rank_id):
             break
     if rank_data is None:
         return jsonify({'error': 'Rank not found'}), 404
-    current_rank = users[username].get('rank')
-    current_rank_index = -1
-    if current_rank:
-        for i, rank in enumerate(RANKS):
-            if rank['id'] == current_rank:
-                current_rank_index = i
-                break
-    if rank_index != current_rank_index + 1:
-        return jsonify({'error': 'You must purchase ranks in order!'}), 400
-    user_tokens = users[username].get('tokens', 0)
-    if user_tokens < rank_data['price']:
-        return jsonify({'error': 'Insufficient tokens'}), 400
-    users[username]['tokens'] -= rank_data['price']
-    users[username]['rank'] = rank_id
-    save_json(USERS_FILE, users)
+    with locks.balances(username):
+        current_rank = users[username].get('rank')
+        current_rank_index = -1
+        if current_rank:
+            for i, rank in enumerate(RANKS):
+                if rank['id'] == current_rank:
+                    current_rank_index = i
+                    break
+        if rank_index != current_rank_index + 1:
+            return jsonify({'error': 'You must purchase ranks in order!'}), 400
+        if not debit_tokens(username, rank_data['price']):
+            return jsonify({'error': 'Insufficient tokens'}), 400
+        users[username]['rank'] = rank_id
+        save_json(USERS_FILE, users, keys=[username])
     log_transaction('destruction', rank_data['price'], username, 'rank_purchase', f'Rank: {rank_id}')
     return jsonify({
         'success': True,
@@ -2753,9 +5233,8 @@ def purchase_rank(rank_id):
 @login_required
 def add_tokens(amount):
     username = session['username']
-    users[username]['tokens'] += amount
-    save_json(USERS_FILE, users)
-    return jsonify({'success': True, 'new_balance': users[username]['tokens']})
+    new_balance = credit_tokens(username, amount)
+    return jsonify({'success': True, 'new_balance': new_balance})
 
 @app.route('/api/leaderboard')
 @login_required
@@ -2781,10 +5260,6 @@ def claim_rank_pass():
     ny_tz = pytz.timezone('America/New_York')
     now = datetime.now(ny_tz)
     today = now.strftime('%Y-%m-%d')
-    if username in rank_pass_state:
-        last_claim = rank_pass_state[username].get('last_claim_date')
-        if last_claim == today:
-            return jsonify({'error': 'Already claimed today! Come back tomorrow'}), 400
     rank_rewards = {
         'bronze': 5,
         'silver': 10,
@@ -2797,18 +5272,22 @@ def claim_rank_pass():
     reward = rank_rewards.get(user_rank, 0)
     if reward == 0:
         return jsonify({'error': 'Invalid rank'}), 400
-    users[username]['tokens'] = users[username].get('tokens', 0) + reward
-    rank_pass_state[username] = {
-        'last_claim_date': today,
-        'last_claim_time': now.strftime('%Y-%m-%d %H:%M:%S')
-    }
-    save_json(USERS_FILE, users)
-    save_json(RANK_PASS_FILE, rank_pass_state)
+    with locks.balances(username):
+        if username in rank_pass_state:
+            last_claim = rank_pass_state[username].get('last_claim_date')
+            if last_claim == today:
+                return jsonify({'error': 'Already claimed today! Come back tomorrow'}), 400
+        rank_pass_state[username] = {
+            'last_claim_date': today,
+            'last_claim_time': now.strftime('%Y-%m-%d %H:%M:%S')
+        }
+        save_json(RANK_PASS_FILE, rank_pass_state, keys=[username])
+        new_balance = credit_tokens(username, reward)
     log_transaction('creation', reward, username, 'daily_reward')
     return jsonify({
         'success': True,
         'reward': reward,
-        'new_balance': users[username]['tokens']
+        'new_balance': new_balance
     })
 
 @app.route('/api/rank_pass_status')
@@ -2870,18 +5349,17 @@ def redeem_code(code):
         return jsonify({'error': 'Code not found'}), 404
     if not codes[code]['active']:
         return jsonify({'error': 'Code is no longer active'}), 400
-    if username not in redeemed_codes:
-        redeemed_codes[username] = []
-    if code in redeemed_codes[username]:
-        return jsonify({'error': 'You already redeemed this code'}), 400
     tokens = codes[code]['tokens']
-    users[username]['tokens'] += tokens
-    redeemed_codes[username].append(code)
-    save_json(USERS_FILE, users)
-    save_json(REDEEMED_CODES_FILE, redeemed_codes)
+    with locks.balances(username):
+        if code in redeemed_codes.get(username, []):
+            return jsonify({'error': 'You already redeemed this code'}), 400
+        with locks.stores(REDEEMED_CODES_FILE):
+            redeemed_codes.setdefault(username, []).append(code)
+        save_json(REDEEMED_CODES_FILE, redeemed_codes, keys=[username])
+        new_balance = credit_tokens(username, tokens)
     log_transaction('creation', tokens, username, 'code_redeem', f'Code: {code}')
 
-    return jsonify({'success': True, 'tokens': tokens, 'new_balance': users[username]['tokens']})
+    return jsonify({'success': True, 'tokens': tokens, 'new_balance': new_balance})
 
 @app.route('/api/get_codes')
 @panel_access_required
@@ -2915,7 +5393,19 @@ def get_play_stats():
                 'games': user_games
             })
     stats.sort(key=lambda x: x['username'])
-    return jsonify({'stats': stats})
+
+    # Launches per game per hour and per day
+    game_stats = []
+    for game_id, buckets in play_buckets.items():
+        if game_id in games:
+            game_stats.append({
+                'game_id': game_id,
+                'game_name': games[game_id]['name'],
+                'hourly': buckets.get('hourly', {}),
+                'daily': buckets.get('daily', {})
+            })
+    game_stats.sort(key=lambda x: x['game_name'])
+    return jsonify({'stats': stats, 'games': game_stats})
 
 @app.route('/download/<game_id>')
 @login_required
@@ -2925,15 +5415,166 @@ def download(game_id):
     if not games[game_id].get('available', True):
         return "This game is currently unavailable for maintenance", 503
     game = games[game_id]
-    file_data = io.BytesIO(game['html_content'].encode('utf-8'))
-    file_data.seek(0)
     return send_file(
-        file_data,
+        game_content_path(game),
         mimetype='text/html',
         as_attachment=True,
         download_name=f'{game_id}.html'
     )
 
+@app.route('/media/<name>')
+@login_required
+def media(name):
+    """Serve a blob. Content never changes, so the hash is the ETag and it caches forever"""
+    match = MEDIA_NAME_RE.fullmatch(name)
+    if not match:
+        return "Not found", 404
+    digest, ext = match.group(1), match.group(2) or ''
+    path = blob_path(digest, ext)
+    if not os.path.exists(path):
+        return "Not found", 404
+    response = send_file(path, mimetype=MEDIA_MIMETYPES.get(ext), conditional=True,
+                         etag=digest, max_age=31536000)
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+@app.cli.command('migrate-media')
+def migrate_media():
+    """Move inline base64 media in existing stores into the blob store.
+
+    Run offline: flask --app flask_app migrate-media
+    """
+    moved = 0
+
+    def migrate(record, field):
+        nonlocal moved
+        value = record.get(field)
+        ref = media_ref(value)
+        if ref is not value:
+            record[field] = ref
+            moved += 1
+
+    for chat in messages.values():
+        for msg in chat:
+            migrate(msg, 'photo')
+            migrate(msg, 'audio')
+    for msg in lounge_messages:
+        migrate(msg, 'photo')
+        migrate(msg, 'audio')
+    for chat in group_messages.values():
+        for msg in chat:
+            migrate(msg, 'photo')
+            migrate(msg, 'audio')
+    for profile in profiles.values():
+        migrate(profile, 'profile_picture')
+    for group in groups.values():
+        migrate(group, 'image')
+
+    save_json(MESSAGES_FILE, messages)
+    save_json(LOUNGE_FILE, lounge_messages)
+    save_json(GROUP_MESSAGES_FILE, group_messages)
+    save_json(PROFILES_FILE, profiles)
+    save_json(GROUPS_FILE, groups)
+    flush_stores()
+    publish_lounge_feed()
+    print(f"Moved {moved} media items to {BLOB_DIR}")
+
+@app.cli.command('verify-unread')
+def verify_unread():
+    """Check the inbox index against a full scan for every user.
+
+    flask --app flask_app verify-unread
+    """
+    started = time.perf_counter()
+    rebuild_inbox_index()
+    rebuilt = time.perf_counter() - started
+    mismatches = 0
+    scan_seconds = index_seconds = 0.0
+    for username in users:
+        started = time.perf_counter()
+        expected = scan_unread_count(username)
+        scan_seconds += time.perf_counter() - started
+        started = time.perf_counter()
+        actual = get_unread_count(username)
+        index_seconds += time.perf_counter() - started
+        if actual != expected:
+            mismatches += 1
+            print(f"  {username}: index {actual}, scan {expected}")
+        for other_user, entry in inbox(username).items():
+            if entry != inbox_entry(username, entry['chat_key']):
+                mismatches += 1
+                print(f"  {username} -> {other_user}: stale inbox entry")
+    print(f"{len(users)} users, {mismatches} mismatches; rebuild {rebuilt * 1000:.1f} ms, "
+          f"lookups {index_seconds * 1000:.1f} ms vs scan {scan_seconds * 1000:.1f} ms")
+
+@app.cli.command('gateway-loadtest')
+@click.option('--subscribers', default=5000, help='Idle streams to open')
+@click.option('--idle', default=EVENT_HEARTBEAT_SECONDS + 5, help='Seconds to hold them open')
+@click.option('--user', default=None, help='Account the streams log in as (default: first user)')
+def gateway_loadtest(subscribers, idle, user):
+    """Open many idle event streams against the gateway and report memory.
+
+    flask --app flask_app gateway-loadtest --subscribers 5000
+    Client and server sockets live in this one process, so the per-stream
+    figure covers both ends.
+    """
+    username = user or next(iter(users), None)
+    if username not in users:
+        print('No such user; pass --user')
+        return
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+    gateway = event_gateway or EventGateway(GATEWAY_HOST, 0).start()
+    session_cookie = gateway.serializer.dumps({'username': username})
+    request_head = (f"GET /api/events HTTP/1.1\r\nHost: {GATEWAY_HOST}\r\n"
+                    f"Cookie: {app.config.get('SESSION_COOKIE_NAME', 'session')}={session_cookie}\r\n\r\n").encode()
+
+    def rss_kib():
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+        return 0
+
+    async def open_stream():
+        reader, writer = await asyncio.open_connection(GATEWAY_HOST, gateway.port)
+        writer.write(request_head)
+        await reader.readuntil(b'retry: 3000\n\n')
+        return reader, writer
+
+    async def run():
+        before = rss_kib()
+        started = time.perf_counter()
+        streams = []
+        for i in range(0, subscribers, 500):
+            streams += await asyncio.gather(*(open_stream() for _ in range(min(500, subscribers - i))))
+        connected = rss_kib()
+        print(f"{len(streams)} streams open in {time.perf_counter() - started:.1f}s, "
+              f"RSS {before / 1024:.1f} -> {connected / 1024:.1f} MiB "
+              f"({(connected - before) / max(len(streams), 1):.1f} KiB/stream)")
+
+        await asyncio.sleep(idle)
+        idled = rss_kib()
+        print(f"after {idle}s idle (heartbeats every {EVENT_HEARTBEAT_SECONDS}s): RSS {idled / 1024:.1f} MiB "
+              f"({(idled - connected) / 1024:+.1f} MiB)")
+
+        started = time.perf_counter()
+        event_bus.publish('loadtest', {'ping': True}, to=[username])
+        delivered = await asyncio.gather(*(asyncio.wait_for(reader.readuntil(b'event: loadtest'), 30)
+                                           for reader, writer in streams), return_exceptions=True)
+        ok = sum(1 for result in delivered if not isinstance(result, BaseException))
+        print(f"broadcast reached {ok}/{len(streams)} streams in {time.perf_counter() - started:.2f}s")
+
+        for reader, writer in streams:
+            writer.close()
+
+    asyncio.run(run())
+
 @app.route('/panel')
 @panel_access_required
 def admin_panel():
@@ -2964,7 +5605,7 @@ def admin_panel():
     groups_data = []
     for group_id, group_data in groups.items():
         all_members = [group_data['leader']] + group_data.get('members', [])
-        message_count = len(group_messages.get(group_id, []))
+        message_count = len(live_messages(group_messages.get(group_id, [])))
         groups_data.append({
             'id': group_id,
             'name': group_data['name'],
@@ -3011,15 +5652,14 @@ def get_game_html(game_id):
         return jsonify({'error': 'Game not found'}), 404
     return jsonify({
         'success': True,
-        'html_content': games[game_id]['html_content']
+        'html_content': read_game_html(games[game_id])
     })
 
 @app.route('/panel/edit_token/<username>/<int:amount>', methods=['GET', 'POST'])
 @admin_required
 def edit_token(username, amount):
     if username in users:
-        users[username]['tokens'] = amount
-        save_json(USERS_FILE, users)
+        set_tokens(username, amount)
     return redirect(url_for('admin_panel'))
 
 @app.route('/panel/change_password/<username>', methods=['POST'])
@@ -3163,7 +5803,9 @@ def unban_user(username):
 @admin_required
 def delete_user(username):
     if username in users and username != 'admin':
-        del users[username]
+        with circulation.lock:
+            del users[username]
+            circulation.track(username)
         save_json(USERS_FILE, users)
     return redirect(url_for('admin_panel'))
 
@@ -3201,7 +5843,6 @@ def add_game():
         game_id = game_name.lower().replace(' ', '_').replace('+', '_plus')
         games[game_id] = {
             'name': game_name,
-            'html_content': html_content,
             'available': True,
             'price': price,
             'free_for_all': free_for_all,
@@ -3211,7 +5852,8 @@ def add_game():
             'is_pokemon_game': is_pokemon_game,
             'background_image': background_image if background_image else None
         }
-        save_json(GAMES_FILE, games)
+        store_game_html(games[game_id], html_content)
+        save_json(GAMES_FILE, games, keys=[game_id])
     return redirect(url_for('admin_panel'))
 
 @app.route('/panel/toggle_game_roblox/<game_id>', methods=['GET', 'POST'])
@@ -3252,8 +5894,8 @@ def update_game(game_id):
     if game_id in games:
         html_content = request.form.get('html_content')
         if html_content:
-            games[game_id]['html_content'] = html_content
-            save_json(GAMES_FILE, games)
+            store_game_html(games[game_id], html_content)
+            save_json(GAMES_FILE, games, keys=[game_id])
     return redirect(url_for('admin_panel'))
 
 @app.route('/panel/toggle_game/<game_id>', methods=['GET', 'POST'])
@@ -3268,8 +5910,9 @@ def toggle_game(game_id):
 @admin_required
 def delete_game(game_id):
     if game_id in games:
-        del games[game_id]
-        save_json(GAMES_FILE, games)
+        games.pop(game_id)
+        save_json(GAMES_FILE, games, keys=[game_id])
+        game_pages.forget(game_id)
     return redirect(url_for('admin_panel'))
 
 @app.route('/panel/add_announcement', methods=['POST'])
@@ -3323,11 +5966,6 @@ def tower_start():
         return jsonify({'error': 'Minimum bet is 5 tokens'}), 400
     if mode not in [2, 3]:
         return jsonify({'error': 'Invalid mode'}), 400
-    user_tokens = users[username].get('tokens', 0)
-    if user_tokens < bet_amount:
-        return jsonify({'error': 'Insufficient tokens'}), 400
-    users[username]['tokens'] -= bet_amount
-    save_json(USERS_FILE, users)
     pattern = []
     for level in range(9):
         if mode == 2:
@@ -3343,14 +5981,19 @@ def tower_start():
     # -------------------------------
     # 🔹 Save active game session
     # -------------------------------
-    tower_games[username] = {
-        'bet': bet_amount,
-        'mode': mode,
-        'level': 0,
-        'pattern': pattern,
-        'active': True,
-        'rigged_level': rigged_level
-    }
+    # Same per-player lock as select/cashout, so a start can't replace a game mid-move
+    with locks.balances(username), locks.stores(TOWER_GAMES_FILE):
+        if not debit_tokens(username, bet_amount):
+            return jsonify({'error': 'Insufficient tokens'}), 400
+        tower_games[username] = {
+            'bet': bet_amount,
+            'mode': mode,
+            'level': 0,
+            'pattern': pattern,
+            'active': True,
+            'rigged_level': rigged_level
+        }
+        save_json(TOWER_GAMES_FILE, tower_games, keys=[username])
     # -------------------------------
     # 🔹 Return fair game start
     # -------------------------------
@@ -3365,91 +6008,96 @@ def tower_start():
 @login_required
 def tower_select():
     username = session['username']
-    if username not in tower_games or not tower_games[username]['active']:
-        return jsonify({'error': 'No active game'}), 400
-
-    game = tower_games[username]
-    data = request.json
-    level = data.get('level')
-    tile = data.get('tile')
+    # Serialise moves per player so a select can't race a cashout
+    with locks.balances(username), locks.stores(TOWER_GAMES_FILE):
+        if username not in tower_games or not tower_games[username]['active']:
+            return jsonify({'error': 'No active game'}), 400
+
+        game = tower_games[username]
+        data = request.json
+        level = data.get('level')
+        tile = data.get('tile')
+
+        if level != game['level']:
+            return jsonify({'error': 'Invalid level'}), 400
+
+        # Check if hit egg or bobcat
+        if game['mode'] == 2:
+            # Mode 2: pattern contains egg position
+            hit_egg = (tile == game['pattern'][level][0])
+        else:
+            # Mode 3: pattern contains list of egg positions
+            hit_egg = (tile in game['pattern'][level])
 
-    if level != game['level']:
-        return jsonify({'error': 'Invalid level'}), 400
 
-    # Check if hit egg or bobcat
-    if game['mode'] == 2:
-        # Mode 2: pattern contains egg position
-        hit_egg = (tile == game['pattern'][level][0])
-    else:
-        # Mode 3: pattern contains list of egg positions
-        hit_egg = (tile in game['pattern'][level])
+        if hit_egg:
+            # Success! Move to next level
+            game['level'] += 1
+            save_json(TOWER_GAMES_FILE, tower_games, keys=[username])
+            multipliers = {
+                2: [1.5, 2.25, 3.38, 5.06, 7.59, 11.39, 17.09, 25.63, 38.44],
+                3: [1.2, 1.44, 1.73, 2.07, 2.49, 2.99, 3.58, 4.30, 5.16]
+            }
+            multiplier = multipliers[game['mode']][game['level'] - 1]
 
+            return jsonify({
+                'success': True,
+                'hit_egg': True,
+                'level': game['level'],
+                'multiplier': multiplier
+            })
+        else:
+            # Hit bobcat - game over
+            game['active'] = False
+            save_json(TOWER_GAMES_FILE, tower_games, keys=[username])
+            log_casino_game('tower', username, game['bet'], False, -game['bet'])
+            log_transaction('destruction', game['bet'], username, 'casino_tower')
+
+            return jsonify({
+                'success': True,
+                'hit_egg': False,
+                'new_balance': users[username]['tokens']
+            })
 
-    if hit_egg:
-        # Success! Move to next level
-        game['level'] += 1
+@app.route('/api/tower_cashout', methods=['POST'])
+@login_required
+def tower_cashout():
+    username = session['username']
+    with locks.balances(username), locks.stores(TOWER_GAMES_FILE):
+        if username not in tower_games or not tower_games[username]['active']:
+            return jsonify({'error': 'No active game'}), 400
+        game = tower_games[username]
+        if game['level'] == 0:
+            return jsonify({'error': 'Must complete at least one level'}), 400
+        # Close the game before paying out so a second cashout gets 'No active game'
+        game['active'] = False
+        save_json(TOWER_GAMES_FILE, tower_games, keys=[username])
+        # Calculate winnings
         multipliers = {
             2: [1.5, 2.25, 3.38, 5.06, 7.59, 11.39, 17.09, 25.63, 38.44],
             3: [1.2, 1.44, 1.73, 2.07, 2.49, 2.99, 3.58, 4.30, 5.16]
         }
         multiplier = multipliers[game['mode']][game['level'] - 1]
-
-        return jsonify({
-            'success': True,
-            'hit_egg': True,
+        profit = int(game['bet'] * multiplier)
+        # Add winnings
+        new_balance = credit_tokens(username, profit)
+    # Add to recent wins (keep only last 3)
+    with locks.stores(TOWER_WINS_FILE):
+        tower_recent_wins.insert(0, {
+            'username': username,
             'level': game['level'],
-            'multiplier': multiplier
-        })
-    else:
-        # Hit bobcat - game over
-        game['active'] = False
-        save_json(USERS_FILE, users)
-        log_casino_game('tower', username, game['bet'], False, -game['bet'])
-        log_transaction('destruction', game['bet'], username, 'casino_tower')
-
-        return jsonify({
-            'success': True,
-            'hit_egg': False,
-            'new_balance': users[username]['tokens']
+            'profit': profit,
+            'multiplier': f"{multiplier:.2f}"
         })
-
-@app.route('/api/tower_cashout', methods=['POST'])
-@login_required
-def tower_cashout():
-    username = session['username']
-    if username not in tower_games or not tower_games[username]['active']:
-        return jsonify({'error': 'No active game'}), 400
-    game = tower_games[username]
-    if game['level'] == 0:
-        return jsonify({'error': 'Must complete at least one level'}), 400
-    # Calculate winnings
-    multipliers = {
-        2: [1.5, 2.25, 3.38, 5.06, 7.59, 11.39, 17.09, 25.63, 38.44],
-        3: [1.2, 1.44, 1.73, 2.07, 2.49, 2.99, 3.58, 4.30, 5.16]
-    }
-    multiplier = multipliers[game['mode']][game['level'] - 1]
-    profit = int(game['bet'] * multiplier)
-    # Add winnings
-    users[username]['tokens'] += profit
-    save_json(USERS_FILE, users)
-    # Add to recent wins (keep only last 3)
-    global tower_recent_wins
-    tower_recent_wins.insert(0, {
-        'username': username,
-        'level': game['level'],
-        'profit': profit,
-        'multiplier': f"{multiplier:.2f}"
-    })
-    tower_recent_wins = tower_recent_wins[:3]
-    save_json(TOWER_WINS_FILE, tower_recent_wins)
+        del tower_recent_wins[3:]
+        save_json(TOWER_WINS_FILE, tower_recent_wins)
     log_casino_game('tower', username, game['bet'], True, profit - game['bet'])
     log_transaction('creation', profit, username, 'casino_tower')
-    game['active'] = False
     return jsonify({
         'success': True,
         'profit': profit,
         'multiplier': multiplier,
-        'new_balance': users[username]['tokens']
+        'new_balance': new_balance
     })
 
 @app.route('/api/update_maintenance_notes', methods=['POST'])
@@ -3565,35 +6213,44 @@ def purchase_lottery_ticket():
     ticket_price = lottery_state.get('ticket_price', 0)
     total_cost = ticket_price * ticket_count
 
-    # Check balance
-    user_tokens = users[username].get('tokens', 0)
-    if user_tokens < total_cost:
-        return jsonify({'error': 'Insufficient tokens'}), 400
+    with locks.stores(LOTTERY_FILE, LOTTERY_TICKETS_FILE):
+        # The draw may have happened while we were waiting for the lock
+        if not lottery_state.get('active'):
+            return jsonify({'error': 'No active lottery'}), 400
 
-    # Deduct tokens (tokens just disappear, don't add to prize pool)
-    users[username]['tokens'] -= total_cost
+        # Deduct tokens (tokens just disappear, don't add to prize pool)
+        if not debit_tokens(username, total_cost):
+            return jsonify({'error': 'Insufficient tokens'}), 400
 
-    # Add tickets
-    if username not in lottery_tickets:
-        lottery_tickets[username] = 0
-    lottery_tickets[username] += ticket_count
+        # Add tickets
+        if username not in lottery_tickets:
+            lottery_tickets[username] = 0
+        lottery_tickets[username] += ticket_count
+        total_tickets = lottery_tickets[username]
 
-    # ✅ REMOVED: Prize pool accumulation - it's now fixed by admin
+        # ✅ REMOVED: Prize pool accumulation - it's now fixed by admin
 
-    save_json(USERS_FILE, users)
-    save_json(LOTTERY_TICKETS_FILE, lottery_tickets)
+        save_json(LOTTERY_TICKETS_FILE, lottery_tickets, keys=[username])
     log_transaction('destruction', total_cost, username, 'lottery_ticket')
 
     return jsonify({
         'success': True,
         'new_balance': users[username]['tokens'],
-        'total_tickets': lottery_tickets[username]
+        'total_tickets': total_tickets
     })
 
 def end_lottery():
     """End the lottery and pick a winner"""
+    with locks.stores(LOTTERY_FILE, LOTTERY_TICKETS_FILE):
+        _end_lottery()
+
+def _end_lottery():
     global lottery_state, lottery_tickets
 
+    if not lottery_state.get('active'):
+        # Already drawn by a concurrent request
+        return
+
     if not lottery_tickets:
         # No participants - cancel lottery
         lottery_state['active'] = False
@@ -3611,7 +6268,7 @@ def end_lottery():
 
     # Award prize
     prize = lottery_state['prize_pool']
-    users[winner]['tokens'] = users[winner].get('tokens', 0) + prize
+    credit_tokens(winner, prize)
 
     # Calculate totals
     total_tickets = sum(lottery_tickets.values())
@@ -3628,18 +6285,16 @@ def end_lottery():
     # Clear tickets
     lottery_tickets.clear()
 
-    save_json(USERS_FILE, users)
     save_json(LOTTERY_FILE, lottery_state)
     save_json(LOTTERY_TICKETS_FILE, lottery_tickets)
     log_transaction('creation', prize, winner, 'lottery_win')
 
     # Post to lounge
-    lounge_messages.append({
+    append_message(LOUNGE_FILE, lounge_messages, {
         'from': 'system',
         'text': f'🎰 LOTTERY WINNER: {winner} won {prize} tokens with {winner_tickets}/{total_tickets} tickets! 🎉',
         'timestamp': get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
     })
-    save_json(LOUNGE_FILE, lounge_messages)
 
 # ===== ADMIN LOTTERY ROUTES =====
 
@@ -3805,8 +6460,14 @@ def determine_rps_winner(move1, move2):
 
 def check_rps_timeouts():
     """Check for expired invites and moves, handle timeouts"""
+    with locks.stores(RPS_GAMES_FILE):
+        _check_rps_timeouts()
+
+def _check_rps_timeouts():
     current_time = get_ny_time().timestamp()
     games_to_remove = []
+    timed_out = []
+    games_before = dict(rps_games)
 
     for game_key, game in list(rps_games.items()):  # Use list() to avoid dict size change during iteration
         # Check invite timeout (1 hour)
@@ -3830,22 +6491,21 @@ def check_rps_timeouts():
                 else:
                     # Both haven't moved (shouldn't happen but handle it), refund both
                     amount = game['bet_amount']
-                    users[game['player1']]['tokens'] = users[game['player1']].get('tokens', 0) + amount
-                    users[game['player2']]['tokens'] = users[game['player2']].get('tokens', 0) + amount
+                    credit_tokens(game['player1'], amount)
+                    credit_tokens(game['player2'], amount)
                     games_to_remove.append(game_key)
-                    save_json(USERS_FILE, users)
                     continue
 
                 # Award tokens to winner
                 total_pot = game['bet_amount'] * 2
-                users[winner]['tokens'] = users[winner].get('tokens', 0) + total_pot
+                credit_tokens(winner, total_pot)
 
                 # Mark game as completed with timeout
                 game['status'] = 'completed'
                 game['winner'] = winner
                 game['timeout_win'] = True
                 game['completion_time'] = current_time
-                save_json(USERS_FILE, users)
+                timed_out.append(game_key)
 
                 # Log the game to history
                 log_rps_game(game)
@@ -3870,6 +6530,9 @@ def check_rps_timeouts():
 
     if games_to_remove or completed_to_remove:
         save_json(RPS_GAMES_FILE, rps_games)
+    for game_key in set(games_to_remove + completed_to_remove + timed_out):
+        game = games_before[game_key]
+        notify_rps(game['player1'], game['player2'])
 
 def log_rps_game(game):
     """Log completed RPS game to history"""
@@ -3900,6 +6563,7 @@ def log_rps_game(game):
 
 @app.route('/api/rps/invite/<other_user>', methods=['POST'])
 @login_required
+@store_locked(RPS_GAMES_FILE)
 def rps_invite(other_user):
     """Invite another user to play Rock Paper Scissors"""
     current_user = session['username']
@@ -3952,27 +6616,26 @@ def rps_invite(other_user):
         'current_round': None
     }
     save_json(RPS_GAMES_FILE, rps_games)
+    notify_rps(current_user, other_user)
 
     # Add RPS notification to chat messages for notification system
     chat_key = get_chat_key(current_user, other_user)
-    if chat_key not in messages:
-        messages[chat_key] = []
 
     new_timestamp = get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
-    messages[chat_key].append({
+    append_message(MESSAGES_FILE, messages, {
         'from': current_user,
         'to': other_user,
         'type': 'rps_invite',
         'text': f'I am challenging you to RPS for {bet_amount} tokens! Lets play it the Bobcat Way.',
         'timestamp': new_timestamp,
         'read': False
-    })
-    save_json(MESSAGES_FILE, messages)
+    }, key=chat_key)
 
     return jsonify({'success': True, 'game_key': game_key})
 
 @app.route('/api/rps/accept/<other_user>', methods=['POST'])
 @login_required
+@store_locked(RPS_GAMES_FILE)
 def rps_accept(other_user):
     """Accept an RPS game invite"""
     current_user = session['username']
@@ -3989,21 +6652,23 @@ def rps_accept(other_user):
     if game['player2'] != current_user:
         return jsonify({'error': 'You are not the invited player'}), 403
 
-    # Check if both users still have enough tokens (re-check player1 too)
-    if users[game['player1']].get('tokens', 0) < game['bet_amount']:
-        del rps_games[game_key]
-        save_json(RPS_GAMES_FILE, rps_games)
-        return jsonify({'error': f'{game["player1"]} no longer has enough tokens'}), 400
+    with locks.balances(game['player1'], current_user):
+        # Check if both users still have enough tokens (re-check player1 too)
+        if users[game['player1']].get('tokens', 0) < game['bet_amount']:
+            del rps_games[game_key]
+            save_json(RPS_GAMES_FILE, rps_games)
+            notify_rps(game['player1'], current_user)
+            return jsonify({'error': f'{game["player1"]} no longer has enough tokens'}), 400
 
-    if users[current_user].get('tokens', 0) < game['bet_amount']:
-        del rps_games[game_key]
-        save_json(RPS_GAMES_FILE, rps_games)
-        return jsonify({'error': 'You no longer have enough tokens'}), 400
+        if users[current_user].get('tokens', 0) < game['bet_amount']:
+            del rps_games[game_key]
+            save_json(RPS_GAMES_FILE, rps_games)
+            notify_rps(game['player1'], current_user)
+            return jsonify({'error': 'You no longer have enough tokens'}), 400
 
-    # Deduct tokens from BOTH players when game starts
-    users[game['player1']]['tokens'] -= game['bet_amount']
-    users[current_user]['tokens'] -= game['bet_amount']
-    save_json(USERS_FILE, users)
+        # Deduct tokens from BOTH players when game starts
+        debit_tokens(game['player1'], game['bet_amount'])
+        debit_tokens(current_user, game['bet_amount'])
 
     # Start game
     game['status'] = 'active'
@@ -4011,11 +6676,13 @@ def rps_accept(other_user):
     game['last_move_time'] = get_ny_time().timestamp()
     game['current_round'] = 1
     save_json(RPS_GAMES_FILE, rps_games)
+    notify_rps(game['player1'], current_user)
 
     return jsonify({'success': True, 'game': game})
 
 @app.route('/api/rps/decline/<other_user>', methods=['POST'])
 @login_required
+@store_locked(RPS_GAMES_FILE)
 def rps_decline(other_user):
     """Decline an RPS game invite"""
     current_user = session['username']
@@ -4035,6 +6702,7 @@ def rps_decline(other_user):
     # Remove game (no tokens to refund since they weren't deducted yet)
     del rps_games[game_key]
     save_json(RPS_GAMES_FILE, rps_games)
+    notify_rps(game['player1'], current_user)
 
     return jsonify({'success': True})
 
@@ -4081,6 +6749,7 @@ def rps_status(other_user):
 
 @app.route('/api/rps/move/<other_user>', methods=['POST'])
 @login_required
+@store_locked(RPS_GAMES_FILE)
 def rps_move(other_user):
     """Make a move in RPS game"""
     current_user = session['username']
@@ -4145,12 +6814,11 @@ def rps_move(other_user):
         if game['player1_wins'] >= 3:
             # Player 1 wins
             total_pot = game['bet_amount'] * 2
-            users[game['player1']]['tokens'] = users[game['player1']].get('tokens', 0) + total_pot
+            credit_tokens(game['player1'], total_pot)
             game['status'] = 'completed'
             game['winner'] = game['player1']
             game['completion_time'] = get_ny_time().timestamp()
             game['timeout_win'] = False
-            save_json(USERS_FILE, users)
 
             # Log the game to history
             log_rps_game(game)
@@ -4159,12 +6827,11 @@ def rps_move(other_user):
         elif game['player2_wins'] >= 3:
             # Player 2 wins
             total_pot = game['bet_amount'] * 2
-            users[game['player2']]['tokens'] = users[game['player2']].get('tokens', 0) + total_pot
+            credit_tokens(game['player2'], total_pot)
             game['status'] = 'completed'
             game['winner'] = game['player2']
             game['completion_time'] = get_ny_time().timestamp()
             game['timeout_win'] = False
-            save_json(USERS_FILE, users)
 
             # Log the game to history
             log_rps_game(game)
@@ -4176,6 +6843,8 @@ def rps_move(other_user):
             game['player1_move'] = None
             game['player2_move'] = None
 
+    notify_rps(game['player1'], game['player2'])
+
     # Create response with hidden moves if needed
     # Check if game was deleted (completed) - use the game dict before deletion
     if game_key not in rps_games:
@@ -4302,6 +6971,7 @@ def get_advent_status():
 
 @app.route('/api/advent/open/<int:door_number>', methods=['POST'])
 @login_required
+@store_locked(ADVENT_CALENDAR_FILE)
 def open_advent_door(door_number):
     """Open an advent calendar door"""
     username = session['username']
@@ -4335,8 +7005,7 @@ def open_advent_door(door_number):
     if reward_config['type'] == 'tokens':
         # Award tokens immediately
         amount = reward_config['amount']
-        users[username]['tokens'] = users[username].get('tokens', 0) + amount
-        save_json(USERS_FILE, users)
+        new_balance = credit_tokens(username, amount)
 
         # Mark door as opened
         advent_calendar[username][door_key] = {
@@ -4350,7 +7019,7 @@ def open_advent_door(door_number):
             'success': True,
             'reward_type': 'tokens',
             'amount': amount,
-            'new_balance': users[username]['tokens']
+            'new_balance': new_balance
         })
 
     elif reward_config['type'] == 'free_game':
@@ -4467,22 +7136,13 @@ def claim_advent_game():
 
 def get_group_unread_count(username, group_id):
     """Count unread messages in a group for a user"""
-    if group_id not in group_messages or not group_messages[group_id]:
-        return 0
-
-    last_read = group_read_receipts.get(username, {}).get(group_id, '')
-
-    # Count messages from others that are newer than last_read
-    return sum(1 for msg in group_messages[group_id]
-               if msg.get('from') != username and msg.get('from') != 'system' and msg['timestamp'] > last_read)
+    with group_index_lock:
+        return group_unread.get(username, {}).get(group_id, 0)
 
 def get_total_group_unread_count(username):
     """Get total unread count across all groups user is member of"""
-    total = 0
-    for group_id, group_data in groups.items():
-        if username == group_data['leader'] or username in group_data.get('members', []):
-            total += get_group_unread_count(username, group_id)
-    return total
+    with group_index_lock:
+        return sum(group_unread.get(username, {}).values())
 
 @app.route('/groups')
 @maintenance_check
@@ -4494,15 +7154,16 @@ def groups_list():
     lounge_unread_count = get_lounge_unread_count(username)
 
     # Get groups with unread counts
+    my_group_ids = group_index.groups_of(username)
     groups_data = []
     for group_id, group_data in groups.items():
-        is_member = username == group_data['leader'] or username in group_data.get('members', [])
+        is_member = group_id in my_group_ids
         unread = get_group_unread_count(username, group_id) if is_member else 0
 
         # Get last message preview
         last_message = None
-        if group_id in group_messages and group_messages[group_id]:
-            last_msg = group_messages[group_id][-1]
+        last_msg = last_live_message(group_messages.get(group_id, []))
+        if last_msg:
             if last_msg.get('type') == 'snap':
                 preview = '📷 Snap'
             elif last_msg.get('type') == 'voice':
@@ -4531,7 +7192,7 @@ def groups_list():
     groups_data.sort(key=lambda x: x['last_message']['timestamp'] if x['last_message'] else '', reverse=True)
 
     # Check if user already has a group they lead
-    user_has_group = any(g['leader'] == username for g in groups.values())
+    user_has_group = group_index.leads_group(username)
 
     return render_template('groups_list.html',
         groups=groups_data,
@@ -4554,7 +7215,7 @@ def group_chat(group_id):
 
     username = session['username']
     group_data = groups[group_id]
-    is_member = username == group_data['leader'] or username in group_data.get('members', [])
+    is_member = group_index.is_member(username, group_id)
 
     if not is_member:
         # Show group info page for non-members
@@ -4567,10 +7228,7 @@ def group_chat(group_id):
 
     # Mark as read on page load
     if group_id in group_messages and group_messages[group_id]:
-        if username not in group_read_receipts:
-            group_read_receipts[username] = {}
-        group_read_receipts[username][group_id] = group_messages[group_id][-1]['timestamp']
-        save_json(GROUP_READ_RECEIPTS_FILE, group_read_receipts)
+        set_group_read(username, group_id, group_messages[group_id][-1]['timestamp'])
 
     # Get reactions for this group
     reactions = group_reactions.get(group_id, {})
@@ -4578,7 +7236,7 @@ def group_chat(group_id):
     return render_template('group_chat.html',
         group=group_data,
         group_id=group_id,
-        messages=group_messages.get(group_id, []),
+        messages=live_messages(group_messages.get(group_id, [])),
         reactions=reactions,
         current_user=username,
         is_leader=username == group_data['leader'],
@@ -4589,12 +7247,13 @@ def group_chat(group_id):
 
 @app.route('/api/group/create', methods=['POST'])
 @login_required
+@store_locked(GROUPS_FILE)
 def create_group():
     """Create a new group"""
     username = session['username']
 
     # Check if user already has a group
-    if any(g['leader'] == username for g in groups.values()):
+    if group_index.leads_group(username):
         return jsonify({'error': 'You can only create one group'}), 400
 
     # Check tokens
@@ -4614,7 +7273,7 @@ def create_group():
         return jsonify({'error': 'Group name must be 30 characters or less'}), 400
 
     # Check if group name already exists
-    if any(g['name'].lower() == group_name.lower() for g in groups.values()):
+    if group_index.name_taken(group_name):
         return jsonify({'error': 'A group with this name already exists'}), 400
 
     if len(members) > 5:
@@ -4628,8 +7287,8 @@ def create_group():
             return jsonify({'error': 'You cannot add yourself as a member'}), 400
 
     # Deduct tokens
-    users[username]['tokens'] -= 100
-    save_json(USERS_FILE, users)
+    if not debit_tokens(username, 100):
+        return jsonify({'error': 'Insufficient tokens. You need 100 tokens to create a group'}), 400
 
     # Create group
     import uuid
@@ -4640,34 +7299,31 @@ def create_group():
         'name': group_name,
         'leader': username,
         'members': members,
-        'image': image,
+        'image': media_ref(image),
         'created_at': get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
     }
 
-    # Initialize messages
-    group_messages[group_id] = [{
+    save_json(GROUPS_FILE, groups, keys=[group_id])
+    reindex_group(group_id)
+
+    # Initialize messages (append_message numbers it and starts the group's feed)
+    append_message(GROUP_MESSAGES_FILE, group_messages, {
         'from': 'system',
         'text': f'🎉 {username} created the group "{group_name}"',
         'timestamp': get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
-    }]
-
-    save_json(GROUPS_FILE, groups)
-    save_json(GROUP_MESSAGES_FILE, group_messages)
+    }, key=group_id)
 
     # Send notifications to added members via chat
     for member in members:
         chat_key = get_chat_key(username, member)
-        if chat_key not in messages:
-            messages[chat_key] = []
-        messages[chat_key].append({
+        append_message(MESSAGES_FILE, messages, {
             'from': 'system',
             'to': member,
             'type': 'group_invite',
             'text': f'🎊 {username} added you to the group "{group_name}"!',
             'timestamp': get_ny_time().strftime('%Y-%m-%d %H:%M:%S'),
             'read': False
-        })
-    save_json(MESSAGES_FILE, messages)
+        }, key=chat_key)
 
     return jsonify({
         'success': True,
@@ -4683,34 +7339,27 @@ def send_group_message(group_id):
         return jsonify({'error': 'Group not found'}), 404
 
     username = session['username']
-    group_data = groups[group_id]
 
     # Check if user is member
-    if username != group_data['leader'] and username not in group_data.get('members', []):
+    if not group_index.is_member(username, group_id):
         return jsonify({'error': 'You are not a member of this group'}), 403
 
     message_text = request.form.get('message', '').strip()
     if not message_text:
         return jsonify({'error': 'Message cannot be empty'}), 400
 
-    if group_id not in group_messages:
-        group_messages[group_id] = []
 
     new_timestamp = get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
 
-    group_messages[group_id].append({
+    append_message(GROUP_MESSAGES_FILE, group_messages, {
         'from': username,
         'text': message_text,
         'timestamp': new_timestamp
-    })
+    }, key=group_id)
 
-    save_json(GROUP_MESSAGES_FILE, group_messages)
 
     # Mark as read for sender
-    if username not in group_read_receipts:
-        group_read_receipts[username] = {}
-    group_read_receipts[username][group_id] = new_timestamp
-    save_json(GROUP_READ_RECEIPTS_FILE, group_read_receipts)
+    set_group_read(username, group_id, new_timestamp)
 
     return jsonify({'success': True})
 
@@ -4725,11 +7374,11 @@ def get_group_messages(group_id):
     group_data = groups[group_id]
 
     # Check if user is member
-    if username != group_data['leader'] and username not in group_data.get('members', []):
+    if not group_index.is_member(username, group_id):
         return jsonify({'error': 'You are not a member of this group'}), 403
 
     return jsonify({
-        'messages': group_messages.get(group_id, []),
+        'messages': live_messages(group_messages.get(group_id, [])),
         'reactions': group_reactions.get(group_id, {}),
         'group': group_data
     })
@@ -4744,10 +7393,7 @@ def mark_group_read(group_id):
     username = session['username']
 
     if group_id in group_messages and group_messages[group_id]:
-        if username not in group_read_receipts:
-            group_read_receipts[username] = {}
-        group_read_receipts[username][group_id] = group_messages[group_id][-1]['timestamp']
-        save_json(GROUP_READ_RECEIPTS_FILE, group_read_receipts)
+        set_group_read(username, group_id, group_messages[group_id][-1]['timestamp'])
 
     return jsonify({'success': True})
 
@@ -4759,35 +7405,28 @@ def send_group_snap(group_id):
         return jsonify({'error': 'Group not found'}), 404
 
     username = session['username']
-    group_data = groups[group_id]
 
-    if username != group_data['leader'] and username not in group_data.get('members', []):
+    if not group_index.is_member(username, group_id):
         return jsonify({'error': 'You are not a member of this group'}), 403
 
     photo_data = request.json.get('photo')
     if not photo_data:
         return jsonify({'error': 'No photo provided'}), 400
 
-    if group_id not in group_messages:
-        group_messages[group_id] = []
 
     new_timestamp = get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
 
-    group_messages[group_id].append({
+    append_message(GROUP_MESSAGES_FILE, group_messages, {
         'from': username,
         'type': 'snap',
-        'photo': photo_data,
+        'photo': media_ref(photo_data),
         'opened_by': [],
         'timestamp': new_timestamp
-    })
+    }, key=group_id)
 
-    save_json(GROUP_MESSAGES_FILE, group_messages)
 
     # Mark as read for sender
-    if username not in group_read_receipts:
-        group_read_receipts[username] = {}
-    group_read_receipts[username][group_id] = new_timestamp
-    save_json(GROUP_READ_RECEIPTS_FILE, group_read_receipts)
+    set_group_read(username, group_id, new_timestamp)
 
     return jsonify({'success': True})
 
@@ -4799,9 +7438,8 @@ def send_group_voice(group_id):
         return jsonify({'error': 'Group not found'}), 404
 
     username = session['username']
-    group_data = groups[group_id]
 
-    if username != group_data['leader'] and username not in group_data.get('members', []):
+    if not group_index.is_member(username, group_id):
         return jsonify({'error': 'You are not a member of this group'}), 403
 
     audio_data = request.json.get('audio')
@@ -4810,61 +7448,58 @@ def send_group_voice(group_id):
     if not audio_data:
         return jsonify({'error': 'No audio provided'}), 400
 
-    if group_id not in group_messages:
-        group_messages[group_id] = []
 
     new_timestamp = get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
 
-    group_messages[group_id].append({
+    append_message(GROUP_MESSAGES_FILE, group_messages, {
         'from': username,
         'type': 'voice',
-        'audio': audio_data,
+        'audio': media_ref(audio_data),
         'duration': duration,
         'timestamp': new_timestamp
-    })
+    }, key=group_id)
 
-    save_json(GROUP_MESSAGES_FILE, group_messages)
 
     # Mark as read for sender
-    if username not in group_read_receipts:
-        group_read_receipts[username] = {}
-    group_read_receipts[username][group_id] = new_timestamp
-    save_json(GROUP_READ_RECEIPTS_FILE, group_read_receipts)
+    set_group_read(username, group_id, new_timestamp)
 
     return jsonify({'success': True})
 
-@app.route('/api/group/<group_id>/open_snap/<int:message_index>', methods=['POST'])
+@app.route('/api/group/<group_id>/open_snap/<int:message_id>', methods=['POST'])
 @login_required
-def open_group_snap(group_id, message_index):
+def open_group_snap(group_id, message_id):
     """Open a snap in a group"""
     if group_id not in groups:
         return jsonify({'error': 'Group not found'}), 404
 
     username = session['username']
-    group_data = groups[group_id]
 
-    if username != group_data['leader'] and username not in group_data.get('members', []):
+    if not group_index.is_member(username, group_id):
         return jsonify({'error': 'You are not a member of this group'}), 403
 
-    if group_id not in group_messages or message_index >= len(group_messages[group_id]):
-        return jsonify({'error': 'Snap not found'}), 404
+    with locks.stores(GROUP_MESSAGES_FILE, GROUP_REACTIONS_FILE):
+        position = live_position(group_messages.get(group_id, []), message_id)
+        if position is None:
+            return jsonify({'error': 'Snap not found'}), 404
 
-    msg = group_messages[group_id][message_index]
+        msg = group_messages[group_id][position]
 
-    if msg.get('type') != 'snap':
-        return jsonify({'error': 'Not a snap'}), 400
+        if msg.get('type') != 'snap':
+            return jsonify({'error': 'Not a snap'}), 400
 
-    if msg.get('from') == username:
-        return jsonify({'error': "You can't view your own snaps!"}), 400
+        if msg.get('from') == username:
+            return jsonify({'error': "You can't view your own snaps!"}), 400
 
-    if username in msg.get('opened_by', []):
-        return jsonify({'error': 'Already opened'}), 400
+        if username in msg.get('opened_by', []):
+            return jsonify({'error': 'Already opened'}), 400
 
-    if 'opened_by' not in msg:
-        msg['opened_by'] = []
-    msg['opened_by'].append(username)
+        if 'opened_by' not in msg:
+            msg['opened_by'] = []
+        msg['opened_by'].append(username)
+        group_feed(group_id).edited(msg)
 
-    save_json(GROUP_MESSAGES_FILE, group_messages)
+        save_json(GROUP_MESSAGES_FILE, group_messages, keys=[group_id])
+    notify_group(group_id)
 
     return jsonify({
         'success': True,
@@ -4872,49 +7507,52 @@ def open_group_snap(group_id, message_index):
         'opened_count': len(msg['opened_by'])
     })
 
-@app.route('/api/group/<group_id>/react/<int:message_index>', methods=['POST'])
+@app.route('/api/group/<group_id>/react/<int:message_id>', methods=['POST'])
 @login_required
-def react_to_group_message(group_id, message_index):
+def react_to_group_message(group_id, message_id):
     """React to a message in a group"""
     if group_id not in groups:
         return jsonify({'error': 'Group not found'}), 404
 
     username = session['username']
-    group_data = groups[group_id]
 
-    if username != group_data['leader'] and username not in group_data.get('members', []):
+    if not group_index.is_member(username, group_id):
         return jsonify({'error': 'You are not a member of this group'}), 403
 
     emoji = request.json.get('emoji')
     if not emoji:
         return jsonify({'error': 'No emoji provided'}), 400
 
-    if group_id not in group_messages or message_index >= len(group_messages[group_id]):
-        return jsonify({'error': 'Message not found'}), 404
+    with locks.stores(GROUP_MESSAGES_FILE, GROUP_REACTIONS_FILE):
+        if live_position(group_messages.get(group_id, []), message_id) is None:
+            return jsonify({'error': 'Message not found'}), 404
 
-    if group_id not in group_reactions:
-        group_reactions[group_id] = {}
+        if group_id not in group_reactions:
+            group_reactions[group_id] = {}
 
-    msg_key = str(message_index)
-    if msg_key not in group_reactions[group_id]:
-        group_reactions[group_id][msg_key] = {}
+        msg_key = str(message_id)
+        if msg_key not in group_reactions[group_id]:
+            group_reactions[group_id][msg_key] = {}
 
-    if emoji not in group_reactions[group_id][msg_key]:
-        group_reactions[group_id][msg_key][emoji] = []
+        if emoji not in group_reactions[group_id][msg_key]:
+            group_reactions[group_id][msg_key][emoji] = []
 
-    if username in group_reactions[group_id][msg_key][emoji]:
-        group_reactions[group_id][msg_key][emoji].remove(username)
-        if not group_reactions[group_id][msg_key][emoji]:
-            del group_reactions[group_id][msg_key][emoji]
-    else:
-        group_reactions[group_id][msg_key][emoji].append(username)
+        if username in group_reactions[group_id][msg_key][emoji]:
+            group_reactions[group_id][msg_key][emoji].remove(username)
+            if not group_reactions[group_id][msg_key][emoji]:
+                del group_reactions[group_id][msg_key][emoji]
+        else:
+            group_reactions[group_id][msg_key][emoji].append(username)
 
-    save_json(GROUP_REACTIONS_FILE, group_reactions)
+        save_json(GROUP_REACTIONS_FILE, group_reactions, keys=[group_id])
+        reactions = dict(group_reactions[group_id].get(msg_key, {}))
+    notify_group(group_id)
 
-    return jsonify({'success': True, 'reactions': group_reactions[group_id].get(msg_key, {})})
+    return jsonify({'success': True, 'reactions': reactions})
 
 @app.route('/api/group/<group_id>/add_member', methods=['POST'])
 @login_required
+@store_locked(GROUPS_FILE)
 def add_group_member(group_id):
     """Add a member to a group (leader only)"""
     if group_id not in groups:
@@ -4949,35 +7587,31 @@ def add_group_member(group_id):
     groups[group_id]['members'].append(member_username)
 
     # Add system message
-    if group_id not in group_messages:
-        group_messages[group_id] = []
-    group_messages[group_id].append({
+    append_message(GROUP_MESSAGES_FILE, group_messages, {
         'from': 'system',
         'text': f'👋 {member_username} was added to the group by {username}',
         'timestamp': get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
-    })
+    }, key=group_id)
 
-    save_json(GROUPS_FILE, groups)
-    save_json(GROUP_MESSAGES_FILE, group_messages)
+    save_json(GROUPS_FILE, groups, keys=[group_id])
+    reindex_group(group_id)
 
     # Send notification to added member via chat
     chat_key = get_chat_key(username, member_username)
-    if chat_key not in messages:
-        messages[chat_key] = []
-    messages[chat_key].append({
+    append_message(MESSAGES_FILE, messages, {
         'from': 'system',
         'to': member_username,
         'type': 'group_invite',
         'text': f'🎊 {username} added you to the group "{group_data["name"]}"!',
         'timestamp': get_ny_time().strftime('%Y-%m-%d %H:%M:%S'),
         'read': False
-    })
-    save_json(MESSAGES_FILE, messages)
+    }, key=chat_key)
 
     return jsonify({'success': True})
 
 @app.route('/api/group/<group_id>/kick_member', methods=['POST'])
 @login_required
+@store_locked(GROUPS_FILE)
 def kick_group_member(group_id):
     """Kick a member from a group (leader only)"""
     if group_id not in groups:
@@ -5000,19 +7634,20 @@ def kick_group_member(group_id):
     groups[group_id]['members'].remove(member_username)
 
     # Add system message
-    group_messages[group_id].append({
+    append_message(GROUP_MESSAGES_FILE, group_messages, {
         'from': 'system',
         'text': f'👢 {member_username} was removed from the group',
         'timestamp': get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
-    })
+    }, key=group_id)
 
-    save_json(GROUPS_FILE, groups)
-    save_json(GROUP_MESSAGES_FILE, group_messages)
+    save_json(GROUPS_FILE, groups, keys=[group_id])
+    reindex_group(group_id)
 
     return jsonify({'success': True})
 
 @app.route('/api/group/<group_id>/leave', methods=['POST'])
 @login_required
+@store_locked(GROUPS_FILE)
 def leave_group(group_id):
     """Leave a group"""
     if group_id not in groups:
@@ -5031,19 +7666,20 @@ def leave_group(group_id):
     groups[group_id]['members'].remove(username)
 
     # Add system message
-    group_messages[group_id].append({
+    append_message(GROUP_MESSAGES_FILE, group_messages, {
         'from': 'system',
         'text': f'👋 {username} left the group',
         'timestamp': get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
-    })
+    }, key=group_id)
 
-    save_json(GROUPS_FILE, groups)
-    save_json(GROUP_MESSAGES_FILE, group_messages)
+    save_json(GROUPS_FILE, groups, keys=[group_id])
+    reindex_group(group_id)
 
     return jsonify({'success': True})
 
 @app.route('/api/group/<group_id>/delete', methods=['POST'])
 @login_required
+@store_locked(GROUPS_FILE, GROUP_MESSAGES_FILE, GROUP_REACTIONS_FILE, GROUP_READ_RECEIPTS_FILE)
 def delete_group(group_id):
     """Delete a group (leader only)"""
     if group_id not in groups:
@@ -5056,27 +7692,13 @@ def delete_group(group_id):
         return jsonify({'error': 'Only the group leader can delete the group'}), 403
 
     # Delete group and all associated data
-    del groups[group_id]
-    if group_id in group_messages:
-        del group_messages[group_id]
-    if group_id in group_reactions:
-        del group_reactions[group_id]
-
-    # Remove from read receipts
-    for user in group_read_receipts:
-        if group_id in group_read_receipts[user]:
-            del group_read_receipts[user][group_id]
-
-    save_json(GROUPS_FILE, groups)
-    save_json(GROUP_MESSAGES_FILE, group_messages)
-    save_json(GROUP_REACTIONS_FILE, group_reactions)
-    save_json(GROUP_READ_RECEIPTS_FILE, group_read_receipts)
+    remove_group(group_id)
 
     return jsonify({'success': True})
 
-@app.route('/api/group/<group_id>/delete_message/<int:message_index>', methods=['POST'])
+@app.route('/api/group/<group_id>/delete_message/<int:message_id>', methods=['POST'])
 @login_required
-def delete_group_message(group_id, message_index):
+def delete_group_message(group_id, message_id):
     """Delete a message from group (leader only)"""
     if group_id not in groups:
         return jsonify({'error': 'Group not found'}), 404
@@ -5087,25 +7709,21 @@ def delete_group_message(group_id, message_index):
     if username != group_data['leader']:
         return jsonify({'error': 'Only the group leader can delete messages'}), 403
 
-    if group_id not in group_messages or message_index >= len(group_messages[group_id]):
-        return jsonify({'error': 'Message not found'}), 404
-
-    # Delete message
-    group_messages[group_id].pop(message_index)
+    with locks.stores(GROUP_MESSAGES_FILE, GROUP_REACTIONS_FILE):
+        position = live_position(group_messages.get(group_id, []), message_id)
+        if position is None:
+            return jsonify({'error': 'Message not found'}), 404
 
-    # Update reactions indices
-    if group_id in group_reactions:
-        new_reactions = {}
-        for key, reactions in group_reactions[group_id].items():
-            idx = int(key)
-            if idx < message_index:
-                new_reactions[key] = reactions
-            elif idx > message_index:
-                new_reactions[str(idx - 1)] = reactions
-        group_reactions[group_id] = new_reactions
+        # Leave a tombstone; reactions of other messages are keyed by ID and stay put
+        msg = tombstone(group_messages[group_id][position])
+        group_feed(group_id).edited(msg)
+        group_messages[group_id][position] = msg
+        save_json(GROUP_MESSAGES_FILE, group_messages, keys=[group_id])
 
-    save_json(GROUP_MESSAGES_FILE, group_messages)
-    save_json(GROUP_REACTIONS_FILE, group_reactions)
+        if group_reactions.get(group_id, {}).pop(str(message_id), None) is not None:
+            save_json(GROUP_REACTIONS_FILE, group_reactions, keys=[group_id])
+    reindex_group(group_id)
+    notify_group(group_id)
 
     return jsonify({'success': True})
 
@@ -5130,7 +7748,7 @@ def admin_get_groups():
     groups_list = []
     for group_id, group_data in groups.items():
         all_members = [group_data['leader']] + group_data.get('members', [])
-        message_count = len(group_messages.get(group_id, []))
+        message_count = len(live_messages(group_messages.get(group_id, [])))
         groups_list.append({
             'id': group_id,
             'name': group_data['name'],
@@ -5148,6 +7766,7 @@ def admin_get_groups():
 
 @app.route('/api/admin/group/<group_id>/rename', methods=['POST'])
 @panel_access_required
+@store_locked(GROUPS_FILE)
 def admin_rename_group(group_id):
     """Admin rename a group"""
     if not has_permission(session['username'], 'manage_groups'):
@@ -5166,27 +7785,26 @@ def admin_rename_group(group_id):
         return jsonify({'success': False, 'error': 'Group name must be 30 characters or less'}), 400
 
     # Check if name already exists (excluding current group)
-    if any(g['name'].lower() == new_name.lower() and gid != group_id for gid, g in groups.items()):
+    if group_index.name_taken(new_name, exclude=group_id):
         return jsonify({'success': False, 'error': 'A group with this name already exists'}), 400
 
     old_name = groups[group_id]['name']
     groups[group_id]['name'] = new_name
-    save_json(GROUPS_FILE, groups)
+    save_json(GROUPS_FILE, groups, keys=[group_id])
+    reindex_group(group_id)
 
     # Add system message
-    if group_id not in group_messages:
-        group_messages[group_id] = []
-    group_messages[group_id].append({
+    append_message(GROUP_MESSAGES_FILE, group_messages, {
         'from': 'system',
         'text': f'✏️ Group renamed from "{old_name}" to "{new_name}" by admin',
         'timestamp': get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
-    })
-    save_json(GROUP_MESSAGES_FILE, group_messages)
+    }, key=group_id)
 
     return jsonify({'success': True, 'new_name': new_name})
 
 @app.route('/api/admin/group/<group_id>/delete', methods=['POST'])
 @panel_access_required
+@store_locked(GROUPS_FILE, GROUP_MESSAGES_FILE, GROUP_REACTIONS_FILE, GROUP_READ_RECEIPTS_FILE)
 def admin_delete_group(group_id):
     """Admin delete a group"""
     if not has_permission(session['username'], 'manage_groups'):
@@ -5198,26 +7816,13 @@ def admin_delete_group(group_id):
     group_name = groups[group_id]['name']
 
     # Delete all group data
-    del groups[group_id]
-    if group_id in group_messages:
-        del group_messages[group_id]
-    if group_id in group_reactions:
-        del group_reactions[group_id]
-
-    # Clean up read receipts
-    for username in list(group_read_receipts.keys()):
-        if group_id in group_read_receipts[username]:
-            del group_read_receipts[username][group_id]
-
-    save_json(GROUPS_FILE, groups)
-    save_json(GROUP_MESSAGES_FILE, group_messages)
-    save_json(GROUP_REACTIONS_FILE, group_reactions)
-    save_json(GROUP_READ_RECEIPTS_FILE, group_read_receipts)
+    remove_group(group_id)
 
     return jsonify({'success': True, 'deleted_name': group_name})
 
 @app.route('/api/admin/group/<group_id>/kick/<member>', methods=['POST'])
 @panel_access_required
+@store_locked(GROUPS_FILE)
 def admin_kick_member(group_id, member):
     """Admin kick a member from a group"""
     if not has_permission(session['username'], 'manage_groups'):
@@ -5235,22 +7840,21 @@ def admin_kick_member(group_id, member):
         return jsonify({'success': False, 'error': 'User is not a member of this group'}), 400
 
     groups[group_id]['members'].remove(member)
-    save_json(GROUPS_FILE, groups)
+    save_json(GROUPS_FILE, groups, keys=[group_id])
+    reindex_group(group_id)
 
     # Add system message
-    if group_id not in group_messages:
-        group_messages[group_id] = []
-    group_messages[group_id].append({
+    append_message(GROUP_MESSAGES_FILE, group_messages, {
         'from': 'system',
         'text': f'👢 {member} was removed from the group by admin',
         'timestamp': get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
-    })
-    save_json(GROUP_MESSAGES_FILE, group_messages)
+    }, key=group_id)
 
     return jsonify({'success': True})
 
 @app.route('/api/admin/group/<group_id>/transfer/<new_leader>', methods=['POST'])
 @panel_access_required
+@store_locked(GROUPS_FILE)
 def admin_transfer_leadership(group_id, new_leader):
     """Admin transfer group leadership"""
     if not has_permission(session['username'], 'manage_groups'):
@@ -5266,8 +7870,7 @@ def admin_transfer_leadership(group_id, new_leader):
         return jsonify({'success': False, 'error': 'User does not exist'}), 400
 
     # Check if new leader is a member or the current leader
-    all_members = [old_leader] + group_data.get('members', [])
-    if new_leader not in all_members:
+    if not group_index.is_member(new_leader, group_id):
         return jsonify({'success': False, 'error': 'New leader must be a current member of the group'}), 400
 
     if new_leader == old_leader:
@@ -5284,22 +7887,21 @@ def admin_transfer_leadership(group_id, new_leader):
         members.append(old_leader)
     groups[group_id]['members'] = members
 
-    save_json(GROUPS_FILE, groups)
+    save_json(GROUPS_FILE, groups, keys=[group_id])
+    reindex_group(group_id)
 
     # Add system message
-    if group_id not in group_messages:
-        group_messages[group_id] = []
-    group_messages[group_id].append({
+    append_message(GROUP_MESSAGES_FILE, group_messages, {
         'from': 'system',
         'text': f'👑 Leadership transferred from {old_leader} to {new_leader} by admin',
         'timestamp': get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
-    })
-    save_json(GROUP_MESSAGES_FILE, group_messages)
+    }, key=group_id)
 
     return jsonify({'success': True, 'new_leader': new_leader})
 
 @app.route('/api/admin/group/<group_id>/add_member', methods=['POST'])
 @panel_access_required
+@store_locked(GROUPS_FILE)
 def admin_add_member(group_id):
     """Admin add a member to a group"""
     if not has_permission(session['username'], 'manage_groups'):
@@ -5317,26 +7919,21 @@ def admin_add_member(group_id):
     if new_member not in users:
         return jsonify({'success': False, 'error': 'User does not exist'}), 400
 
-    group_data = groups[group_id]
-    all_members = [group_data['leader']] + group_data.get('members', [])
-
-    if new_member in all_members:
+    if group_index.is_member(new_member, group_id):
         return jsonify({'success': False, 'error': 'User is already a member'}), 400
 
     if 'members' not in groups[group_id]:
         groups[group_id]['members'] = []
     groups[group_id]['members'].append(new_member)
-    save_json(GROUPS_FILE, groups)
+    save_json(GROUPS_FILE, groups, keys=[group_id])
+    reindex_group(group_id)
 
     # Add system message
-    if group_id not in group_messages:
-        group_messages[group_id] = []
-    group_messages[group_id].append({
+    append_message(GROUP_MESSAGES_FILE, group_messages, {
         'from': 'system',
         'text': f'➕ {new_member} was added to the group by admin',
         'timestamp': get_ny_time().strftime('%Y-%m-%d %H:%M:%S')
-    })
-    save_json(GROUP_MESSAGES_FILE, group_messages)
+    }, key=group_id)
 
     return jsonify({'success': True})
 
@@ -5346,17 +7943,18 @@ def report_message():
     """Report a message in private chat"""
     data = request.json
     chat_key = data.get('chat_key')
-    message_index = data.get('message_index')
+    message_id = data.get('message_id')
     reason = data.get('reason', '')
 
-    if not chat_key or message_index is None:
+    if not chat_key or not isinstance(message_id, int):
         return jsonify({'error': 'Invalid request'}), 400
 
     # Get the message
-    if chat_key not in messages or message_index >= len(messages[chat_key]):
+    position = message_position(messages.get(chat_key, []), message_id)
+    if position is None:
         return jsonify({'error': 'Message not found'}), 404
 
-    msg = messages[chat_key][message_index]
+    msg = messages[chat_key][position]
     reporter = session['username']
 
     # Can't report your own messages
@@ -5365,13 +7963,13 @@ def report_message():
 
     # Check if already reported
     for report in reported_messages:
-        if report['chat_key'] == chat_key and report['message_index'] == message_index:
+        if report['chat_key'] == chat_key and report.get('message_id') == message_id:
             return jsonify({'error': 'Message already reported'}), 400
 
     report = {
         'id': len(reported_messages) + 1,
         'chat_key': chat_key,
-        'message_index': message_index,
+        'message_id': message_id,
         'message_content': msg.get('text', '[Media Message]'),
         'message_type': msg.get('type', 'text'),
         'sender': msg.get('from'),
@@ -5601,6 +8199,7 @@ def adjust_paycheck(paycheck_id):
 
 @app.route('/api/approve_paycheck/<int:paycheck_id>', methods=['POST'])
 @login_required
+@store_locked(PAYCHECKS_FILE)
 def approve_paycheck(paycheck_id):
     """Approve a pending paycheck"""
     if not has_permission(session['username'], 'approve_paychecks'):
@@ -5628,8 +8227,7 @@ def approve_paycheck(paycheck_id):
 
             # Pay the user
             if recipient in users:
-                users[recipient]['tokens'] = users[recipient].get('tokens', 0) + amount
-                save_json(USERS_FILE, users)
+                credit_tokens(recipient, amount)
 
                 # Log the transaction
                 log_transaction(
@@ -5656,20 +8254,21 @@ def approve_paycheck(paycheck_id):
             save_json(PAYCHECKS_FILE, paychecks)
 
             # Send notification to recipient
-            if recipient in login_notifications:
-                if not isinstance(login_notifications[recipient], list):
+            with locks.stores(LOGIN_NOTIFICATIONS_FILE):
+                if recipient in login_notifications:
+                    if not isinstance(login_notifications[recipient], list):
+                        login_notifications[recipient] = []
+                else:
                     login_notifications[recipient] = []
-            else:
-                login_notifications[recipient] = []
-
-            login_notifications[recipient].append({
-                'type': 'paycheck_approved',
-                'message': f'Your paycheck of {amount} 🎟️ has been approved!',
-                'note': president_note,
-                'timestamp': get_ny_time().strftime('%Y-%m-%d %H:%M:%S'),
-                'approved_by': actor
-            })
-            save_json(LOGIN_NOTIFICATIONS_FILE, login_notifications)
+
+                login_notifications[recipient].append({
+                    'type': 'paycheck_approved',
+                    'message': f'Your paycheck of {amount} 🎟️ has been approved!',
+                    'note': president_note,
+                    'timestamp': get_ny_time().strftime('%Y-%m-%d %H:%M:%S'),
+                    'approved_by': actor
+                })
+                save_json(LOGIN_NOTIFICATIONS_FILE, login_notifications, keys=[recipient])
 
             log_action(
                 actor=actor,
@@ -5745,6 +8344,7 @@ def get_token_stats_api():
         'destroyed_total': destroyed_total,
         'daily_totals': stats.get('daily_totals', {}),
         'total_transactions': stats.get('total_transactions', 0),
+        'circulation': stats['circulation'],
         'user_transactions': user_transactions
     })
 